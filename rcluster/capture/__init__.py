@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Captures the incoming requests into a file and replays them.
+"""
+
+import argparse
+import logging
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+import traceback
+
+import rcluster.shared
+
+
+class Capture:
+    """
+    Records the sampled incoming requests with their arrival times into a
+    capture file. Stops by itself once the file reaches the size limit.
+
+    The capture files are only created in the directory set by the
+    operator. Without the directory the capture is disabled.
+    """
+
+    MAGIC = b"RCCAP1\n"
+    # Microseconds since the capture start, request size.
+    HEADER = struct.Struct(">QI")
+    # Only the data commands are replayed: the admin commands would change
+    # the topology and the settings of the target cluster.
+    RECORDED_COMMANDS = frozenset((
+        b"GET",
+        b"SET",
+        b"SETEX",
+        b"EXPIRE",
+        b"TTL",
+        b"SCAN",
+        b"PING",
+        b"ECHO",
+    ))
+
+    def __init__(self, directory=None):
+        self._logger = logging.getLogger("rcluster.capture.Capture")
+        self._directory = directory
+        self._file = None
+        self._sample_rate = 1.0
+        self._max_size = 0
+        self._size = 0
+        self._started_at = 0.0
+        self._recorded = 0
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def active(self):
+        return self._file is not None
+
+    @property
+    def recorded(self):
+        """
+        Number of the requests recorded by the last capture.
+        """
+
+        return self._recorded
+
+    def start(self, name, sample_rate=1.0, max_size=64 * 1048576):
+        """
+        Starts capturing into the file with the name in the capture
+        directory.
+        """
+
+        if self._directory is None:
+            raise RuntimeError("Capture directory is not set.")
+        if self._file is not None:
+            raise RuntimeError("Capture is already started.")
+        if (
+            not name or
+            "/" in name or
+            "\\" in name or
+            ".." in name
+        ):
+            raise ValueError("Invalid capture file name: %r." % name)
+        path = os.path.join(self._directory, name)
+        self._file = open(path, "wb")
+        self._file.write(Capture.MAGIC)
+        self._sample_rate = sample_rate
+        self._max_size = max_size
+        self._size = len(Capture.MAGIC)
+        self._started_at = time.time()
+        self._recorded = 0
+        self._logger.info("Capturing the requests into %s.", path)
+
+    def stop(self):
+        """
+        Stops the capture. Returns the number of the recorded requests.
+        """
+
+        if self._file is None:
+            raise RuntimeError("Capture is not started.")
+        self._file.close()
+        self._file = None
+        self._logger.info("Captured %d requests.", self._recorded)
+        return self._recorded
+
+    def record(self, command, arguments):
+        if self._file is None:
+            return
+        if self._sample_rate < 1.0 and random.random() >= self._sample_rate:
+            return
+        if command.upper() not in Capture.RECORDED_COMMANDS:
+            return
+        request = rcluster.shared.encode_request([command] + arguments)
+        size = Capture.HEADER.size + len(request)
+        if self._size + size > self._max_size:
+            self._logger.info("Capture file is full.")
+            self.stop()
+            return
+        try:
+            self._file.write(Capture.HEADER.pack(
+                int((time.time() - self._started_at) * 1000000),
+                len(request),
+            ))
+            self._file.write(request)
+        except OSError as ex:
+            # Never fail the request because of the capture.
+            self._logger.error("Could not write the capture: %s", ex)
+            self.stop()
+            return
+        self._size += size
+        self._recorded += 1
+
+
+def read_capture(capture_file):
+    """
+    Reads the (offset in seconds, encoded request) records.
+    """
+
+    if capture_file.read(len(Capture.MAGIC)) != Capture.MAGIC:
+        raise ValueError("Not an rcluster capture file.")
+    header_size = Capture.HEADER.size
+    while True:
+        header = capture_file.read(header_size)
+        if not header:
+            break
+        if len(header) < header_size:
+            raise ValueError("Truncated capture file.")
+        offset, request_size = Capture.HEADER.unpack(header)
+        request = capture_file.read(request_size)
+        if len(request) < request_size:
+            raise ValueError("Truncated capture file.")
+        yield offset / 1000000.0, request
+
+
+def _read_reply(stream):
+    """
+    Reads the reply. Returns whether it is not an error.
+    """
+
+    line = stream.readline()
+    if not line:
+        raise EOFError("Connection is closed.")
+    if line[:1] == b"$":
+        length = int(line[1:])
+        if length >= 0:
+            stream.read(length + 2)
+    elif line[:1] == b"*":
+        for _ in range(int(line[1:])):
+            _read_reply(stream)
+    return line[:1] != b"-"
+
+
+class _Replayer:
+    """
+    Replays the requests over a single connection keeping their schedule.
+    """
+
+    # Maximum number of the read requests waiting for the connection.
+    QUEUE_SIZE = 1024
+
+    def __init__(self, address, speed, started_at):
+        self._address = address
+        self._requests = queue.Queue(_Replayer.QUEUE_SIZE)
+        self._speed = speed
+        self._started_at = started_at
+        self.latencies = list()
+        self.errors = 0
+
+    def put(self, record):
+        """
+        Queues the record, waits while the queue is full. None stops the
+        replay.
+        """
+
+        self._requests.put(record)
+
+    def run(self):
+        connection = stream = None
+        try:
+            for offset, request in iter(self._requests.get, None):
+                if self._speed:
+                    delay = (
+                        self._started_at + offset / self._speed - time.time()
+                    )
+                    if delay > 0.0:
+                        time.sleep(delay)
+                try:
+                    if connection is None:
+                        connection = socket.create_connection(self._address)
+                        connection.setsockopt(
+                            socket.IPPROTO_TCP,
+                            socket.TCP_NODELAY,
+                            1,
+                        )
+                        stream = connection.makefile("rb")
+                    sent_at = time.time()
+                    connection.sendall(request)
+                    succeeded = _read_reply(stream)
+                except (EOFError, OSError):
+                    succeeded = False
+                else:
+                    self.latencies.append(time.time() - sent_at)
+                if not succeeded:
+                    self.errors += 1
+                    # The server may close the connection after an error.
+                    if stream is not None:
+                        stream.close()
+                    if connection is not None:
+                        connection.close()
+                    connection = stream = None
+        finally:
+            if stream is not None:
+                stream.close()
+            if connection is not None:
+                connection.close()
+
+
+def replay(address, records, speed=1.0, connection_count=1):
+    """
+    Replays the records against the server. The records are streamed, so
+    that the whole capture is never held in memory, and are spread across
+    the connections in turn. The speed scales the original schedule, zero
+    replays as fast as possible. Returns the answered request count, the
+    error count, the elapsed time and the sorted latencies.
+    """
+
+    started_at = time.time()
+    replayers = [
+        _Replayer(address, speed, started_at)
+        for _ in range(connection_count)
+    ]
+    threads = [
+        threading.Thread(target=replayer.run)
+        for replayer in replayers
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for index, record in enumerate(records):
+            replayers[index % connection_count].put(record)
+    finally:
+        for replayer in replayers:
+            replayer.put(None)
+        for thread in threads:
+            thread.join()
+    elapsed = time.time() - started_at
+
+    latencies = sorted(
+        latency
+        for replayer in replayers
+        for latency in replayer.latencies
+    )
+    errors = sum(replayer.errors for replayer in replayers)
+    return len(latencies), errors, elapsed, latencies
+
+
+def _percentile(latencies, percent):
+    if not latencies:
+        return 0.0
+    index = int(len(latencies) * percent / 100.0 + 0.5) - 1
+    return latencies[min(max(index, 0), len(latencies) - 1)]
+
+
+def replay_entry_point():
+    parser = argparse.ArgumentParser(
+        description="Replays a capture file against rcluster-shard.",
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="rcluster-replay",
+    )
+    parser.add_argument(
+        "--log-level",
+        dest="log_level",
+        type=str,
+        metavar="LEVEL",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "FATAL"],
+        default="INFO",
+        help="logging level (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        type=str,
+        metavar="HOST",
+        default="localhost",
+        help="proxy host (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--port",
+        dest="port_number",
+        type=int,
+        metavar="PORT",
+        default=6381,
+        help="proxy port (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--speed",
+        dest="speed",
+        type=float,
+        metavar="FACTOR",
+        default=1.0,
+        help=(
+            "replay speed relative to the capture, 0 replays as fast as\n"
+            "possible (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--connections",
+        dest="connection_count",
+        type=int,
+        metavar="COUNT",
+        default=1,
+        help=(
+            "number of connections, the requests are spread across them\n"
+            "(default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "path",
+        type=str,
+        metavar="FILE",
+        help="capture file",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level),
+        format="%(asctime)s [%(process)d] %(name)s %(levelname)s: %(message)s",
+    )
+    logger = logging.getLogger("rcluster.capture")
+
+    try:
+        with open(args.path, "rb") as capture_file:
+            logger.info("Replaying %s ...", args.path)
+            count, errors, elapsed, latencies = replay(
+                (args.host, args.port_number),
+                read_capture(capture_file),
+                args.speed,
+                max(args.connection_count, 1),
+            )
+    except (OSError, ValueError) as ex:
+        logger.fatal(str(ex))
+        return os.EX_UNAVAILABLE
+    except KeyboardInterrupt:
+        logger.info("Keyboard interrupt.")
+        return os.EX_SOFTWARE
+    except:
+        logger.fatal(traceback.format_exc())
+        return os.EX_SOFTWARE
+
+    logger.info(
+        "%d requests, %d errors in %.3fs: %.0f requests/s.",
+        count,
+        errors,
+        elapsed,
+        count / max(elapsed, 1e-6),
+    )
+    logger.info(
+        "Latency: p50=%.3fms p90=%.3fms p99=%.3fms max=%.3fms.",
+        _percentile(latencies, 50) * 1000.0,
+        _percentile(latencies, 90) * 1000.0,
+        _percentile(latencies, 99) * 1000.0,
+        _percentile(latencies, 100) * 1000.0,
+    )
+    return os.EX_OK
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Embedded cluster client. Talks to the backends directly, without the proxy.
+"""
+
+import logging
+
+import rcluster.shard.cluster
+import rcluster.shard.exceptions
+import rcluster.shared
+
+
+class Client:
+    """
+    Cluster client with the same key placement, replication and failure
+    handling as rcluster-shard. Every backend is reached through the
+    thread-safe redis-py connection pool. Safe to use from any thread.
+    """
+
+    def __init__(
+        self,
+        seeds=(),
+        replicaness=None,
+        write_concern=None,
+        deadline=None,
+        fast_reads=False,
+        large_value_threshold=None,
+        handoff_capacity=65536,
+        handoff_directory=None,
+        topology_interval=5.0,
+        stats_interval=1.0,
+        backend_connections=2,
+        small_key_buckets=0,
+        small_key_size=64,
+        key_directory=0,
+    ):
+        self._logger = logging.getLogger("rcluster.client.Client")
+        self._cluster = rcluster.shard.cluster.Cluster(
+            handoff_capacity=handoff_capacity,
+            handoff_directory=handoff_directory,
+            topology_interval=topology_interval,
+            stats_interval=stats_interval,
+            backend_connections=backend_connections,
+            small_key_buckets=small_key_buckets,
+            small_key_size=small_key_size,
+            key_directory=key_directory,
+        )
+        if replicaness is not None:
+            self._cluster.replicaness = replicaness
+        self._cluster.write_concern = write_concern
+        self._cluster.deadline = deadline
+        self._cluster.fast_reads = fast_reads
+        self._cluster.large_value_threshold = large_value_threshold
+        # The seeds are connected before the first call.
+        for host, port_number, db in seeds:
+            try:
+                self._cluster.add_shard(host, port_number, db)
+            except rcluster.shard.exceptions.ShardConnectionError as ex:
+                self._logger.warning(
+                    "Could not connect to seed %s: %s",
+                    rcluster.shared.format_address((host, port_number, db)),
+                    ex,
+                )
+        self._cluster.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    @property
+    def cluster(self):
+        """
+        Gets the underlying cluster for the settings that are not exposed by
+        the client.
+        """
+
+        return self._cluster
+
+    def add_shard(self, host, port_number, db=0):
+        """
+        Adds the backend and publishes it to the other proxies and clients.
+        Returns the shard ID.
+        """
+
+        shard_id = self._cluster.add_shard(host, port_number, db)
+        self._cluster.topology.publish(added=[shard_id])
+        return shard_id
+
+    def remove_shard(self, shard_id):
+        """
+        Removes the backend and publishes the removal to the other proxies
+        and clients.
+        """
+
+        self._cluster.remove_shard(shard_id)
+        self._cluster.topology.publish(removed=[shard_id])
+
+    def get_shards(self):
+        return self._cluster.get_shards()
+
+    def get(self, key, timeout=None):
+        """
+        Gets the newest value of the key or None.
+        """
+
+        return self._cluster.get(key, timeout)
+
+    def set(self, key, data, write_concern=None, timeout=None, ttl=None):
+        """
+        Sets the key, expiring after the TTL in seconds if it is given.
+        Returns the number of the replicas that have acknowledged the write.
+        """
+
+        return self._cluster.set(key, data, write_concern, timeout, ttl)
+
+    def expire(self, key, ttl):
+        """
+        Sets the key to expire after the TTL in seconds. Returns whether the
+        key exists.
+        """
+
+        return self._cluster.expire(key, ttl)
+
+    def ttl(self, key):
+        """
+        Gets the time to live of the key in seconds: -1 if the key does not
+        expire, -2 if it does not exist.
+        """
+
+        return self._cluster.ttl(key)
+
+    def scan(self, cursor=0, match=None, count=None):
+        """
+        Incrementally iterates over the keys. Returns the next cursor and the
+        keys. Zero cursor starts and ends the iteration.
+        """
+
+        return self._cluster.scan(cursor, match, count)
+
+    def scan_iter(self, match=None, count=None):
+        """
+        Iterates over the keys of the cluster.
+        """
+
+        cursor = 0
+        while True:
+            cursor, keys = self.scan(cursor, match, count)
+            for key in keys:
+                yield key
+            if not cursor:
+                break
+
+    def close(self):
+        self._cluster.stop()
+
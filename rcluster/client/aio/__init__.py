@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+asyncio variant of the embedded cluster client. Requires Python 3.4+.
+"""
+
+import asyncio
+import concurrent.futures
+
+import rcluster.client
+
+
+class AsyncClient:
+    """
+    Wraps the blocking Client: every call runs on its own thread pool
+    through run_in_executor and returns an asyncio future, so the calls can
+    be awaited without blocking the event loop. The backends are still
+    reached with the blocking redis-py connections. Takes the same settings
+    as Client.
+    """
+
+    def __init__(self, loop=None, max_workers=16, **kwargs):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._client = rcluster.client.Client(**kwargs)
+        # The calls wait for the shard executor, so they cannot run on it.
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+        )
+
+    @property
+    def client(self):
+        return self._client
+
+    def add_shard(self, host, port_number, db=0):
+        return self._call(self._client.add_shard, host, port_number, db)
+
+    def get(self, key, timeout=None):
+        return self._call(self._client.get, key, timeout)
+
+    def set(self, key, data, write_concern=None, timeout=None, ttl=None):
+        return self._call(
+            self._client.set,
+            key,
+            data,
+            write_concern,
+            timeout,
+            ttl,
+        )
+
+    def expire(self, key, ttl):
+        return self._call(self._client.expire, key, ttl)
+
+    def ttl(self, key):
+        return self._call(self._client.ttl, key)
+
+    def scan(self, cursor=0, match=None, count=None):
+        return self._call(self._client.scan, cursor, match, count)
+
+    def close(self):
+        self._client.close()
+        self._executor.shutdown(wait=False)
+
+    def _call(self, function, *arguments):
+        return self._loop.run_in_executor(self._executor, function, *arguments)
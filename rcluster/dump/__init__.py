@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exports the cluster keys into a dump file and imports them back.
+"""
+
+import argparse
+import logging
+import os
+import struct
+import time
+import traceback
+
+import rcluster.shard.cluster
+import rcluster.shard.exceptions
+import rcluster.shared
+
+
+class DumpWriter:
+    """
+    Writes the key records into a dump file.
+    """
+
+    MAGIC = b"RCDUMP2\n"
+    # Timestamp, TTL in milliseconds (-1 if the key does not expire), key
+    # length, data length.
+    HEADER = struct.Struct(">QqII")
+    # The first version has no TTL.
+    V1_MAGIC = b"RCDUMP1\n"
+    V1_HEADER = struct.Struct(">QII")
+
+    def __init__(self, dump_file):
+        self._file = dump_file
+        self._file.write(DumpWriter.MAGIC)
+
+    def write(self, key, timestamp, data, ttl=None):
+        """
+        Writes the record. The TTL is in seconds, None if the key does not
+        expire.
+        """
+
+        self._file.write(
+            DumpWriter.HEADER.pack(
+                timestamp,
+                -1 if ttl is None else int(ttl * 1000),
+                len(key),
+                len(data),
+            ),
+        )
+        self._file.write(key)
+        self._file.write(data)
+
+
+class DumpReader:
+    """
+    Reads the (key, timestamp, data, TTL) records from a dump file. The TTL
+    is in seconds, None if the key does not expire.
+    """
+
+    def __init__(self, dump_file):
+        self._file = dump_file
+        magic = self._file.read(len(DumpWriter.MAGIC))
+        if magic == DumpWriter.MAGIC:
+            self._header = DumpWriter.HEADER
+        elif magic == DumpWriter.V1_MAGIC:
+            self._header = DumpWriter.V1_HEADER
+        else:
+            raise ValueError("Not an rcluster dump file.")
+
+    def __iter__(self):
+        header_size = self._header.size
+        while True:
+            header = self._file.read(header_size)
+            if not header:
+                break
+            if len(header) < header_size:
+                raise ValueError("Truncated dump file.")
+            if self._header is DumpWriter.HEADER:
+                timestamp, ttl, key_length, data_length = self._header.unpack(
+                    header,
+                )
+            else:
+                timestamp, key_length, data_length = self._header.unpack(
+                    header,
+                )
+                ttl = -1
+            key = self._file.read(key_length)
+            data = self._file.read(data_length)
+            if len(key) < key_length or len(data) < data_length:
+                raise ValueError("Truncated dump file.")
+            yield key, timestamp, data, None if ttl < 0 else ttl / 1000.0
+
+
+class _Progress:
+    """
+    Logs the throughput.
+    """
+
+    def __init__(self, logger, interval=1.0):
+        self._logger = logger
+        self._interval = interval
+        self._started_at = self._logged_at = time.time()
+        self.key_count = self.byte_count = 0
+
+    def update(self, key_count, byte_count):
+        self.key_count += key_count
+        self.byte_count += byte_count
+        if time.time() - self._logged_at >= self._interval:
+            self.log()
+
+    def log(self):
+        self._logged_at = time.time()
+        elapsed = max(self._logged_at - self._started_at, 1e-6)
+        self._logger.info(
+            "%d keys, %.1f MiB: %.0f keys/s, %.2f MiB/s.",
+            self.key_count,
+            self.byte_count / 1048576.0,
+            self.key_count / elapsed,
+            self.byte_count / 1048576.0 / elapsed,
+        )
+
+
+def export_keys(shard, dump_file, batch_size=1000):
+    """
+    Writes the newest version of every key with its remaining time to live
+    into the dump file.
+    """
+
+    logger = logging.getLogger("rcluster.dump.export_keys")
+    writer, progress = DumpWriter(dump_file), _Progress(logger)
+    cursor = 0
+    while True:
+        cursor, keys = shard.scan(cursor, count=batch_size)
+        if keys:
+            key_count = byte_count = 0
+            for key, (timestamp, data, ttl) in zip(
+                keys,
+                shard.get_versions(keys),
+            ):
+                # The key might be deleted since it was scanned.
+                if data is not None:
+                    writer.write(key, timestamp, data, ttl)
+                    key_count += 1
+                    byte_count += len(data)
+            progress.update(key_count, byte_count)
+        if not cursor:
+            break
+    progress.log()
+    return progress.key_count
+
+
+def import_keys(shard, dump_file, batch_size=1000):
+    """
+    Loads the keys from the dump file into the cluster.
+    """
+
+    logger = logging.getLogger("rcluster.dump.import_keys")
+    progress, batch, byte_count = _Progress(logger), list(), 0
+    for record in DumpReader(dump_file):
+        batch.append(record)
+        byte_count += len(record[2])
+        if len(batch) >= batch_size:
+            shard.load(batch)
+            progress.update(len(batch), byte_count)
+            batch, byte_count = list(), 0
+    if batch:
+        shard.load(batch)
+        progress.update(len(batch), byte_count)
+    progress.log()
+    return progress.key_count
+
+
+def _create_argument_parser(prog, description):
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog=prog,
+    )
+    parser.add_argument(
+        "--log-level",
+        dest="log_level",
+        type=str,
+        metavar="LEVEL",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "FATAL"],
+        default="INFO",
+        help="logging level (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--shard",
+        dest="addresses",
+        type=rcluster.shared.parse_address,
+        metavar="HOST:PORT[/DB]",
+        action="append",
+        required=True,
+        help="backend address, may be repeated",
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        metavar="COUNT",
+        default=1000,
+        help="number of keys per pipeline (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--small-key-buckets",
+        dest="small_key_buckets",
+        type=int,
+        metavar="COUNT",
+        default=0,
+        help="small value buckets of the cluster (default: none)",
+    )
+    parser.add_argument(
+        "--small-key-size",
+        dest="small_key_size",
+        type=int,
+        metavar="BYTES",
+        default=64,
+        help="largest key and value kept in a bucket (default: %(default)s)",
+    )
+    parser.add_argument(
+        "path",
+        type=str,
+        metavar="FILE",
+        help="dump file",
+    )
+    return parser
+
+
+def _run(args, run):
+    logging.basicConfig(
+        level=getattr(logging, args.log_level),
+        format="%(asctime)s [%(process)d] %(name)s %(levelname)s: %(message)s",
+    )
+    logger = logging.getLogger("rcluster.dump")
+
+    shard = rcluster.shard.cluster.Cluster(
+        small_key_buckets=args.small_key_buckets,
+        small_key_size=args.small_key_size,
+    )
+    try:
+        for host, port_number, db in args.addresses:
+            shard.add_shard(host, port_number, db)
+        run(shard)
+    except rcluster.shard.exceptions.ShardConnectionError as ex:
+        logger.fatal(str(ex))
+        return os.EX_UNAVAILABLE
+    except KeyboardInterrupt:
+        logger.info("Keyboard interrupt.")
+        return os.EX_SOFTWARE
+    except:
+        logger.fatal(traceback.format_exc())
+        return os.EX_SOFTWARE
+
+    return os.EX_OK
+
+
+def export_entry_point():
+    args = _create_argument_parser(
+        "rcluster-export",
+        "Exports the cluster keys into a dump file.",
+    ).parse_args()
+
+    def run(shard):
+        with open(args.path, "wb") as dump_file:
+            export_keys(shard, dump_file, args.batch_size)
+
+    return _run(args, run)
+
+
+def import_entry_point():
+    parser = _create_argument_parser(
+        "rcluster-import",
+        "Imports the keys from a dump file into the cluster.",
+    )
+    parser.add_argument(
+        "--replicaness",
+        dest="replicaness",
+        type=int,
+        metavar="REPLICANESS",
+        default=1,
+        help="number of replicas per key (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    def run(shard):
+        shard.replicaness = args.replicaness
+        with open(args.path, "rb") as dump_file:
+            import_keys(shard, dump_file, args.batch_size)
+
+    return _run(args, run)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+On-demand CPU and memory profiling of the running process.
+"""
+
+import cProfile
+import io
+import pstats
+
+try:
+    import tracemalloc
+except ImportError:
+    # tracemalloc is only available in Python 3.4+.
+    tracemalloc = None
+
+
+class Profiler:
+    """
+    Toggles cProfile and tracemalloc. Nothing is hooked into the process
+    while they are stopped.
+
+    cProfile only sees the thread that has started it, that is, the IO loop.
+    """
+
+    def __init__(self):
+        self._profile = None
+
+    @property
+    def cpu_active(self):
+        return self._profile is not None
+
+    @property
+    def memory_active(self):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def start_cpu(self):
+        if self._profile is not None:
+            raise RuntimeError("CPU profiling is already started.")
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop_cpu(self, count=20, path=None):
+        """
+        Stops CPU profiling. Returns the report of the top functions by the
+        cumulative time. The full statistics are dumped to the path if it is
+        given.
+        """
+
+        if self._profile is None:
+            raise RuntimeError("CPU profiling is not started.")
+        profile, self._profile = self._profile, None
+        profile.disable()
+        if path is not None:
+            profile.dump_stats(path)
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats(
+            "cumulative",
+        ).print_stats(count)
+        return stream.getvalue()
+
+    def start_memory(self, frames=1):
+        if tracemalloc is None:
+            raise RuntimeError("tracemalloc is not available.")
+        if tracemalloc.is_tracing():
+            raise RuntimeError("Memory tracing is already started.")
+        tracemalloc.start(frames)
+
+    def snapshot_memory(self, count=20, path=None):
+        """
+        Returns the report of the top allocation sites. The snapshot is
+        dumped to the path if it is given.
+        """
+
+        if not self.memory_active:
+            raise RuntimeError("Memory tracing is not started.")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        if path is not None:
+            snapshot.dump(path)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["Traced memory: current=%d peak=%d" % (current, peak)]
+        lines.extend(
+            str(statistic)
+            for statistic in snapshot.statistics("lineno")[:count]
+        )
+        return "\n".join(lines) + "\n"
+
+    def stop_memory(self):
+        if not self.memory_active:
+            raise RuntimeError("Memory tracing is not started.")
+        tracemalloc.stop()
+
+
+PROFILER = Profiler()
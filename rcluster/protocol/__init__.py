@@ -5,14 +5,16 @@
 Redis Protocol classes.
 """
 
+import importlib
 import itertools
 import logging
 import traceback
 
-import tornado.netutil
-
+import rcluster.capture
 import rcluster.protocol.exceptions
 import rcluster.protocol.replies
+import rcluster.profiling
+import rcluster.tracing
 
 
 class CommandHandler:
@@ -20,19 +22,23 @@ class CommandHandler:
     Base command handler.
     """
 
-    def __init__(self, handlers={}):
+    def __init__(self, handlers={}, tracer=None, capture=None):
         self._logger = logging.getLogger("rcluster.protocol.CommandHandler")
+        self._tracer = tracer
+        self._capture = capture
         self._handlers = {
             b"PING": self._on_ping,
             b"ECHO": self._on_echo,
             b"QUIT": self._on_quit,
             b"INFO": self._on_info,
+            b"TRACES": self._on_traces,
+            b"SETTRACERATE": self._on_set_trace_rate,
+            b"DEBUG": self._on_debug,
+            b"CAPTURE": self._on_capture,
         }
         self._handlers.update(handlers)
 
     def handle(self, command, arguments):
-        self._logger.debug("%s %s", command, repr(arguments))
-
         handler = self._handlers.get(command.upper())
 
         if handler:
@@ -51,6 +57,21 @@ class CommandHandler:
             },
         } if section is None or section == b"Server" else dict()
 
+    def _parse_options(self, arguments, names, usage):
+        """
+        Parses the optional "NAME value" argument pairs into a dictionary.
+        """
+
+        if len(arguments) % 2:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        options = dict()
+        for index in range(0, len(arguments), 2):
+            name = arguments[index].upper()
+            if name not in names:
+                raise rcluster.protocol.exceptions.CommandError(data=usage)
+            options[name] = arguments[index + 1]
+        return options
+
     def _serialize_info_section(self, section_name, section):
         """
         Serializes the info section into an iterable of byte strings.
@@ -63,7 +84,7 @@ class CommandHandler:
 
     def _on_ping(self, arguments):
         if not arguments:
-            return rcluster.protocol.replies.StatusReply(data=b"PONG")
+            return rcluster.protocol.replies.PONG_REPLY
         else:
             raise rcluster.protocol.exceptions.CommandError(
                 data=b"ERR Expected> PING",
@@ -90,6 +111,149 @@ class CommandHandler:
             )),
         ) + b"\r\n")
 
+    def _on_traces(self, arguments):
+        if len(arguments) > 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Expected> TRACES [count]",
+            )
+        if self._tracer is None:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Tracing is not available.",
+            )
+        try:
+            count = int(arguments[0]) if arguments else None
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        return rcluster.protocol.replies.MultiBulkReply(replies=[
+            rcluster.protocol.replies.BulkReply(data=trace.format())
+            for trace in self._tracer.get_traces(count)
+        ])
+
+    def _on_set_trace_rate(self, arguments):
+        if len(arguments) != 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Expected> SETTRACERATE rate",
+            )
+        if self._tracer is None:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Tracing is not available.",
+            )
+        try:
+            sample_rate = float(arguments[0])
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        if not 0.0 <= sample_rate <= 1.0:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Invalid trace rate value.",
+            )
+        self._tracer.sample_rate = sample_rate
+        return rcluster.protocol.replies.OK_REPLY
+
+    def _on_debug(self, arguments):
+        usage = (
+            b"ERR Expected> DEBUG PROFILE START|STOP [COUNT count]"
+            b" or DEBUG MEMORY START [FRAMES frames]|SNAPSHOT"
+            b" [COUNT count]|STOP"
+        )
+        if len(arguments) < 2:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        subcommand = (arguments[0].upper(), arguments[1].upper())
+        options = self._parse_options(
+            arguments[2:],
+            (b"COUNT", b"FRAMES"),
+            usage,
+        )
+        try:
+            count = int(options.get(b"COUNT", 20))
+            frames = int(options.get(b"FRAMES", 1))
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        if count < 1 or frames < 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Invalid count value.",
+            )
+
+        profiler = rcluster.profiling.PROFILER
+        try:
+            if subcommand == (b"PROFILE", b"START"):
+                profiler.start_cpu()
+                return rcluster.protocol.replies.OK_REPLY
+            elif subcommand == (b"PROFILE", b"STOP"):
+                report = profiler.stop_cpu(count)
+            elif subcommand == (b"MEMORY", b"START"):
+                profiler.start_memory(frames)
+                return rcluster.protocol.replies.OK_REPLY
+            elif subcommand == (b"MEMORY", b"SNAPSHOT"):
+                report = profiler.snapshot_memory(count)
+            elif subcommand == (b"MEMORY", b"STOP"):
+                profiler.stop_memory()
+                return rcluster.protocol.replies.OK_REPLY
+            else:
+                raise rcluster.protocol.exceptions.CommandError(data=usage)
+        except RuntimeError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        return rcluster.protocol.replies.BulkReply(
+            data=bytes(report, "utf-8"),
+        )
+
+    def _on_capture(self, arguments):
+        usage = (
+            b"ERR Expected> CAPTURE START name [RATE rate] [MAXSIZE bytes]"
+            b" or CAPTURE STOP"
+        )
+        if not arguments:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        if self._capture is None:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Capture is not available.",
+            )
+        action = arguments[0].upper()
+        if action == b"STOP" and len(arguments) == 1:
+            try:
+                recorded = self._capture.stop()
+            except RuntimeError as ex:
+                raise rcluster.protocol.exceptions.CommandError(
+                    data=b"ERR " + bytes(str(ex), "utf-8"),
+                )
+            return rcluster.protocol.replies.IntegerReply(value=recorded)
+        if action != b"START" or len(arguments) < 2:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        options = self._parse_options(
+            arguments[2:],
+            (b"RATE", b"MAXSIZE"),
+            usage,
+        )
+        try:
+            sample_rate = float(options.get(b"RATE", 1.0))
+            max_size = int(options.get(b"MAXSIZE", 64 * 1048576))
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        if not 0.0 < sample_rate <= 1.0 or max_size < 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Invalid rate or size value.",
+            )
+        try:
+            self._capture.start(
+                str(arguments[1], "utf-8"),
+                sample_rate,
+                max_size,
+            )
+        except (RuntimeError, ValueError, OSError) as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        return rcluster.protocol.replies.OK_REPLY
+
     def _on_quit(self, arguments):
         if not arguments:
             return rcluster.protocol.replies.StatusReply(
@@ -102,206 +266,112 @@ class CommandHandler:
             )
 
 
-class Server(tornado.netutil.TCPServer):
+class Server:
     """
-    Redis Protocol server.
+    Redis Protocol server. The engine is either the name of a built-in
+    engine or a factory that takes the server.
     """
 
+    TORNADO_ENGINE = "tornado"
+    ASYNCIO_ENGINE = "asyncio"
+    ENGINES = (TORNADO_ENGINE, ASYNCIO_ENGINE)
+
     def __init__(
         self,
         port_number=6381,
         command_handler_factory=CommandHandler,
+        tracer=None,
+        engine=TORNADO_ENGINE,
+        capture=None,
     ):
-        super(Server, self).__init__()
-
         self._logger = logging.getLogger("rcluster.protocol.Server")
         self._port_number = port_number
         self._command_handler_factory = command_handler_factory
+        self._tracer = (
+            tracer if tracer is not None else rcluster.tracing.Tracer()
+        )
+        self._capture = (
+            capture if capture is not None else rcluster.capture.Capture()
+        )
 
-    def start(self):
-        self.listen(self._port_number)
-
-    def handle_stream(self, stream, address):
-        self._logger.info("Accepted connection from %s.", address)
-        _StreamHandler(
-            stream,
-            address,
-            self._command_handler_factory(),
-        ).start()
-
+        if engine == Server.TORNADO_ENGINE:
+            # Tornado is only imported when it serves the clients.
+            stream = importlib.import_module("rcluster.protocol.stream")
+            self._engine = stream.TornadoEngine(self)
+        elif engine == Server.ASYNCIO_ENGINE:
+            # asyncio is only available in Python 3.4+.
+            aio = importlib.import_module("rcluster.protocol.aio")
+            self._engine = aio.AsyncioEngine(self)
+        elif callable(engine):
+            # Custom engine factory.
+            self._engine = engine(self)
+        else:
+            raise ValueError("Unknown engine: %s" % engine)
 
-class _StreamHandler:
-    """
-    Handles the client connection.
-    """
+    @property
+    def tracer(self):
+        return self._tracer
 
-    def __init__(self, stream, address, command_handler):
-        self._logger = logging.getLogger("rcluster.protocol._StreamHandler")
-        self._stream = stream
-        self._address = address
-        self._command_handler = command_handler
+    @property
+    def capture(self):
+        return self._capture
 
-        self._stream.set_close_callback(self._on_disconnected)
+    @property
+    def command_handler_factory(self):
+        return self._command_handler_factory
 
     def start(self):
-        """
-        Starts requests processing.
-        """
+        self._engine.listen(self._port_number)
 
-        self._serve_request()
-
-    def _serve_request(self):
+    def run(self):
         """
-        Serves the incoming request.
+        Runs the IO loop.
         """
 
-        _RequestHandler(
-            self._stream,
-            self._command_handler,
-            self._serve_request,
-        ).handle()
+        self._engine.run()
 
-    def _on_disconnected(self):
+    def stop(self):
         """
-        Called when client has disconnected.
+        Stops accepting the connections and the active capture.
         """
 
-        self._logger.info("Connection with %s is closed.", self._address)
-
-
-class _RequestHandler:
-    """
-    Handles a single incoming request.
-    """
+        self._engine.stop()
+        if self._capture.active:
+            self._capture.stop()
 
-    def __init__(self, stream, command_handler, callback):
-        self._logger = logging.getLogger("rcluster.protocol._RequestHandler")
-        self._stream = stream
-        self._command_handler = command_handler
-        self._callback = callback
-
-        self._arguments = list()
-
-    def handle(self):
-        self._stream.read_until(b"\r\n", callback=self._on_read_argument_count)
-
-    def _on_read_argument_count(self, data):
+    def add_callback(self, callback):
         """
-        Called when the line with the argument count is read.
+        Calls the callback on the IO loop. Safe to call from any thread.
         """
 
-        try:
-            if not data or data[0] != ord("*"):
-                raise ValueError()
-            self._argument_count = int(data[1:].rstrip())
-        except ValueError:
-            self._reply(
-                rcluster.protocol.replies.ErrorReply(
-                    data=b"ERR *<number of arguments> CR LF is expected.",
-                ),
-            )
-        else:
-            if self._argument_count > 0:
-                self._stream.read_until(b"\r\n", self._on_read_argument_length)
-            else:
-                # There is no request - just skip any processing.
-                self._callback()
+        self._engine.add_callback(callback)
 
-    def _on_read_argument_length(self, data):
+    def add_periodic_callback(self, callback, interval):
         """
-        Called when the line with the argument length is read.
+        Calls the callback on the IO loop every interval seconds.
         """
 
-        try:
-            if not data or data[0] != ord("$"):
-                raise ValueError()
-            argument_length = int(data[1:].rstrip())
-        except ValueError:
-            self._reply(
-                rcluster.protocol.replies.ErrorReply(
-                    data=(
-                        b"ERR $<number of bytes of argument>"
-                        b" CR LF is expected."
-                    ),
-                ),
-            )
-        else:
-            if argument_length > 0:
-                self._stream.read_bytes(
-                    argument_length,
-                    callback=self._on_read_argument_value,
-                )
-            elif argument_length == 0:
-                self._on_read_argument_value(bytes(0))
-            else:
-                # Negative argument length is treated as None value.
-                self._on_read_argument_value(None)
+        return self._engine.add_periodic_callback(callback, interval)
 
-    def _on_read_argument_value(self, data):
-        """
-        Called when the argument value is read.
-        """
-
-        self._arguments.append(data)
-        self._argument_count -= 1
-        self._stream.read_until(
-            b"\r\n",
-            callback=(
-                self._on_read_argument
-                if self._argument_count
-                else self._on_read_request
-            ),
-        )
 
-    def _on_read_argument(self, data):
-        """
-        Called when the argument value tail is read.
-        """
+def call_handler(command, get_reply, *arguments):
+    """
+    Gets the reply to the command and turns the exceptions into error
+    replies.
+    """
 
-        self._stream.read_until(
-            b"\r\n",
-            callback=self._on_read_argument_length,
+    try:
+        return get_reply(*arguments)
+    except rcluster.protocol.exceptions.CommandError as ex:
+        return rcluster.protocol.replies.ErrorReply(
+            data=ex.data,
         )
-
-    def _on_read_request(self, data):
-        """
-        Called when the entire request is read. The last argument tail
-        is dropped.
-        """
-
-        # The very first argument is a command.
-        command, *arguments = self._arguments
-
-        try:
-            reply = self._command_handler.handle(command, arguments)
-            if reply is None:
-                reply = rcluster.protocol.replies.NoneReply()
-        except rcluster.protocol.exceptions.CommandError as ex:
-            reply = rcluster.protocol.replies.ErrorReply(
-                data=ex.data,
-            )
-        except rcluster.protocol.exceptions.UnknownCommandError:
-            reply = rcluster.protocol.replies.ErrorReply(
-                data=b"ERR Unknown command: " + command,
-            )
-        except:
-            self._logger.error(traceback.format_exc())
-            reply = rcluster.protocol.replies.ErrorReply(
-                data=b"ERR Internal server error.",
-            )
-
-        self._logger.debug("%s", repr(reply))
-        self._reply(reply)
-
-    def _reply(self, reply):
-        data = rcluster.protocol.replies.ReplyEncoder.encode(reply)
-        self._logger.debug("%s", data)
-        if data is None:
-            raise ValueError("Invalid reply value.")
-        self._stream.write(
-            data,
-            callback=(
-                self._callback if not reply.quit
-                else self._stream.close
-            ),
+    except rcluster.protocol.exceptions.UnknownCommandError:
+        return rcluster.protocol.replies.ErrorReply(
+            data=b"ERR Unknown command: " + command,
+        )
+    except:
+        logging.getLogger("rcluster.protocol").error(traceback.format_exc())
+        return rcluster.protocol.replies.ErrorReply(
+            data=b"ERR Internal server error.",
         )
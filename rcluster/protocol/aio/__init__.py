@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+asyncio-based Redis Protocol server engine. Requires Python 3.4+.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+
+import rcluster.protocol
+import rcluster.protocol.replies
+import rcluster.tracing
+
+
+class AsyncioEngine:
+    """
+    Serves the clients with asyncio protocols.
+    """
+
+    def __init__(self, server):
+        self._logger = logging.getLogger("rcluster.protocol.aio.AsyncioEngine")
+        self._server = server
+        self._listener = None
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def listen(self, port_number):
+        self._listener = self._loop.run_until_complete(
+            self._loop.create_server(
+                lambda: RedisProtocol(
+                    self._loop,
+                    self._server.command_handler_factory(),
+                    self._server.tracer,
+                    self._server.capture,
+                ),
+                port=port_number,
+            ),
+        )
+
+    def run(self):
+        self._loop.run_forever()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def add_callback(self, callback):
+        self._loop.call_soon_threadsafe(callback)
+
+    def add_periodic_callback(self, callback, interval):
+        periodic_callback = _PeriodicCallback(self._loop, callback, interval)
+        periodic_callback.start()
+        return periodic_callback
+
+
+class RedisProtocol(asyncio.Protocol):
+    """
+    Handles the client connection. Parses every request available in the
+    receive buffer and writes all the ready replies at once.
+
+    Reading is paused while the transport buffer is full or too many
+    replies are pending, so a slow client cannot make the server buffer
+    an unbounded number of requests.
+    """
+
+    MAX_PENDING_REPLIES = 1024
+
+    def __init__(self, loop, command_handler, tracer, capture):
+        self._logger = logging.getLogger("rcluster.protocol.aio.RedisProtocol")
+        self._loop = loop
+        self._command_handler = command_handler
+        self._tracer = tracer
+        self._capture = capture
+        self._transport = None
+        self._buffer = bytearray()
+        # Replies (or their futures) in the request order, with the requests
+        # and the traces.
+        self._replies = collections.deque()
+        self._closing = False
+        self._writing_paused = False
+        self._reading_paused = False
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._logger.info(
+            "Accepted connection from %s.",
+            transport.get_extra_info("peername"),
+        )
+
+    def connection_lost(self, exc):
+        self._closing = True
+        self._transport = None
+        self._logger.info("Connection is closed.")
+
+    def pause_writing(self):
+        self._writing_paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._update_reading()
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        position = 0
+        while not self._closing:
+            trace = self._tracer.start()
+            try:
+                request, position = _parse_request(self._buffer, position)
+            except ValueError as ex:
+                self._replies.append((
+                    None,
+                    rcluster.protocol.replies.ErrorReply(
+                        data=bytes("ERR %s" % ex, "utf-8"),
+                    ),
+                    trace,
+                ))
+                self._closing = True
+                break
+            if request is None:
+                break
+            if request:
+                self._dispatch(request, trace)
+        # Drop the parsed requests at once.
+        del self._buffer[:position]
+        self._flush()
+
+    def _dispatch(self, request, trace):
+        command, *arguments = request
+        if self._capture.active:
+            self._capture.record(command, arguments)
+        trace.describe(command, arguments)
+        trace.mark("parse")
+
+        self._tracer.active = trace
+        try:
+            reply = rcluster.protocol.call_handler(
+                command,
+                self._command_handler.handle,
+                command,
+                arguments,
+            )
+        finally:
+            self._tracer.active = rcluster.tracing.NULL_TRACE
+
+        if isinstance(reply, concurrent.futures.Future):
+            # The command is being executed asynchronously.
+            reply.add_done_callback(
+                lambda future: self._loop.call_soon_threadsafe(self._flush),
+            )
+        else:
+            trace.mark("dispatch")
+        self._replies.append((command, reply, trace))
+
+    def _flush(self):
+        """
+        Writes the ready replies keeping the request order.
+        """
+
+        chunks, traces, quit = list(), list(), False
+        while self._replies and not quit:
+            command, reply, trace = self._replies[0]
+            if isinstance(reply, concurrent.futures.Future):
+                if not reply.done():
+                    break
+                reply = rcluster.protocol.call_handler(command, reply.result)
+                trace.mark("dispatch")
+            self._replies.popleft()
+            if reply is None:
+                reply = rcluster.protocol.replies.NONE_REPLY
+            data = rcluster.protocol.replies.ReplyEncoder.encode(reply)
+            if data is None:
+                self._logger.error("Invalid reply value: %r.", reply)
+                reply = rcluster.protocol.replies.ErrorReply(
+                    data=b"ERR Invalid reply value.",
+                    quit=False,
+                )
+                data = rcluster.protocol.replies.ReplyEncoder.encode(reply)
+            trace.mark("encode", len(data))
+            chunks.append(data)
+            traces.append(trace)
+            quit = reply.quit
+
+        if chunks and self._transport is not None:
+            self._transport.writelines(chunks)
+        for trace in traces:
+            trace.mark("write")
+            self._tracer.finish(trace)
+        if quit or (self._closing and not self._replies):
+            self._closing = True
+            self._replies.clear()
+            if self._transport is not None:
+                self._transport.close()
+        else:
+            self._update_reading()
+
+    def _update_reading(self):
+        """
+        Pauses reading the requests while the replies cannot be written, and
+        resumes it once they can.
+        """
+
+        if self._transport is None or self._closing:
+            return
+        paused = (
+            self._writing_paused or
+            len(self._replies) >= RedisProtocol.MAX_PENDING_REPLIES
+        )
+        if paused and not self._reading_paused:
+            self._transport.pause_reading()
+        elif not paused and self._reading_paused:
+            self._transport.resume_reading()
+        self._reading_paused = paused
+
+
+def _parse_request(buffer, position):
+    """
+    Parses the request that starts at the position. Returns the arguments
+    and the position of the next request, or None if the request is not
+    received completely.
+    """
+
+    start = position
+    end = buffer.find(b"\r\n", position)
+    if end == -1:
+        return None, start
+    if buffer[position] != ord("*"):
+        raise ValueError("*<number of arguments> CR LF is expected.")
+    argument_count = int(buffer[position + 1:end])
+    position = end + 2
+
+    arguments = list()
+    for _ in range(argument_count):
+        end = buffer.find(b"\r\n", position)
+        if end == -1:
+            return None, start
+        if buffer[position] != ord("$"):
+            raise ValueError(
+                "$<number of bytes of argument> CR LF is expected.",
+            )
+        argument_length = int(buffer[position + 1:end])
+        position = end + 2
+        if argument_length < 0:
+            # Negative argument length is treated as None value.
+            arguments.append(None)
+            continue
+        if len(buffer) < position + argument_length + 2:
+            return None, start
+        arguments.append(bytes(buffer[position:position + argument_length]))
+        position += argument_length + 2
+
+    return arguments, position
+
+
+class _PeriodicCallback:
+    def __init__(self, loop, callback, interval):
+        self._loop = loop
+        self._callback = callback
+        self._interval = interval
+        self._handle = None
+
+    def start(self):
+        self._handle = self._loop.call_later(self._interval, self._run)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _run(self):
+        try:
+            self._callback()
+        finally:
+            if self._handle is not None:
+                self.start()
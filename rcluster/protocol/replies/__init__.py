@@ -7,6 +7,8 @@ Defines classes for Redis Protocol replies.
 
 
 class _Reply:
+    __slots__ = ("quit", )
+
     STATUS_REPLY = 0
     ERROR_REPLY = 1
     INTEGER_REPLY = 2
@@ -14,6 +16,9 @@ class _Reply:
     MULTI_BULK_REPLY = 4
     NONE_REPLY = 5
 
+    # Cached wire bytes. Only constant replies have them.
+    encoded = None
+
     def __init__(self, quit=False):
         self.quit = quit
 
@@ -22,6 +27,8 @@ class _Reply:
 
 
 class _DataReply(_Reply):
+    __slots__ = ("data", )
+
     def __init__(self, data, quit=False):
         super(_DataReply, self).__init__(quit=quit)
         self.data = data
@@ -35,6 +42,8 @@ class _DataReply(_Reply):
 
 
 class StatusReply(_DataReply):
+    __slots__ = ()
+
     reply_type = _Reply.STATUS_REPLY
 
     def __init__(self, data, quit=False):
@@ -42,6 +51,8 @@ class StatusReply(_DataReply):
 
 
 class ErrorReply(_DataReply):
+    __slots__ = ()
+
     reply_type = _Reply.ERROR_REPLY
 
     def __init__(self, data, quit=True):
@@ -49,6 +60,8 @@ class ErrorReply(_DataReply):
 
 
 class IntegerReply(_Reply):
+    __slots__ = ("value", )
+
     reply_type = _Reply.INTEGER_REPLY
 
     def __init__(self, value=0, quit=False):
@@ -60,6 +73,8 @@ class IntegerReply(_Reply):
 
 
 class BulkReply(_DataReply):
+    __slots__ = ()
+
     reply_type = _Reply.BULK_REPLY
 
     def __init__(self, data, quit=False):
@@ -67,6 +82,8 @@ class BulkReply(_DataReply):
 
 
 class MultiBulkReply(_Reply):
+    __slots__ = ("replies", )
+
     reply_type = _Reply.MULTI_BULK_REPLY
 
     def __init__(self, replies=[], quit=False):
@@ -81,6 +98,8 @@ class MultiBulkReply(_Reply):
 
 
 class NoneReply(_Reply):
+    __slots__ = ()
+
     reply_type = _Reply.NONE_REPLY
 
     def __init__(self, quit=False):
@@ -94,18 +113,13 @@ class ReplyEncoder:
 
     @classmethod
     def encode(cls, reply):
-        if reply is None or reply.reply_type == _Reply.NONE_REPLY:
-            return b"$-1\r\n"
-        elif reply.reply_type == _Reply.STATUS_REPLY:
-            return cls._encode_status(reply)
-        elif reply.reply_type == _Reply.ERROR_REPLY:
-            return cls._encode_error(reply)
-        elif reply.reply_type == _Reply.INTEGER_REPLY:
-            return cls._encode_integer(reply)
-        elif reply.reply_type == _Reply.BULK_REPLY:
-            return cls._encode_bulk(reply)
-        elif reply.reply_type == _Reply.MULTI_BULK_REPLY:
-            return cls._encode_multi_bulk(reply)
+        if reply is None:
+            return NONE_REPLY.encoded
+        encoded = reply.encoded
+        if encoded is not None:
+            return encoded
+        encode = cls._encoders.get(reply.reply_type)
+        return encode(reply) if encode is not None else None
 
     @classmethod
     def _encode_status(cls, status_reply):
@@ -121,10 +135,10 @@ class ReplyEncoder:
 
     @classmethod
     def _encode_bulk(cls, bulk_reply):
-        return (
-            b"$" + bytes(str(len(bulk_reply.data)), "ascii") + b"\r\n" +
-            bulk_reply.data + b"\r\n"
-        )
+        return b"".join((
+            b"$", bytes(str(len(bulk_reply.data)), "ascii"), b"\r\n",
+            bulk_reply.data, b"\r\n",
+        ))
 
     @classmethod
     def _encode_multi_bulk(cls, multi_bulk_reply):
@@ -132,7 +146,59 @@ class ReplyEncoder:
             b"*" + bytes(str(len(multi_bulk_reply.replies)), "ascii") +
             b"\r\n" +
             b"".join(
-                cls._encode_bulk(bulk_reply)
-                for bulk_reply in multi_bulk_reply.replies
+                cls.encode(reply)
+                for reply in multi_bulk_reply.replies
             )
         )
+
+    @classmethod
+    def _encode_none(cls, none_reply):
+        return b"$-1\r\n"
+
+
+ReplyEncoder._encoders = {
+    _Reply.STATUS_REPLY: ReplyEncoder._encode_status,
+    _Reply.ERROR_REPLY: ReplyEncoder._encode_error,
+    _Reply.INTEGER_REPLY: ReplyEncoder._encode_integer,
+    _Reply.BULK_REPLY: ReplyEncoder._encode_bulk,
+    _Reply.MULTI_BULK_REPLY: ReplyEncoder._encode_multi_bulk,
+    _Reply.NONE_REPLY: ReplyEncoder._encode_none,
+}
+
+
+class _ConstantReply:
+    """
+    Immutable shared reply. Its wire bytes are encoded once.
+    """
+
+    __slots__ = ("reply_type", "data", "quit", "encoded")
+
+    def __init__(self, reply):
+        setattr_ = super(_ConstantReply, self).__setattr__
+        setattr_("reply_type", reply.reply_type)
+        setattr_("data", getattr(reply, "data", None))
+        setattr_("quit", reply.quit)
+        setattr_("encoded", ReplyEncoder.encode(reply))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Constant reply is immutable.")
+
+    def __repr__(self):
+        return "_ConstantReply(encoded=%s, quit=%s)" % (
+            self.encoded,
+            self.quit,
+        )
+
+
+def constant(reply):
+    """
+    Makes the shared immutable copy of the reply.
+    """
+
+    return _ConstantReply(reply)
+
+
+# Constant replies.
+OK_REPLY = constant(StatusReply(data=b"OK"))
+PONG_REPLY = constant(StatusReply(data=b"PONG"))
+NONE_REPLY = constant(NoneReply())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tornado engine: serves the clients with Tornado IO streams.
+"""
+
+import concurrent.futures
+import logging
+
+import tornado.ioloop
+import tornado.netutil
+
+import rcluster.protocol
+import rcluster.protocol.replies
+import rcluster.tracing
+
+
+class TornadoEngine(tornado.netutil.TCPServer):
+    """
+    Serves the clients with Tornado IO streams.
+    """
+
+    def __init__(self, server):
+        super(TornadoEngine, self).__init__()
+
+        self._logger = logging.getLogger(
+            "rcluster.protocol.stream.TornadoEngine",
+        )
+        self._server = server
+
+    def run(self):
+        tornado.ioloop.IOLoop.instance().start()
+
+    def add_callback(self, callback):
+        tornado.ioloop.IOLoop.instance().add_callback(callback)
+
+    def add_periodic_callback(self, callback, interval):
+        periodic_callback = tornado.ioloop.PeriodicCallback(
+            callback,
+            interval * 1000.0,
+        )
+        periodic_callback.start()
+        return periodic_callback
+
+    def handle_stream(self, stream, address):
+        self._logger.info("Accepted connection from %s.", address)
+        _StreamHandler(
+            stream,
+            address,
+            self._server.command_handler_factory(),
+            self._server.tracer,
+            self._server.capture,
+        ).start()
+
+
+class _StreamHandler:
+    """
+    Handles the client connection.
+    """
+
+    def __init__(self, stream, address, command_handler, tracer, capture):
+        self._logger = logging.getLogger(
+            "rcluster.protocol.stream._StreamHandler",
+        )
+        self._stream = stream
+        self._address = address
+        self._command_handler = command_handler
+        self._tracer = tracer
+        self._capture = capture
+
+        self._stream.set_close_callback(self._on_disconnected)
+
+    def start(self):
+        """
+        Starts requests processing.
+        """
+
+        self._serve_request()
+
+    def _serve_request(self):
+        """
+        Serves the incoming request.
+        """
+
+        _RequestHandler(
+            self._stream,
+            self._command_handler,
+            self._tracer,
+            self._capture,
+            self._serve_request,
+        ).handle()
+
+    def _on_disconnected(self):
+        """
+        Called when client has disconnected.
+        """
+
+        self._logger.info("Connection with %s is closed.", self._address)
+
+
+class _RequestHandler:
+    """
+    Handles a single incoming request.
+    """
+
+    def __init__(self, stream, command_handler, tracer, capture, callback):
+        self._logger = logging.getLogger(
+            "rcluster.protocol.stream._RequestHandler",
+        )
+        self._stream = stream
+        self._command_handler = command_handler
+        self._tracer = tracer
+        self._capture = capture
+        self._callback = callback
+
+        self._arguments = list()
+        self._trace = rcluster.tracing.NULL_TRACE
+
+    def handle(self):
+        self._stream.read_until(b"\r\n", callback=self._on_read_argument_count)
+
+    def _on_read_argument_count(self, data):
+        """
+        Called when the line with the argument count is read.
+        """
+
+        # The request starts with its first line.
+        self._trace = self._tracer.start()
+
+        try:
+            if not data or data[0] != ord("*"):
+                raise ValueError()
+            self._argument_count = int(data[1:].rstrip())
+        except ValueError:
+            self._reply(
+                rcluster.protocol.replies.ErrorReply(
+                    data=b"ERR *<number of arguments> CR LF is expected.",
+                ),
+            )
+        else:
+            if self._argument_count > 0:
+                self._stream.read_until(b"\r\n", self._on_read_argument_length)
+            else:
+                # There is no request - just skip any processing.
+                self._callback()
+
+    def _on_read_argument_length(self, data):
+        """
+        Called when the line with the argument length is read.
+        """
+
+        try:
+            if not data or data[0] != ord("$"):
+                raise ValueError()
+            argument_length = int(data[1:].rstrip())
+        except ValueError:
+            self._reply(
+                rcluster.protocol.replies.ErrorReply(
+                    data=(
+                        b"ERR $<number of bytes of argument>"
+                        b" CR LF is expected."
+                    ),
+                ),
+            )
+        else:
+            if argument_length > 0:
+                self._stream.read_bytes(
+                    argument_length,
+                    callback=self._on_read_argument_value,
+                )
+            elif argument_length == 0:
+                self._on_read_argument_value(bytes(0))
+            else:
+                # Negative argument length is treated as None value.
+                self._on_read_argument_value(None)
+
+    def _on_read_argument_value(self, data):
+        """
+        Called when the argument value is read.
+        """
+
+        self._arguments.append(data)
+        self._argument_count -= 1
+        self._stream.read_until(
+            b"\r\n",
+            callback=(
+                self._on_read_argument
+                if self._argument_count
+                else self._on_read_request
+            ),
+        )
+
+    def _on_read_argument(self, data):
+        """
+        Called when the argument value tail is read.
+        """
+
+        self._stream.read_until(
+            b"\r\n",
+            callback=self._on_read_argument_length,
+        )
+
+    def _on_read_request(self, data):
+        """
+        Called when the entire request is read. The last argument tail
+        is dropped.
+        """
+
+        # The very first argument is a command.
+        command, *arguments = self._arguments
+        if self._capture.active:
+            self._capture.record(command, arguments)
+
+        trace = self._trace
+        trace.describe(command, arguments)
+        trace.mark("parse")
+
+        self._tracer.active = trace
+        try:
+            reply = rcluster.protocol.call_handler(
+                command,
+                self._command_handler.handle,
+                command,
+                arguments,
+            )
+        finally:
+            self._tracer.active = rcluster.tracing.NULL_TRACE
+
+        if isinstance(reply, concurrent.futures.Future):
+            # The command is being executed asynchronously.
+            reply.add_done_callback(self._on_reply_future_done)
+        else:
+            self._on_reply(reply)
+
+    def _on_reply_future_done(self, future):
+        """
+        Called when the asynchronous command is executed. May be called from
+        any thread.
+        """
+
+        tornado.ioloop.IOLoop.instance().add_callback(
+            lambda: self._on_reply(
+                rcluster.protocol.call_handler(
+                    self._arguments[0],
+                    future.result,
+                ),
+            ),
+        )
+
+    def _on_reply(self, reply):
+        """
+        Called when the reply is ready.
+        """
+
+        if reply is None:
+            reply = rcluster.protocol.replies.NONE_REPLY
+        self._trace.mark("dispatch")
+        self._reply(reply)
+
+    def _reply(self, reply):
+        data = rcluster.protocol.replies.ReplyEncoder.encode(reply)
+        if data is None:
+            raise ValueError("Invalid reply value.")
+        self._trace.mark("encode", len(data))
+        self._stream.write(
+            data,
+            callback=(
+                self._on_written if not reply.quit
+                else self._stream.close
+            ),
+        )
+
+    def _on_written(self):
+        """
+        Called when the reply is written to the stream.
+        """
+
+        self._trace.mark("write")
+        self._tracer.finish(self._trace)
+        self._callback()
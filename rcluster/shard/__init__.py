@@ -7,193 +7,87 @@ Redis Cluster Shard.
 
 import argparse
 import logging
-import operator
 import os
-import time
 import traceback
-import uuid
-
-import redis
-import redis.exceptions
-import tornado.ioloop
 
+import rcluster.capture
 import rcluster.protocol
 import rcluster.protocol.exceptions
 import rcluster.protocol.replies
 import rcluster.shard.exceptions
 import rcluster.shared
-
-
-class Shard(rcluster.protocol.Server):
-    SHARD_ID_KEY = "rcluster:shard:id"
-
-    def __init__(self, port_number):
-        super(Shard, self).__init__(
+import rcluster.tracing
+
+# The package attribute is only set once this module is imported.
+from rcluster.shard.cluster import Cluster
+
+
+class Shard(Cluster):
+    """
+    Serves the cluster to the Redis clients.
+    """
+
+    def __init__(
+        self,
+        port_number,
+        tracer=None,
+        handoff_capacity=65536,
+        handoff_directory=None,
+        seeds=(),
+        topology_interval=5.0,
+        stats_interval=1.0,
+        engine=rcluster.protocol.Server.TORNADO_ENGINE,
+        backend_connections=2,
+        small_key_buckets=0,
+        small_key_size=64,
+        key_directory=0,
+        capture=None,
+    ):
+        self._server = rcluster.protocol.Server(
             port_number=port_number,
             command_handler_factory=self._create_handler,
+            tracer=tracer,
+            engine=engine,
+            capture=capture,
+        )
+        # The callbacks run on the IO loop of the server.
+        super(Shard, self).__init__(
+            tracer=self._server.tracer,
+            handoff_capacity=handoff_capacity,
+            handoff_directory=handoff_directory,
+            seeds=seeds,
+            topology_interval=topology_interval,
+            stats_interval=stats_interval,
+            backend_connections=backend_connections,
+            small_key_buckets=small_key_buckets,
+            small_key_size=small_key_size,
+            key_directory=key_directory,
+            scheduler=self._server,
         )
-
         self._logger = logging.getLogger("rcluster.shard.Shard")
-        self._replicaness = 1
-        self._connections = dict()
-        self._db_size = dict()
 
     @property
-    def replicaness(self):
-        return self._replicaness
-
-    @replicaness.setter
-    def replicaness(self, replicaness):
-        self._replicaness = replicaness
-
-    def add_shard(self, host, port_number, db):
-        self._logger.info(
-            "Adding shard: %s:%s/%d ...",
-            host,
-            port_number,
-            db,
-        )
-        connection = redis.StrictRedis(
-            host=host,
-            port=port_number,
-            db=db,
-        )
-        shard_id = uuid.uuid4().hex
-        try:
-            if not connection.setnx(Shard.SHARD_ID_KEY, shard_id):
-                shard_id = connection.get(Shard.SHARD_ID_KEY)
-            db_size = connection.dbsize()
-        except redis.exceptions.ConnectionError as ex:
-            raise rcluster.shard.exceptions.ShardConnectionError(
-                "Could not connect to the specified shard.",
-            ) from ex
-        else:
-            self._connections[shard_id] = connection
-            self._db_size[shard_id] = db_size
-            self._logger.info(
-                "Shard %s is added (db_size: %s).",
-                shard_id,
-                db_size,
-            )
-            return shard_id
-
-    def remove_shard(self, shard_id):
-        try:
-            del self._connections[shard_id]
-        except KeyError:
-            pass
-
-    def is_shard_alive(self, shard_id):
-        """
-        Checks whether the connection to the specified shard is alive.
-        """
-
-        connection = self._connections.get(shard_id)
-        if connection is None:
-            return False
-        try:
-            connection.ping()
-        except redis.exceptions.ConnectionError:
-            return False
-        else:
-            return True
-
-    def get(self, key):
-        latest_timestamp, latest_data = 0, None
-
-        for shard_id, connection in self._connections.items():
-            try:
-                with connection.pipeline(transaction=True) as pipeline:
-                    data_key, timestamp_key = self._wrap_key(key)
-                    pipeline.get(data_key).get(timestamp_key).dbsize()
-                    data, timestamp, db_size = pipeline.execute()
-            except redis.exceptions.ConnectionError:
-                # Failed to get the value from this shard. It is failed -
-                # just ignore it.
-                pass
-            else:
-                # Timestamp might not be set for the first time.
-                timestamp = (timestamp and int(timestamp)) or 0
-                if not latest_timestamp or latest_timestamp < timestamp:
-                    latest_data, latest_timestamp = data, timestamp
-                # Update DBSIZE.
-                self._db_size[shard_id] = db_size
+    def capture(self):
+        return self._server.capture
 
-        return latest_data
-
-    def set(self, key, data):
-        """
-        Sets the specified key.
-        """
-
-        # Wrap key name.
-        data_key, timestamp_key = self._wrap_key(key)
-        # Find available shards from the least busy.
-        shards = (
-            (shard_id, self._connections[shard_id], db_size)
-            # Sort by db_size increasing.
-            for shard_id, db_size in sorted(
-                self._db_size.items(),
-                key=operator.itemgetter(1),
-            )
-            # Check that the connection is still available.
-            if shard_id in self._connections
-        )
-
-        while True:
-            # Replicas counter - we need self._replicaness keys set
-            # with this timestamp.
-            timestamp, replicas_left = self._timestamp(), self._replicaness
-            try:
-                for shard_id, connection, db_size in shards:
-                    try:
-                        with connection.pipeline(transaction=True) as pipeline:
-                            pipeline.watch(data_key)
-                            pipeline.watch(timestamp_key)
-                            pipeline.multi()
-
-                            # Delete old data.
-                            pipeline.delete(data_key)
-                            pipeline.delete(timestamp_key)
-
-                            # Determine whether we also need to set the key.
-                            set_key = replicas_left != 0
-                            if set_key:
-                                pipeline.set(data_key, data)
-                                pipeline.set(timestamp_key, timestamp)
-
-                            # Anyway, update cached DBSIZE value.
-                            pipeline.dbsize()
-
-                            # DBSIZE is the last item.
-                            self._db_size[shard_id] = pipeline.execute()[-1]
-                    except redis.exceptions.ConnectionError as ex:
-                        self._logger.debug(str(ex))
-                        # Skip failed target.
-                    else:
-                        if set_key:
-                            # We set the replica.
-                            replicas_left -= 1
-            except redis.exceptions.WatchError:
-                # Other rcluster.shard has modified the key - retry.
-                continue
-            else:
-                # All transactions has succeeded.
-                break
+    @property
+    def command_handler_factory(self):
+        return self._server.command_handler_factory
 
-        # Success if the key is set at least once.
-        return replicas_left != self._replicaness
+    def start(self):
+        self._server.start()
+        super(Shard, self).start()
 
-    def _wrap_key(self, key):
-        rc_key = b"rc:" + bytes(key, "utf-8")
-        return rc_key, rc_key + b":ts"
+    def run(self):
+        self._server.run()
 
-    def _timestamp(self):
+    def stop(self):
         """
-        Gets the current timestamp.
+        Stops serving and following the topology.
         """
 
-        return int(time.time() * 1000000)
+        self._server.stop()
+        super(Shard, self).stop()
 
     def _create_handler(self):
         return _ShardCommandHandler(self)
@@ -203,10 +97,19 @@ class _ShardCommandHandler(rcluster.protocol.CommandHandler):
     def __init__(self, shard):
         super(_ShardCommandHandler, self).__init__({
             b"ADDSHARD": self._on_add_shard,
+            b"REMOVESHARD": self._on_remove_shard,
+            b"SHARDS": self._on_shards,
             b"GET": self._on_get,
             b"SET": self._on_set,
+            b"SETEX": self._on_set_ex,
+            b"EXPIRE": self._on_expire,
+            b"TTL": self._on_ttl,
+            b"SCAN": self._on_scan,
+            b"HOTKEYS": self._on_hot_keys,
             b"SETREPLICANESS": self._on_set_replicaness,
-        })
+            b"SETWRITECONCERN": self._on_set_write_concern,
+            b"SETDEADLINE": self._on_set_deadline,
+        }, tracer=shard.tracer, capture=shard.capture)
 
         self._logger = logging.getLogger("rcluster.shard._ShardCommandHandler")
         self._shard = shard
@@ -230,70 +133,460 @@ class _ShardCommandHandler(rcluster.protocol.CommandHandler):
                 str(self._shard.replicaness),
                 "ascii",
             )
+            write_concern = self._shard.write_concern
             info.update({
                 b"Cluster": {
                     b"replicaness": replicaness_value,
+                    b"write_concern": (
+                        b"all" if write_concern is None
+                        else bytes(str(write_concern), "ascii")
+                    ),
+                    b"background_failures": bytes(
+                        str(self._shard.background_failures),
+                        "ascii",
+                    ),
+                    b"deadline": (
+                        b"none" if self._shard.deadline is None
+                        else bytes(
+                            "%dms" % round(self._shard.deadline * 1000.0),
+                            "ascii",
+                        )
+                    ),
+                    b"timeouts": bytes(str(self._shard.timeouts), "ascii"),
+                    b"large_value_threshold": (
+                        b"none" if self._shard.large_value_threshold is None
+                        else bytes(
+                            str(self._shard.large_value_threshold),
+                            "ascii",
+                        )
+                    ),
+                    b"two_phase_reads": bytes(
+                        str(self._shard.two_phase_reads),
+                        "ascii",
+                    ),
+                    b"small_key_buckets": (
+                        b"none" if self._shard.buckets is None
+                        else bytes(
+                            "%d,max_size=%d" % (
+                                self._shard.buckets.bucket_count,
+                                self._shard.buckets.max_entry_size,
+                            ),
+                            "ascii",
+                        )
+                    ),
                 }
             })
+        if section is None or section == b"HotKeys":
+            threshold = self._shard.hot_key_threshold
+            info.update({
+                b"HotKeys": {
+                    b"threshold": (
+                        b"none" if threshold is None
+                        else bytes(str(threshold), "ascii")
+                    ),
+                    b"extra_replicas": bytes(
+                        str(self._shard.hot_key_replicas),
+                        "ascii",
+                    ),
+                    b"replicated": bytes(
+                        str(len(self._shard.replicated_hot_keys)),
+                        "ascii",
+                    ),
+                },
+            })
+        if section is None or section == b"Handoff":
+            info.update({
+                b"Handoff": dict(
+                    (shard_id, bytes(
+                        "pending=%d,dropped=%d" % (len(hints), hints.dropped),
+                        "ascii",
+                    ))
+                    for shard_id, hints in self._shard.hints.items()
+                ),
+            })
+        if section is None or section == b"Load":
+            info.update({
+                b"Load": dict(
+                    (shard_id, self._shard.load_index.get(shard_id).format())
+                    for shard_id in self._shard.load_index
+                ),
+            })
+        if section is None or section == b"Multiplex":
+            info.update({
+                b"Multiplex": dict(
+                    (shard_id, bytes(
+                        "connections=%d,requests=%d,batches=%d" % (
+                            multiplexer.connection_count,
+                            multiplexer.requests,
+                            multiplexer.batches,
+                        ),
+                        "ascii",
+                    ))
+                    for shard_id, multiplexer in
+                    self._shard.multiplexers.items()
+                ),
+            })
+        if section is None or section == b"Directory":
+            directory = self._shard.directory
+            info.update({
+                b"Directory": {
+                    b"capacity": bytes(
+                        str(0 if directory is None else directory.capacity),
+                        "ascii",
+                    ),
+                    b"keys": bytes(
+                        str(0 if directory is None else len(directory)),
+                        "ascii",
+                    ),
+                    b"hits": bytes(str(self._shard.directory_hits), "ascii"),
+                    b"misses": bytes(
+                        str(self._shard.directory_misses),
+                        "ascii",
+                    ),
+                },
+            })
+        if section is None or section == b"Backends":
+            info.update({
+                b"Backends": dict(
+                    (shard_id, score.format())
+                    for shard_id, score in self._shard.scores.items()
+                ),
+            })
         return info
 
     def _on_add_shard(self, arguments):
-        if len(arguments) == 3:
-            host, port_number, db = arguments
+        if not arguments or len(arguments) % 3:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Expected> ADDSHARD host port_number db [...]",
+            )
+        addresses = list()
+        for index in range(0, len(arguments), 3):
+            host, port_number, db = arguments[index:index + 3]
             try:
-                host = str(host, "utf-8")
-                port_number = int(port_number)
-                db = int(db)
+                addresses.append((
+                    str(host, "utf-8"),
+                    int(port_number),
+                    int(db),
+                ))
             except ValueError as ex:
                 raise rcluster.protocol.exceptions.CommandError(
                     data=b"ERR " + bytes(str(ex), "utf-8"),
                 )
+        # Connect to all the backends in parallel.
+        return rcluster.shared.when_all(
+            [
+                self._shard.add_shard_async(host, port_number, db)
+                for host, port_number, db in addresses
+            ],
+            self._get_add_shard_reply,
+        )
+
+    def _get_add_shard_reply(self, futures):
+        replies, shard_ids = list(), list()
+        for future in futures:
+            try:
+                shard_id = future.result()
+            except rcluster.shard.exceptions.ShardConnectionError:
+                replies.append(rcluster.protocol.replies.ErrorReply(
+                    data=b"ERR Could not connect to the shard.",
+                ))
             else:
-                try:
-                    shard_id = self._shard.add_shard(host, port_number, db)
-                except rcluster.shard.exceptions.ShardConnectionError:
-                    return rcluster.protocol.replies.ErrorReply(
-                        data=b"ERR Could not connect to the shard.",
-                    )
-                else:
-                    return rcluster.protocol.replies.StatusReply(
-                        data=b"OK Shard " + shard_id + b" is added",
-                    )
-        else:
+                shard_ids.append(shard_id)
+                replies.append(rcluster.protocol.replies.StatusReply(
+                    data=b"OK Shard " + shard_id + b" is added",
+                ))
+        # Let the other proxies know about the new shards.
+        self._shard.topology.publish(added=shard_ids)
+        if len(replies) == 1:
+            return replies[0]
+        return rcluster.protocol.replies.MultiBulkReply(replies=replies)
+
+    def _on_remove_shard(self, arguments):
+        if len(arguments) != 1:
             raise rcluster.protocol.exceptions.CommandError(
-                data=b"ERR Expected> ADDSHARD host port_number db",
+                data=b"ERR Expected> REMOVESHARD shard_id",
             )
+        shard_id = arguments[0]
+        if shard_id not in self._shard.connections:
+            return rcluster.protocol.replies.ErrorReply(
+                data=b"ERR Unknown shard.",
+                quit=False,
+            )
+        self._shard.remove_shard(shard_id)
+        # Let the other proxies drop the shard too.
+        self._shard.topology.publish(removed=[shard_id])
+        return rcluster.protocol.replies.StatusReply(
+            data=b"OK Shard " + shard_id + b" is removed",
+        )
+
+    def _on_shards(self, arguments):
+        if arguments:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Expected> SHARDS",
+            )
+        return rcluster.protocol.replies.MultiBulkReply(replies=[
+            rcluster.protocol.replies.MultiBulkReply(replies=[
+                rcluster.protocol.replies.BulkReply(data=shard_id),
+                rcluster.protocol.replies.BulkReply(
+                    data=bytes(
+                        rcluster.shared.format_address(address),
+                        "utf-8",
+                    ),
+                ),
+                rcluster.protocol.replies.IntegerReply(value=db_size),
+                rcluster.protocol.replies.BulkReply(
+                    data=b"ok" if score.healthy else b"failing",
+                ),
+                rcluster.protocol.replies.BulkReply(
+                    data=(
+                        b"-" if score.latency is None else bytes(
+                            "%.3fms" % (score.latency * 1000.0),
+                            "ascii",
+                        )
+                    ),
+                ),
+            ])
+            for shard_id, address, db_size, score in self._shard.get_shards()
+        ])
 
     def _on_get(self, arguments):
+        usage = b"ERR Expected> GET key [TIMEOUT milliseconds]"
+        if not arguments:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        options = self._parse_options(arguments[1:], (b"TIMEOUT", ), usage)
+        timeout = (
+            self._parse_timeout(options[b"TIMEOUT"])
+            if b"TIMEOUT" in options else None
+        )
+        key = str(arguments[0], "utf-8")
+        future = self._shard.get_async(key, timeout)
+        if future.done():
+            return self._get_get_reply([future])
+        return rcluster.shared.when_all([future], self._get_get_reply)
+
+    def _get_get_reply(self, futures):
+        try:
+            data = futures[0].result()
+        except rcluster.shard.exceptions.ShardTimeoutError as ex:
+            return self._get_timeout_reply(ex)
+        if data is not None:
+            return rcluster.protocol.replies.BulkReply(data=data)
+        else:
+            return rcluster.protocol.replies.NONE_REPLY
+
+    def _on_set(self, arguments):
+        usage = (
+            b"ERR Expected> SET key data [W write_concern]"
+            b" [TIMEOUT milliseconds]"
+        )
+        if len(arguments) < 2:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        return self._set(arguments[0], arguments[1], arguments[2:], usage)
+
+    def _on_set_ex(self, arguments):
+        usage = (
+            b"ERR Expected> SETEX key seconds data [W write_concern]"
+            b" [TIMEOUT milliseconds]"
+        )
+        if len(arguments) < 3:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        ttl = self._parse_ttl(arguments[1])
+        if ttl < 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR invalid expire time in setex",
+            )
+        return self._set(arguments[0], arguments[2], arguments[3:], usage, ttl)
+
+    def _set(self, key, data, arguments, usage, ttl=None):
+        options = self._parse_options(arguments, (b"W", b"TIMEOUT"), usage)
+        write_concern = (
+            self._parse_write_concern(options[b"W"])
+            if b"W" in options else None
+        )
+        timeout = (
+            self._parse_timeout(options[b"TIMEOUT"])
+            if b"TIMEOUT" in options else None
+        )
+        try:
+            acknowledged = self._shard.set(
+                str(key, "utf-8"),
+                data,
+                write_concern,
+                timeout,
+                ttl,
+            )
+        except rcluster.shard.exceptions.ShardTimeoutError as ex:
+            return self._get_timeout_reply(ex)
+        if not acknowledged:
+            return rcluster.protocol.replies.ErrorReply(
+                data=b"ERR The key is not set - possible cluster failure.",
+            )
+        if write_concern is None:
+            write_concern = self._shard.write_concern
+        if write_concern is not None and acknowledged < min(
+            write_concern,
+            # The replicaness might be lowered after the write concern is
+            # set.
+            self._shard.replicaness,
+        ):
+            return rcluster.protocol.replies.ErrorReply(
+                data=bytes(
+                    "ERR Write concern is not satisfied: %d replicas are"
+                    " written." % acknowledged,
+                    "ascii",
+                ),
+            )
+        return rcluster.protocol.replies.OK_REPLY
+
+    def _on_expire(self, arguments):
+        if len(arguments) != 2:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Expected> EXPIRE key seconds",
+            )
+        exists = self._shard.expire(
+            str(arguments[0], "utf-8"),
+            self._parse_ttl(arguments[1]),
+        )
+        return rcluster.protocol.replies.IntegerReply(value=int(exists))
+
+    def _on_ttl(self, arguments):
+        if len(arguments) != 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Expected> TTL key",
+            )
+        ttl = self._shard.ttl(str(arguments[0], "utf-8"))
+        return rcluster.protocol.replies.IntegerReply(
+            # Rounded like the Redis TTL.
+            value=int(ttl + 0.5) if ttl >= 0 else ttl,
+        )
+
+    def _parse_ttl(self, value):
+        try:
+            return int(value)
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+
+    def _get_timeout_reply(self, ex):
+        # The client may retry on the same connection.
+        return rcluster.protocol.replies.ErrorReply(
+            data=b"TIMEOUT " + bytes(str(ex), "utf-8"),
+            quit=False,
+        )
+
+    def _on_scan(self, arguments):
+        usage = b"ERR Expected> SCAN cursor [MATCH pattern] [COUNT count]"
+        if not arguments:
+            raise rcluster.protocol.exceptions.CommandError(data=usage)
+        options = self._parse_options(
+            arguments[1:],
+            (b"MATCH", b"COUNT"),
+            usage,
+        )
+        try:
+            cursor = int(arguments[0])
+            count = int(options[b"COUNT"]) if b"COUNT" in options else None
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        if cursor < 0 or (count is not None and count < 1):
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Invalid cursor or count value.",
+            )
+        cursor, keys = self._shard.scan(cursor, options.get(b"MATCH"), count)
+        return rcluster.protocol.replies.MultiBulkReply(replies=[
+            rcluster.protocol.replies.BulkReply(
+                data=bytes(str(cursor), "ascii"),
+            ),
+            rcluster.protocol.replies.MultiBulkReply(replies=[
+                rcluster.protocol.replies.BulkReply(data=key) for key in keys
+            ]),
+        ])
+
+    def _on_hot_keys(self, arguments):
+        if len(arguments) > 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Expected> HOTKEYS [count]",
+            )
+        try:
+            count = int(arguments[0]) if arguments else None
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        if count is not None and count < 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Invalid count value.",
+            )
+        return rcluster.protocol.replies.MultiBulkReply(replies=[
+            rcluster.protocol.replies.MultiBulkReply(replies=[
+                rcluster.protocol.replies.BulkReply(data=key),
+                rcluster.protocol.replies.IntegerReply(value=estimate),
+            ])
+            for key, estimate in self._shard.get_hot_keys(count)
+        ])
+
+    def _on_set_write_concern(self, arguments):
         if len(arguments) == 1:
-            key = str(arguments[0], "utf-8")
-            self._logger.debug("GET %s" % key)
-            data = self._shard.get(key)
-            if data is not None:
-                return rcluster.protocol.replies.BulkReply(data=data)
+            if arguments[0].upper() == b"ALL":
+                self._shard.write_concern = None
             else:
-                return rcluster.protocol.replies.NoneReply()
+                self._shard.write_concern = self._parse_write_concern(
+                    arguments[0],
+                )
+            return rcluster.protocol.replies.OK_REPLY
         else:
             raise rcluster.protocol.exceptions.CommandError(
-                data=b"ERR Expected> GET key",
+                data=b"ERR Expected> SETWRITECONCERN write_concern|ALL",
             )
 
-    def _on_set(self, arguments):
-        if len(arguments) == 2:
-            key, data = str(arguments[0], "utf-8"), arguments[1]
-            self._logger.debug("SET %s bytes(%s)" % (key, len(data)))
-            if self._shard.set(key, data):
-                return rcluster.protocol.replies.StatusReply(
-                    data=b"OK",
-                )
+    def _parse_write_concern(self, value):
+        try:
+            write_concern = int(value)
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        if write_concern < 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Invalid write concern value.",
+            )
+        if write_concern > self._shard.replicaness:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Write concern is greater than replicaness.",
+            )
+        return write_concern
+
+    def _on_set_deadline(self, arguments):
+        if len(arguments) == 1:
+            if arguments[0].upper() == b"NONE":
+                self._shard.deadline = None
             else:
-                return rcluster.protocol.replies.ErrorReply(
-                    data=b"ERR The key is not set - possible cluster failure.",
-                )
+                self._shard.deadline = self._parse_timeout(arguments[0])
+            return rcluster.protocol.replies.OK_REPLY
         else:
             raise rcluster.protocol.exceptions.CommandError(
-                data=b"ERR Expected> SET key data",
+                data=b"ERR Expected> SETDEADLINE milliseconds|NONE",
+            )
+
+    def _parse_timeout(self, value):
+        """
+        Parses the timeout in milliseconds into seconds.
+        """
+
+        try:
+            timeout = int(value)
+        except ValueError as ex:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR " + bytes(str(ex), "utf-8"),
+            )
+        if timeout < 1:
+            raise rcluster.protocol.exceptions.CommandError(
+                data=b"ERR Invalid timeout value.",
             )
+        return timeout / 1000.0
 
     def _on_set_replicaness(self, arguments):
         if len(arguments) == 1:
@@ -306,6 +599,7 @@ class _ShardCommandHandler(rcluster.protocol.CommandHandler):
             else:
                 if replicaness >= 1:
                     self._shard.replicaness = replicaness
+                    self._shard.topology.publish(replicaness_changed=True)
                     return rcluster.protocol.replies.StatusReply(
                         data=(
                             b"OK"
@@ -323,6 +617,19 @@ class _ShardCommandHandler(rcluster.protocol.CommandHandler):
             )
 
 
+def _parse_rate(value):
+    """
+    Parses the sampling rate from 0 to 1.
+    """
+
+    rate = float(value)
+    if not 0.0 <= rate <= 1.0:
+        raise argparse.ArgumentTypeError(
+            "rate from 0 to 1 is expected: %s" % value,
+        )
+    return rate
+
+
 def _create_argument_parser():
     parser = argparse.ArgumentParser(
         description=globals()["__doc__"],
@@ -335,7 +642,7 @@ def _create_argument_parser():
         type=str,
         metavar="LEVEL",
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "FATAL"],
-        default="DEBUG",
+        default="INFO",
         help="logging level (default: %(default)s)",
     )
     parser.add_argument(
@@ -346,6 +653,231 @@ def _create_argument_parser():
         default=rcluster.shared.DEFAULT_SHARD_PORT,
         help="port number to listen to (default: %(default)s)",
     )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        type=str,
+        metavar="ENGINE",
+        choices=rcluster.protocol.Server.ENGINES,
+        default=rcluster.protocol.Server.TORNADO_ENGINE,
+        help=(
+            "server engine: %s (default: %%(default)s)"
+            % ", ".join(rcluster.protocol.Server.ENGINES)
+        ),
+    )
+    parser.add_argument(
+        "--seed",
+        dest="seeds",
+        type=rcluster.shared.parse_address,
+        metavar="HOST:PORT[/DB]",
+        action="append",
+        default=[],
+        help=(
+            "backend to discover the cluster topology from,\n"
+            "may be repeated"
+        ),
+    )
+    parser.add_argument(
+        "--topology-interval",
+        dest="topology_interval",
+        type=float,
+        metavar="SECONDS",
+        default=5.0,
+        help=(
+            "how often the topology is polled from the backends\n"
+            "(default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--backend-connections",
+        dest="backend_connections",
+        type=int,
+        metavar="COUNT",
+        default=2,
+        help=(
+            "multiplexed read connections per backend, 0 reads through\n"
+            "the connection pool (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--small-key-buckets",
+        dest="small_key_buckets",
+        type=int,
+        metavar="COUNT",
+        default=0,
+        help=(
+            "number of hashes to keep the small values in, must be the same\n"
+            "on every proxy (default: none)"
+        ),
+    )
+    parser.add_argument(
+        "--small-key-size",
+        dest="small_key_size",
+        type=int,
+        metavar="BYTES",
+        default=64,
+        help=(
+            "largest key and value kept in a bucket, should match\n"
+            "hash-max-ziplist-value (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--stats-interval",
+        dest="stats_interval",
+        type=float,
+        metavar="SECONDS",
+        default=1.0,
+        help=(
+            "how often the backend load is sampled for the key placement\n"
+            "(default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--write-concern",
+        dest="write_concern",
+        type=int,
+        metavar="W",
+        default=None,
+        help=(
+            "number of replicas to acknowledge a write before the reply\n"
+            "(default: all)"
+        ),
+    )
+    parser.add_argument(
+        "--deadline",
+        dest="deadline",
+        type=int,
+        metavar="MILLISECONDS",
+        default=None,
+        help=(
+            "time budget of GET and SET, may be overridden per request\n"
+            "with TIMEOUT (default: none)"
+        ),
+    )
+    parser.add_argument(
+        "--fast-reads",
+        dest="fast_reads",
+        action="store_true",
+        help=(
+            "return reads once the replicaness copies of the newest value\n"
+            "are found on the fastest backends"
+        ),
+    )
+    parser.add_argument(
+        "--large-value-threshold",
+        dest="large_value_threshold",
+        type=int,
+        metavar="BYTES",
+        default=None,
+        help=(
+            "value size from which reads compare the versions first and\n"
+            "fetch the value from a single replica (default: none)"
+        ),
+    )
+    parser.add_argument(
+        "--key-directory",
+        dest="key_directory",
+        type=int,
+        metavar="KEYS",
+        default=0,
+        help=(
+            "number of keys whose backends are remembered, so that their\n"
+            "reads skip the other backends (default: none)"
+        ),
+    )
+    parser.add_argument(
+        "--hot-key-threshold",
+        dest="hot_key_threshold",
+        type=int,
+        metavar="COUNT",
+        default=None,
+        help=(
+            "read count above which a key gets extra replicas, the counts\n"
+            "are halved every %d seconds (default: none)"
+            % Shard.HOT_KEYS_INTERVAL
+        ),
+    )
+    parser.add_argument(
+        "--hot-key-replicas",
+        dest="hot_key_replicas",
+        type=int,
+        metavar="COUNT",
+        default=1,
+        help="number of extra replicas of a hot key (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--handoff-capacity",
+        dest="handoff_capacity",
+        type=int,
+        metavar="COUNT",
+        default=65536,
+        help=(
+            "number of missed writes to keep per backend, 0 disables\n"
+            "hinted handoff (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--handoff-dir",
+        dest="handoff_directory",
+        type=str,
+        metavar="DIR",
+        default=None,
+        help="directory to keep the missed writes in (default: memory only)",
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        dest="trace_sample_rate",
+        type=_parse_rate,
+        metavar="RATE",
+        default=0.0,
+        help="fraction of requests to trace (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--trace-capacity",
+        dest="trace_capacity",
+        type=int,
+        metavar="COUNT",
+        default=128,
+        help="number of recent traces to keep (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--capture-dir",
+        dest="capture_directory",
+        type=str,
+        metavar="DIR",
+        default=None,
+        help=(
+            "directory of the capture files, CAPTURE is disabled without\n"
+            "it (default: none)"
+        ),
+    )
+    parser.add_argument(
+        "--capture",
+        dest="capture_name",
+        type=str,
+        metavar="FILE",
+        default=None,
+        help=(
+            "capture the incoming requests into the file in --capture-dir\n"
+            "for rcluster-replay"
+        ),
+    )
+    parser.add_argument(
+        "--capture-sample-rate",
+        dest="capture_sample_rate",
+        type=_parse_rate,
+        metavar="RATE",
+        default=1.0,
+        help="fraction of requests to capture (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--capture-max-size",
+        dest="capture_max_size",
+        type=int,
+        metavar="MEGABYTES",
+        default=64,
+        help="capture file size limit (default: %(default)s)",
+    )
     return parser
 
 
@@ -359,7 +891,42 @@ def entry_point():
     logger = logging.getLogger("rcluster.shard")
 
     logger.info("Starting the shard ...")
-    Shard(args.port_number).start()
+    shard = Shard(
+        args.port_number,
+        tracer=rcluster.tracing.Tracer(
+            sample_rate=args.trace_sample_rate,
+            capacity=args.trace_capacity,
+        ),
+        handoff_capacity=args.handoff_capacity,
+        handoff_directory=args.handoff_directory,
+        seeds=args.seeds,
+        topology_interval=args.topology_interval,
+        stats_interval=args.stats_interval,
+        engine=args.engine,
+        backend_connections=args.backend_connections,
+        small_key_buckets=args.small_key_buckets,
+        small_key_size=args.small_key_size,
+        key_directory=args.key_directory,
+        capture=rcluster.capture.Capture(args.capture_directory),
+    )
+    shard.write_concern = args.write_concern
+    shard.fast_reads = args.fast_reads
+    shard.large_value_threshold = args.large_value_threshold
+    shard.hot_key_threshold = args.hot_key_threshold
+    shard.hot_key_replicas = args.hot_key_replicas
+    if args.deadline is not None:
+        shard.deadline = args.deadline / 1000.0
+    if args.capture_name is not None:
+        try:
+            shard.capture.start(
+                args.capture_name,
+                args.capture_sample_rate,
+                args.capture_max_size * 1048576,
+            )
+        except (RuntimeError, ValueError, OSError) as ex:
+            logger.fatal(str(ex))
+            return os.EX_CANTCREAT
+    shard.start()
 
     logger.info("IO loop is being started.")
     logger.info(
@@ -367,7 +934,7 @@ def entry_point():
     )
 
     try:
-        tornado.ioloop.IOLoop.instance().start()
+        shard.run()
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt.")
     except:
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Small value buckets.
+"""
+
+import struct
+import zlib
+
+
+class BucketLayout:
+    """
+    Places the small values into Redis hashes, so that the backend keeps
+    them in the compact hash encoding instead of two top-level keys each.
+    The bucket is derived from the key with CRC32, so every proxy finds it.
+    The hash field holds the timestamp followed by the data.
+    """
+
+    # Unlike the "rc:" data keys, never clashes with a logical key.
+    PREFIX = b"rcb:"
+    TIMESTAMP = struct.Struct(">Q")
+
+    def __init__(self, bucket_count, max_entry_size=64):
+        self._bucket_count = bucket_count
+        self._max_entry_size = max_entry_size
+
+    @property
+    def bucket_count(self):
+        return self._bucket_count
+
+    @property
+    def max_entry_size(self):
+        """
+        Largest field and value size kept in a bucket. Matches the
+        hash-max-ziplist-value backend setting.
+        """
+
+        return self._max_entry_size
+
+    def get_bucket_key(self, bucket_id):
+        return BucketLayout.PREFIX + bytes(str(bucket_id), "ascii")
+
+    def locate(self, data_key):
+        """
+        Gets the bucket key and the field of the data key.
+        """
+
+        # Strip "rc:".
+        key = data_key[3:]
+        return self.get_bucket_key(zlib.crc32(key) % self._bucket_count), key
+
+    def fits(self, data_key, data):
+        """
+        Checks whether the data is small enough to be kept in a bucket.
+        """
+
+        return (
+            len(data_key) - 3 <= self._max_entry_size and
+            BucketLayout.TIMESTAMP.size + len(data) <= self._max_entry_size
+        )
+
+    def pack(self, timestamp, data):
+        return BucketLayout.TIMESTAMP.pack(timestamp) + data
+
+    def unpack(self, value):
+        """
+        Gets the timestamp and the data of the field value. A missing value
+        has zero timestamp and None data.
+        """
+
+        if value is None:
+            return 0, None
+        size = BucketLayout.TIMESTAMP.size
+        return BucketLayout.TIMESTAMP.unpack(value[:size])[0], value[size:]
@@ -0,0 +1,2557 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Places, replicates and reads the keys across the backends. Shared by the
+shard server and the embedded client.
+"""
+
+import bisect
+import concurrent.futures
+import fnmatch
+import functools
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import traceback
+import uuid
+import zlib
+
+import redis
+import redis.exceptions
+
+import rcluster.shard.buckets
+import rcluster.shard.directory
+import rcluster.shard.exceptions
+import rcluster.shard.handoff
+import rcluster.shard.hotkeys
+import rcluster.shard.load
+import rcluster.shard.multiplex
+import rcluster.shard.scores
+import rcluster.shard.sizes
+import rcluster.shard.topology
+import rcluster.tracing
+
+
+class Cluster:
+    """
+    Places the keys on the backends, replicates them and reads the newest
+    versions back. Follows the topology shared with the other proxies and
+    replays the writes missed by the failed backends.
+
+    The callbacks run on the scheduler: the IO loop of the proxy, or the
+    background thread of the cluster by default. The backends can be added
+    and removed from any thread.
+    """
+
+    SHARD_ID_KEY = "rcluster:shard:id"
+    MAX_WORKERS = 8
+    # Hinted handoff replay interval in seconds.
+    HANDOFF_INTERVAL = 1.0
+    HANDOFF_BATCH_SIZE = 512
+    # Attempts to replay a batch of hints while its keys are modified, and
+    # the initial backoff between them in seconds.
+    HANDOFF_ATTEMPTS = 3
+    HANDOFF_BACKOFF = 0.005
+    # How long the timestamp of an expired key outlives its data, in
+    # seconds. It hides the older copies that have missed the deletion.
+    TOMBSTONE_TTL = 86400.0
+    # Bits of the SCAN cursor that hold the hash of the backend's shard ID.
+    SCAN_HASH_BITS = 32
+    SCAN_HASH_MASK = (1 << SCAN_HASH_BITS) - 1
+    # Key access counts are halved every interval in seconds.
+    HOT_KEYS_INTERVAL = 10.0
+
+    def __init__(
+        self,
+        tracer=None,
+        handoff_capacity=65536,
+        handoff_directory=None,
+        seeds=(),
+        topology_interval=5.0,
+        stats_interval=1.0,
+        backend_connections=2,
+        small_key_buckets=0,
+        small_key_size=64,
+        key_directory=0,
+        scheduler=None,
+    ):
+        self._logger = logging.getLogger("rcluster.shard.cluster.Cluster")
+        self._tracer = tracer
+        # The cluster runs its own callbacks unless it is given a scheduler.
+        self._scheduler = scheduler if scheduler is not None else _Scheduler()
+        self._own_scheduler = scheduler is None
+        # Guards the replacement of the per-backend mappings. The mappings
+        # are never modified in place, so they can be read without the lock.
+        self._shards_lock = threading.Lock()
+        self._replicaness = 1
+        self._write_concern = None
+        self._fast_reads = False
+        self._connections = dict()
+        # Multiplexed read connections per backend.
+        self._multiplexers = dict()
+        self._backend_connections = backend_connections
+        # Hashes to keep the small values in. Every proxy must use the same
+        # layout.
+        self._buckets = (
+            rcluster.shard.buckets.BucketLayout(
+                small_key_buckets,
+                small_key_size,
+            )
+            if small_key_buckets else None
+        )
+        # Backends that hold the keys.
+        self._directory = (
+            rcluster.shard.directory.KeyDirectory(key_directory)
+            if key_directory else None
+        )
+        # Guards the counters updated by the request threads.
+        self._counters_lock = threading.Lock()
+        self._directory_hits = 0
+        self._directory_misses = 0
+        self._stopped = False
+        self._load = rcluster.shard.load.LoadIndex()
+        self._stats_interval = stats_interval
+        self._sampling = False
+        self._addresses = dict()
+        self._scores = dict()
+        self._background_failures = 0
+        self._deadline = None
+        self._timeouts = 0
+        self._hot_keys = rcluster.shard.hotkeys.HotKeyTracker()
+        self._hot_key_threshold = None
+        self._hot_key_replicas = 1
+        # Keys that have the extra replicas, guarded by the lock.
+        self._replicated_hot_keys = set()
+        self._hot_keys_lock = threading.Lock()
+        self._large_value_threshold = None
+        self._sizes = rcluster.shard.sizes.SizeHints()
+        self._two_phase_reads = 0
+        # Missed writes per backend.
+        self._hints = dict()
+        self._handoff_capacity = handoff_capacity
+        self._handoff_directory = handoff_directory
+        self._replaying = set()
+        self._seeds = seeds
+        self._topology = rcluster.shard.topology.TopologyRegistry(
+            self,
+            interval=topology_interval,
+        )
+        # Runs the blocking backend operations off the IO loop.
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=Cluster.MAX_WORKERS,
+        )
+
+    @property
+    def replicaness(self):
+        return self._replicaness
+
+    @replicaness.setter
+    def replicaness(self, replicaness):
+        self._replicaness = replicaness
+
+    @property
+    def write_concern(self):
+        """
+        Number of the replicas that must acknowledge the write before the
+        reply is sent. None stands for all the writes.
+        """
+
+        return self._write_concern
+
+    @write_concern.setter
+    def write_concern(self, write_concern):
+        self._write_concern = write_concern
+
+    @property
+    def background_failures(self):
+        """
+        Number of the failed background writes.
+        """
+
+        return self._background_failures
+
+    @property
+    def deadline(self):
+        """
+        Default time budget of a command in seconds. None stands for no
+        deadline.
+        """
+
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, deadline):
+        self._deadline = deadline
+
+    @property
+    def timeouts(self):
+        """
+        Number of the commands that have run out of time.
+        """
+
+        return self._timeouts
+
+    @property
+    def hot_key_threshold(self):
+        """
+        Decayed read count above which a key gets the extra replicas. None
+        disables the extra replicas.
+        """
+
+        return self._hot_key_threshold
+
+    @hot_key_threshold.setter
+    def hot_key_threshold(self, hot_key_threshold):
+        self._hot_key_threshold = hot_key_threshold
+
+    @property
+    def hot_key_replicas(self):
+        """
+        Number of the extra replicas of a hot key.
+        """
+
+        return self._hot_key_replicas
+
+    @hot_key_replicas.setter
+    def hot_key_replicas(self, hot_key_replicas):
+        self._hot_key_replicas = hot_key_replicas
+
+    @property
+    def replicated_hot_keys(self):
+        with self._hot_keys_lock:
+            return set(self._replicated_hot_keys)
+
+    def get_hot_keys(self, count=None):
+        """
+        Gets the most frequently read keys with their decayed read counts.
+        """
+
+        return [
+            (self._unwrap_key(data_key), estimate)
+            for data_key, estimate in self._hot_keys.top(count)
+        ]
+
+    @property
+    def large_value_threshold(self):
+        """
+        Value size in bytes from which the value is fetched from a single
+        replica after its versions are compared. None disables the
+        two-phase reads.
+        """
+
+        return self._large_value_threshold
+
+    @large_value_threshold.setter
+    def large_value_threshold(self, large_value_threshold):
+        self._large_value_threshold = large_value_threshold
+
+    @property
+    def two_phase_reads(self):
+        return self._two_phase_reads
+
+    @property
+    def fast_reads(self):
+        """
+        Whether reads stop as soon as the fastest backends return
+        the replicaness copies of the newest value.
+        """
+
+        return self._fast_reads
+
+    @fast_reads.setter
+    def fast_reads(self, fast_reads):
+        self._fast_reads = fast_reads
+
+    @property
+    def scores(self):
+        return self._scores
+
+    def add_shard(self, host, port_number, db):
+        """
+        Adds the shard. Blocks until the backend is connected.
+        """
+
+        return self._register_shard(
+            *self._connect_shard(host, port_number, db)
+        )
+
+    def add_shard_async(self, host, port_number, db):
+        """
+        Adds the shard without blocking the IO loop. Returns the future of
+        the shard ID.
+        """
+
+        future = concurrent.futures.Future()
+
+        def on_connected(connect_future):
+            self.add_callback(
+                lambda: self._on_shard_connected(connect_future, future),
+            )
+
+        self._executor.submit(
+            self._connect_shard,
+            host,
+            port_number,
+            db,
+        ).add_done_callback(on_connected)
+        return future
+
+    def _on_shard_connected(self, connect_future, future):
+        """
+        Registers the connected shard on the IO loop.
+        """
+
+        try:
+            shard_id = self._register_shard(*connect_future.result())
+        except Exception as ex:
+            future.set_exception(ex)
+        else:
+            future.set_result(shard_id)
+
+    def _connect_shard(self, host, port_number, db):
+        """
+        Connects to the backend and gets its shard ID.
+        """
+
+        self._logger.info(
+            "Adding shard: %s:%s/%d ...",
+            host,
+            port_number,
+            db,
+        )
+        connection = redis.StrictRedis(
+            host=host,
+            port=port_number,
+            db=db,
+        )
+        shard_id = bytes(uuid.uuid4().hex, "ascii")
+        try:
+            if not connection.setnx(Cluster.SHARD_ID_KEY, shard_id):
+                shard_id = connection.get(Cluster.SHARD_ID_KEY)
+            load = self._sample_load(connection)
+        except redis.exceptions.ConnectionError as ex:
+            raise rcluster.shard.exceptions.ShardConnectionError(
+                "Could not connect to the specified shard.",
+            ) from ex
+        return shard_id, connection, load, (host, port_number, db)
+
+    def _register_shard(self, shard_id, connection, load, address):
+        with self._shards_lock:
+            multiplexers = dict(self._multiplexers)
+            if self._backend_connections:
+                multiplexer = multiplexers.pop(shard_id, None)
+                if multiplexer is not None:
+                    multiplexer.close()
+                multiplexers[shard_id] = rcluster.shard.multiplex.Multiplexer(
+                    connection.connection_pool,
+                    self._backend_connections,
+                )
+            self._load.update(shard_id, load)
+            hints = self._hints
+            if self._handoff_capacity and shard_id not in hints:
+                hints = dict(hints)
+                hints[shard_id] = rcluster.shard.handoff.HintQueue(
+                    capacity=self._handoff_capacity,
+                    path=(
+                        os.path.join(
+                            self._handoff_directory,
+                            str(shard_id, "ascii") + ".hints",
+                        )
+                        if self._handoff_directory is not None else None
+                    ),
+                )
+            self._multiplexers = multiplexers
+            addresses = dict(self._addresses)
+            addresses[shard_id] = address
+            self._addresses = addresses
+            scores = dict(self._scores)
+            scores[shard_id] = rcluster.shard.scores.BackendScore()
+            self._scores = scores
+            self._hints = hints
+            # The requests from the other threads see the backend once the
+            # rest of its state is set.
+            connections = dict(self._connections)
+            connections[shard_id] = connection
+            self._connections = connections
+        if self._directory is not None:
+            learner = threading.Thread(
+                target=self._learn_locations,
+                args=(shard_id, connection),
+                name="rcluster-directory",
+            )
+            learner.daemon = True
+            learner.start()
+        self._logger.info("Shard %s is added (%r).", shard_id, load)
+        return shard_id
+
+    def get_shards(self):
+        """
+        Gets the shard IDs with their addresses, cached DB sizes and scores.
+        """
+
+        return [
+            (
+                shard_id,
+                self._addresses[shard_id],
+                self._load.get(shard_id).db_size,
+                self._scores[shard_id],
+            )
+            for shard_id in self._connections
+        ]
+
+    def remove_shard(self, shard_id):
+        with self._shards_lock:
+            # The requests stop picking the backend before its state goes.
+            self._connections = _without(self._connections, shard_id)
+            multiplexer = self._multiplexers.get(shard_id)
+            self._multiplexers = _without(self._multiplexers, shard_id)
+            self._scores = _without(self._scores, shard_id)
+            self._addresses = _without(self._addresses, shard_id)
+            hints = self._hints.get(shard_id)
+            self._hints = _without(self._hints, shard_id)
+            self._load.remove(shard_id)
+        if multiplexer is not None:
+            multiplexer.close()
+        if self._directory is not None:
+            self._directory.remove_shard(shard_id)
+        if hints is not None:
+            hints.close()
+
+    @property
+    def hints(self):
+        return self._hints
+
+    @property
+    def load_index(self):
+        """
+        Gets the cached load metrics of the backends.
+        """
+
+        return self._load
+
+    def _on_stats_timer(self):
+        """
+        Samples the backend load metrics in the background.
+        """
+
+        if self._sampling:
+            return
+        self._sampling = True
+        self._executor.submit(self._sample_stats)
+
+    def _sample_stats(self):
+        try:
+            for shard_id, connection in list(self._connections.items()):
+                try:
+                    load = self._sample_load(connection)
+                except redis.exceptions.ConnectionError:
+                    continue
+                if shard_id in self._connections:
+                    self._load.update(shard_id, load)
+        except:
+            self._logger.error(traceback.format_exc())
+        finally:
+            self._sampling = False
+
+    def _sample_load(self, connection):
+        with connection.pipeline(transaction=False) as pipeline:
+            memory, stats, db_size = pipeline.info("memory").info(
+                "stats",
+            ).dbsize().execute()
+        return rcluster.shard.load.BackendLoad(
+            db_size=db_size,
+            used_memory=memory.get("used_memory", 0),
+            ops_per_sec=stats.get("instantaneous_ops_per_sec", 0),
+        )
+
+    @property
+    def buckets(self):
+        """
+        Layout of the small value buckets. None if the small values are
+        kept in the top-level keys.
+        """
+
+        return self._buckets
+
+    @property
+    def directory(self):
+        """
+        Key location directory. None if every read is broadcast.
+        """
+
+        return self._directory
+
+    @property
+    def directory_hits(self):
+        """
+        Number of the reads served by the backends from the directory.
+        """
+
+        return self._directory_hits
+
+    @property
+    def directory_misses(self):
+        """
+        Number of the reads broadcast because the key is not in the
+        directory or has moved.
+        """
+
+        return self._directory_misses
+
+    @property
+    def multiplexers(self):
+        return self._multiplexers
+
+    @property
+    def connections(self):
+        """
+        Gets the copy of the shard ID to connection mapping.
+        """
+
+        return dict(self._connections)
+
+    @property
+    def topology(self):
+        return self._topology
+
+    @property
+    def tracer(self):
+        return self._tracer
+
+    def add_callback(self, callback):
+        """
+        Calls the callback on the scheduler. Safe to call from any thread.
+        """
+
+        self._scheduler.add_callback(callback)
+
+    def add_periodic_callback(self, callback, interval):
+        """
+        Calls the callback on the scheduler every interval seconds.
+        """
+
+        return self._scheduler.add_periodic_callback(callback, interval)
+
+    def start(self):
+        """
+        Starts following the topology and the periodic maintenance.
+        """
+
+        if self._own_scheduler:
+            self._scheduler.start()
+        self._topology.start(self._seeds)
+        self.add_periodic_callback(
+            self._on_handoff_timer,
+            Cluster.HANDOFF_INTERVAL,
+        )
+        self.add_periodic_callback(
+            self._on_hot_keys_timer,
+            Cluster.HOT_KEYS_INTERVAL,
+        )
+        self.add_periodic_callback(self._on_stats_timer, self._stats_interval)
+
+    def stop(self):
+        """
+        Stops following the topology and closes the backend connections.
+        """
+
+        self._stopped = True
+        if self._own_scheduler:
+            self._scheduler.stop()
+        self._topology.stop()
+        self._executor.shutdown(wait=False)
+        for multiplexer in self._multiplexers.values():
+            multiplexer.close()
+        for hints in self._hints.values():
+            hints.close()
+
+    def is_shard_alive(self, shard_id):
+        """
+        Checks whether the connection to the specified shard is alive.
+        """
+
+        connection = self._connections.get(shard_id)
+        if connection is None:
+            return False
+        try:
+            connection.ping()
+        except redis.exceptions.ConnectionError:
+            return False
+        else:
+            return True
+
+    def get(self, key, timeout=None):
+        """
+        Gets the newest value of the key.
+
+        The backends are read within the timeout in seconds (the deadline
+        is used by default). When it expires, the newest value found so far
+        is returned, or ShardTimeoutError is raised if the backends that
+        have answered cannot tell whether the key exists.
+
+        Keys known to hold large values are read in two phases: the
+        timestamps are compared first, then the value is fetched from a
+        single replica of the newest version.
+
+        Keys found in the directory are read from their backends and the
+        ones that the placement would pick for a write, and the newest
+        version among them wins. The read is broadcast if none of them has
+        the key.
+        """
+
+        if timeout is None:
+            timeout = self._deadline
+        deadline = None if timeout is None else time.time() + timeout
+        data_key, timestamp_key = self._wrap_key(key)
+        trace = self._get_active_trace()
+        connections = self._get_read_connections(data_key)
+
+        located = self._locate(data_key, connections)
+        if located is not None:
+            data = self._get_value(
+                located,
+                data_key,
+                timestamp_key,
+                trace,
+                deadline,
+            )
+            if data is not None:
+                with self._counters_lock:
+                    self._directory_hits += 1
+                return data
+        if self._directory is not None:
+            with self._counters_lock:
+                self._directory_misses += 1
+        return self._get_value(
+            connections,
+            data_key,
+            timestamp_key,
+            trace,
+            deadline,
+        )
+
+    def _get_value(
+        self,
+        connections,
+        data_key,
+        timestamp_key,
+        trace,
+        deadline,
+    ):
+        """
+        Reads the newest value of the key from the backends.
+        """
+
+        threshold = self._large_value_threshold
+        if threshold is None:
+            return self._get_latest(
+                connections,
+                data_key,
+                timestamp_key,
+                trace,
+                deadline,
+            )
+        if self._sizes.get(data_key) is not None:
+            with self._counters_lock:
+                self._two_phase_reads += 1
+            data = self._get_latest_two_phase(
+                connections,
+                data_key,
+                timestamp_key,
+                trace,
+                deadline,
+            )
+        else:
+            data = self._get_latest(
+                connections,
+                data_key,
+                timestamp_key,
+                trace,
+                deadline,
+            )
+        self._update_size(data_key, data)
+        return data
+
+    def get_async(self, key, timeout=None):
+        """
+        Gets the newest value of the key without blocking. Returns the
+        future of the value.
+
+        The backends are read in parallel through the multiplexed
+        connections. The reads with a timeout, of the large values or
+        without the multiplexed connections are done by get before
+        returning.
+        """
+
+        if timeout is None:
+            timeout = self._deadline
+        data_key, timestamp_key = self._wrap_key(key)
+        if (
+            timeout is not None or
+            not self._multiplexers or
+            self._large_value_threshold is not None and
+            self._sizes.get(data_key) is not None
+        ):
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(self.get(key, timeout))
+            except Exception as ex:
+                future.set_exception(ex)
+            return future
+
+        trace = self._get_active_trace()
+        connections = self._get_read_connections(data_key)
+        located = self._locate(data_key, connections)
+        if located is None:
+            if self._directory is not None:
+                with self._counters_lock:
+                    self._directory_misses += 1
+            return self._read_multiplexed(
+                connections,
+                data_key,
+                timestamp_key,
+                trace,
+            )
+        result = concurrent.futures.Future()
+        self._read_multiplexed(
+            located,
+            data_key,
+            timestamp_key,
+            trace,
+        ).add_done_callback(functools.partial(
+            self._on_located_read,
+            result,
+            connections,
+            data_key,
+            timestamp_key,
+            trace,
+        ))
+        return result
+
+    def _on_located_read(
+        self,
+        result,
+        connections,
+        data_key,
+        timestamp_key,
+        trace,
+        future,
+    ):
+        """
+        Broadcasts the read unless the located backends have the key.
+        """
+
+        if future.exception() is None and future.result() is not None:
+            with self._counters_lock:
+                self._directory_hits += 1
+            result.set_result(future.result())
+            return
+        with self._counters_lock:
+            self._directory_misses += 1
+
+        def on_done(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        self._read_multiplexed(
+            connections,
+            data_key,
+            timestamp_key,
+            trace,
+        ).add_done_callback(on_done)
+
+    def _read_multiplexed(self, connections, data_key, timestamp_key, trace):
+        """
+        Reads the backends in parallel through the multiplexed connections.
+        Returns the future of the newest value.
+
+        The value is resolved once every backend has answered, or as soon
+        as all the replicas of the newest version are found if fast reads
+        are enabled.
+        """
+
+        reads = list()
+        for shard_id, _ in connections:
+            multiplexer = self._multiplexers.get(shard_id)
+            if multiplexer is None:
+                continue
+            span = trace.span("backend", shard_id, "get")
+            span.__enter__()
+            try:
+                future = multiplexer.execute(*(
+                    [(b"MULTI", )] +
+                    self._get_read_commands(data_key, timestamp_key) +
+                    [(b"EXEC", )]
+                ))
+            except redis.exceptions.ConnectionError as ex:
+                # The shard is just removed.
+                span.__exit__(type(ex), ex, None)
+                continue
+            reads.append(
+                (shard_id, future, span, self._scores[shard_id], time.time()),
+            )
+
+        result = concurrent.futures.Future()
+        lock = threading.Lock()
+        # Newest timestamp and data.
+        latest = [0, None]
+        # Backends with the copies of the latest data.
+        holders = list()
+        # Versions of the found data.
+        copies = list()
+        pending = [len(reads)]
+
+        def resolve():
+            try:
+                result.set_result(self._get_latest_reply(
+                    data_key,
+                    latest[1],
+                    latest[0],
+                    holders,
+                    copies,
+                ))
+            except Exception as ex:
+                result.set_exception(ex)
+
+        def on_done(shard_id, span, score, started_at, future):
+            version = self._get_read_reply(span, score, started_at, future)
+            with lock:
+                if not pending[0]:
+                    # The value is already resolved.
+                    return
+                pending[0] -= 1
+                if version is not None:
+                    data, timestamp = version
+                    if data is not None:
+                        copies.append((shard_id, timestamp))
+                    if not latest[0] or latest[0] < timestamp:
+                        latest[:] = timestamp, data
+                        holders[:] = [shard_id] if timestamp else []
+                    elif timestamp == latest[0]:
+                        holders.append(shard_id)
+                # All the replicas of the latest data are found.
+                if self._fast_reads and len(holders) >= self._replicaness:
+                    pending[0] = 0
+                elif pending[0]:
+                    return
+            resolve()
+
+        if not reads:
+            resolve()
+        for shard_id, future, span, score, started_at in reads:
+            future.add_done_callback(functools.partial(
+                on_done,
+                shard_id,
+                span,
+                score,
+                started_at,
+            ))
+        return result
+
+    def _get_read_reply(self, span, score, started_at, future):
+        """
+        Parses the reply of the multiplexed read. Returns the data with its
+        timestamp, or None if the backend has failed.
+        """
+
+        try:
+            # The transaction is never aborted without WATCH.
+            replies = self._check_replies(future.result()[-1])
+        except redis.exceptions.RedisError as ex:
+            score.record(time.time() - started_at, failed=True)
+            span.__exit__(type(ex), ex, None)
+            return None
+        score.record(time.time() - started_at)
+        span.__exit__(None, None, None)
+        return self._parse_version(replies)
+
+    def _get_latest_reply(
+        self,
+        data_key,
+        latest_data,
+        latest_timestamp,
+        holders,
+        copies,
+    ):
+        """
+        Handles the newest data found by the multiplexed read.
+        """
+
+        self._update_size(data_key, latest_data)
+        self._resolve_expired(data_key, latest_data, latest_timestamp, copies)
+        self._remember_locations(
+            data_key,
+            holders if latest_data is not None else [],
+        )
+        return latest_data
+
+    def _resolve_expired(self, data_key, data, timestamp, copies):
+        """
+        Deletes the older copies of the key if its newest version has
+        expired. Only the timestamp of the expired version is left, and the
+        copies are on the backends that have missed the deletion.
+        """
+
+        if data is not None or not timestamp:
+            return
+        outdated = [
+            shard_id
+            for shard_id, copy_timestamp in copies
+            if copy_timestamp < timestamp
+        ]
+        if outdated:
+            self._executor.submit(
+                self._delete_outdated,
+                outdated,
+                data_key,
+                timestamp,
+            )
+
+    def _delete_outdated(self, shard_ids, data_key, timestamp):
+        for shard_id in shard_ids:
+            self._write_replica(
+                shard_id,
+                data_key,
+                data_key + b":ts",
+                None,
+                timestamp,
+            )
+
+    def _locate(self, data_key, connections):
+        """
+        Narrows the connections down to the backends that hold the key
+        according to the directory, and the ones that the placement would
+        pick for a write now: another proxy might have written a newer
+        version there. Returns None if the key is unknown.
+        """
+
+        if (
+            self._directory is None or
+            # The reads of the hot keys are spread on purpose.
+            data_key in self._replicated_hot_keys
+        ):
+            return None
+        shard_ids = self._directory.get(data_key)
+        if shard_ids is None:
+            return None
+        if not any(shard_id in shard_ids for shard_id, _ in connections):
+            return None
+        placement = set(itertools.islice(
+            (
+                shard_id
+                for shard_id in self._load
+                if shard_id in self._connections
+            ),
+            self._replicaness,
+        ))
+        return [
+            (shard_id, connection)
+            for shard_id, connection in connections
+            if shard_id in shard_ids or shard_id in placement
+        ]
+
+    def _remember_locations(self, data_key, shard_ids):
+        # The empty list forgets the key.
+        if self._directory is not None:
+            self._directory.put(data_key, shard_ids)
+
+    def _is_learning(self, shard_id):
+        return not self._stopped and shard_id in self._connections
+
+    def _learn_locations(self, shard_id, connection):
+        """
+        Adds the keys of the backend to the directory. Runs in its own
+        thread.
+        """
+
+        count, cursor = 0, 0
+        try:
+            while self._is_learning(shard_id):
+                cursor, keys = self._scan_keys(connection, cursor, None, 1000)
+                for key in keys:
+                    self._directory.add(b"rc:" + key, shard_id)
+                count += len(keys)
+                cursor = int(cursor)
+                if not cursor:
+                    break
+            if self._buckets is not None:
+                for bucket_id in range(self._buckets.bucket_count):
+                    if not self._is_learning(shard_id):
+                        break
+                    keys = connection.hkeys(
+                        self._buckets.get_bucket_key(bucket_id),
+                    )
+                    for key in keys:
+                        self._directory.add(b"rc:" + key, shard_id)
+                    count += len(keys)
+        except redis.exceptions.ConnectionError as ex:
+            self._logger.warning(
+                "Could not read the keys of shard %s: %s",
+                shard_id,
+                ex,
+            )
+        self._logger.info(
+            "Directory has learned %d keys of shard %s.",
+            count,
+            shard_id,
+        )
+
+    def _get_read_connections(self, data_key):
+        """
+        Counts the key read if the hot keys are replicated and gets the
+        connections to read it from.
+        """
+
+        connections = self._ranked_connections()
+        if data_key in self._replicated_hot_keys:
+            # Spread the reads across the extra replicas.
+            connections = self._shuffle_healthy(connections)
+        if self._hot_key_threshold is None:
+            # Nothing acts on the counts, so the reads are not counted.
+            return connections
+        estimate = self._hot_keys.record(data_key)
+        if (
+            data_key not in self._replicated_hot_keys and
+            estimate >= self._hot_key_threshold
+        ):
+            self._replicate_hot_key(data_key)
+        return connections
+
+    def _get_latest(
+        self,
+        connections,
+        data_key,
+        timestamp_key,
+        trace,
+        deadline,
+    ):
+        """
+        Reads the data with the timestamps from the backends and returns
+        the newest data.
+        """
+
+        latest_timestamp, latest_data = 0, None
+        # Backends with the copies of the latest data.
+        holders = list()
+        # Versions of the found data.
+        copies = list()
+        # Number of the backends that have answered.
+        answered = 0
+        replies = self._read_replicas(
+            connections,
+            self._read_replica,
+            (data_key, timestamp_key, trace),
+            deadline,
+        )
+        try:
+            for reply in replies:
+                if reply is None:
+                    # Failed to get the value from this shard. It is failed -
+                    # just ignore it.
+                    continue
+                answered += 1
+                shard_id, data, timestamp = reply
+                if data is not None:
+                    copies.append((shard_id, timestamp))
+                if not latest_timestamp or latest_timestamp < timestamp:
+                    latest_data, latest_timestamp = data, timestamp
+                    holders = [shard_id] if timestamp else []
+                elif timestamp == latest_timestamp:
+                    holders.append(shard_id)
+                # All the replicas of the latest data are found.
+                if self._fast_reads and len(holders) >= self._replicaness:
+                    break
+        except concurrent.futures.TimeoutError:
+            self._check_timeout(latest_timestamp, answered, connections)
+        finally:
+            replies.close()
+
+        self._resolve_expired(data_key, latest_data, latest_timestamp, copies)
+        self._remember_locations(
+            data_key,
+            holders if latest_data is not None else [],
+        )
+        return latest_data
+
+    def _get_latest_two_phase(
+        self,
+        connections,
+        data_key,
+        timestamp_key,
+        trace,
+        deadline,
+    ):
+        """
+        Reads the timestamps from the backends, then the data from the
+        first backend that still has the newest version. Falls back to the
+        ordinary read if none of them does.
+        """
+
+        latest_timestamp = 0
+        # Backends with the latest timestamp, fastest first.
+        holders = list()
+        answered = 0
+        replies = self._read_replicas(
+            connections,
+            self._read_timestamp,
+            (data_key, timestamp_key, trace),
+            deadline,
+        )
+        try:
+            for reply in replies:
+                if reply is None:
+                    continue
+                answered += 1
+                shard_id, timestamp = reply
+                if latest_timestamp < timestamp:
+                    latest_timestamp, holders = timestamp, [shard_id]
+                elif timestamp and timestamp == latest_timestamp:
+                    holders.append(shard_id)
+                if self._fast_reads and len(holders) >= self._replicaness:
+                    break
+        except concurrent.futures.TimeoutError:
+            self._check_timeout(latest_timestamp, answered, connections)
+        finally:
+            replies.close()
+
+        if not latest_timestamp:
+            return None
+        self._remember_locations(data_key, holders)
+        connection_map = dict(connections)
+        for shard_id in holders:
+            reply = self._read_replica_until(
+                shard_id,
+                connection_map[shard_id],
+                data_key,
+                timestamp_key,
+                trace,
+                deadline,
+            )
+            # The version might be deleted or replaced by a newer one.
+            if reply is not None and reply[2] >= latest_timestamp:
+                return reply[1]
+        return self._get_latest(
+            connections,
+            data_key,
+            timestamp_key,
+            trace,
+            deadline,
+        )
+
+    def _check_timeout(self, latest_timestamp, answered, connections):
+        """
+        Handles the expired read. Raises ShardTimeoutError unless the
+        newest value is found or the key is missing for sure.
+        """
+
+        with self._counters_lock:
+            self._timeouts += 1
+        # The key is missing for sure only if it is missing on more
+        # backends than can be left without a replica.
+        if not latest_timestamp and (
+            not answered or
+            answered <= len(connections) - self._replicaness
+        ):
+            raise rcluster.shard.exceptions.ShardTimeoutError(
+                "%d of %d backends have answered in time."
+                % (answered, len(connections)),
+            )
+
+    def _update_size(self, data_key, data):
+        """
+        Remembers whether the key holds a large value.
+        """
+
+        threshold = self._large_value_threshold
+        if threshold is None:
+            return
+        if data is not None and len(data) >= threshold:
+            self._sizes.put(data_key, len(data))
+        else:
+            self._sizes.discard(data_key)
+
+    def _read_replica(
+        self,
+        shard_id,
+        connection,
+        data_key,
+        timestamp_key,
+        trace=rcluster.tracing.NULL_TRACE,
+    ):
+        """
+        Reads the data and its timestamp from the backend. Returns the shard
+        ID, the data and the timestamp, or None if the backend is failed.
+        """
+
+        score, started_at = self._scores[shard_id], time.time()
+        try:
+            with trace.span("backend", shard_id, "get"):
+                replies = self._execute_read(
+                    shard_id,
+                    connection,
+                    self._get_read_commands(data_key, timestamp_key),
+                )
+        except redis.exceptions.RedisError:
+            # Either the backend or the key is broken.
+            score.record(time.time() - started_at, failed=True)
+            return None
+        score.record(time.time() - started_at)
+        return (shard_id, ) + self._parse_version(replies)
+
+    def _execute_read(self, shard_id, connection, commands):
+        """
+        Runs the read commands in a transaction, through the multiplexed
+        connection if there is one. Returns the replies.
+        """
+
+        multiplexer = self._multiplexers.get(shard_id)
+        if multiplexer is not None:
+            return self._check_replies(multiplexer.execute(
+                *([(b"MULTI", )] + commands + [(b"EXEC", )])
+            ).result()[-1])
+        with connection.pipeline(transaction=True) as pipeline:
+            for command in commands:
+                pipeline.execute_command(*command)
+            return self._check_replies(pipeline.execute())
+
+    def _check_replies(self, replies):
+        """
+        Raises the error of the first failed command of the transaction.
+        Returns the replies otherwise.
+        """
+
+        if replies is None:
+            raise redis.exceptions.WatchError("Transaction is aborted.")
+        for reply in replies:
+            if isinstance(reply, redis.exceptions.RedisError):
+                raise reply
+        return replies
+
+    def _get_read_commands(self, data_key, timestamp_key, with_data=True):
+        """
+        Gets the commands that read the data, its timestamp and the bucket
+        field of the key.
+        """
+
+        commands = [(b"GET", data_key)] if with_data else []
+        commands.append((b"GET", timestamp_key))
+        if self._buckets is not None:
+            commands.append((b"HGET", ) + self._buckets.locate(data_key))
+        return commands
+
+    def _parse_version(self, replies):
+        """
+        Gets the newest data and its timestamp from the replies of the read
+        commands.
+        """
+
+        data, timestamp = replies[:2]
+        # Timestamp might not be set for the first time.
+        timestamp = (timestamp and int(timestamp)) or 0
+        if self._buckets is not None:
+            bucket_timestamp, bucket_data = self._buckets.unpack(replies[2])
+            if bucket_timestamp > timestamp:
+                return bucket_data, bucket_timestamp
+        return data, timestamp
+
+    def _read_replica_until(
+        self,
+        shard_id,
+        connection,
+        data_key,
+        timestamp_key,
+        trace,
+        deadline,
+    ):
+        """
+        Reads the data and its timestamp from the backend within the
+        deadline. Raises ShardTimeoutError once the deadline expires.
+        """
+
+        if deadline is None:
+            return self._read_replica(
+                shard_id,
+                connection,
+                data_key,
+                timestamp_key,
+                trace,
+            )
+        try:
+            return self._executor.submit(
+                self._read_replica,
+                shard_id,
+                connection,
+                data_key,
+                timestamp_key,
+                trace,
+            ).result(timeout=max(deadline - time.time(), 0.0))
+        except concurrent.futures.TimeoutError:
+            with self._counters_lock:
+                self._timeouts += 1
+            raise rcluster.shard.exceptions.ShardTimeoutError(
+                "Data is not read in time.",
+            )
+
+    def _read_timestamp(
+        self,
+        shard_id,
+        connection,
+        data_key,
+        timestamp_key,
+        trace=rcluster.tracing.NULL_TRACE,
+    ):
+        """
+        Reads the timestamp of the data from the backend. Returns None if
+        the backend is failed.
+        """
+
+        score, started_at = self._scores[shard_id], time.time()
+        try:
+            with trace.span("backend", shard_id, "version"):
+                replies = self._execute_read(
+                    shard_id,
+                    connection,
+                    self._get_read_commands(
+                        data_key,
+                        timestamp_key,
+                        with_data=False,
+                    ),
+                )
+        except redis.exceptions.RedisError:
+            score.record(time.time() - started_at, failed=True)
+            return None
+        score.record(time.time() - started_at)
+        return shard_id, self._parse_version([None] + replies)[1]
+
+    def _read_replicas(self, connections, read, arguments, deadline):
+        """
+        Reads the backends one by one, or all in parallel if there is
+        a deadline.
+        """
+
+        if deadline is None:
+            return (
+                read(shard_id, connection, *arguments)
+                for shard_id, connection in connections
+            )
+        return self._read_replicas_until(
+            connections,
+            read,
+            arguments,
+            deadline,
+        )
+
+    def _read_replicas_until(self, connections, read, arguments, deadline):
+        """
+        Reads all the backends in parallel and yields the replies as they
+        arrive. Raises TimeoutError once the deadline expires.
+        """
+
+        futures = [
+            self._executor.submit(read, shard_id, connection, *arguments)
+            for shard_id, connection in connections
+        ]
+        try:
+            for future in concurrent.futures.as_completed(
+                futures,
+                timeout=max(deadline - time.time(), 0.0),
+            ):
+                yield future.result()
+        finally:
+            # Abandon the reads that have not started yet. The running ones
+            # complete in the background.
+            for future in futures:
+                future.cancel()
+
+    def set(self, key, data, write_concern=None, timeout=None, ttl=None):
+        """
+        Sets the specified key. Returns the number of the replicas that have
+        acknowledged the write. With the TTL in seconds every replica expires
+        at the same time.
+
+        If the write concern is given, the method returns as soon as this
+        number of replicas (at most the replicaness) acknowledge the write,
+        and the rest of the writes complete in the background.
+
+        The writes are made within the timeout in seconds (the deadline is
+        used by default). When it expires, the rest of the writes complete
+        in the background and ShardTimeoutError is raised unless the write
+        concern is already satisfied.
+        """
+
+        if write_concern is None:
+            write_concern = self._write_concern
+        if timeout is None:
+            timeout = self._deadline
+        deadline = None if timeout is None else time.time() + timeout
+        data_key, timestamp_key = self._wrap_key(key)
+        timestamp = self._timestamp()
+        expire_at = None if ttl is None else self._get_expire_at(ttl)
+        trace = self._get_active_trace()
+        self._update_size(data_key, data)
+        # Find available shards from the least busy.
+        shard_ids = iter([
+            shard_id
+            for shard_id in self._load
+            # Check that the connection is still available.
+            if shard_id in self._connections
+        ])
+
+        # Replicas counter - we need replicaness keys set with this
+        # timestamp. Hot keys have the extra replicas.
+        replicaness = self._replicaness
+        if write_concern is not None:
+            write_concern = min(write_concern, replicaness)
+        if data_key in self._replicated_hot_keys:
+            replicaness += self._hot_key_replicas
+        replicas_left = replicaness
+        # The write that has not completed in time.
+        pending = None
+        # Backends that have acknowledged the write.
+        holders = list()
+        for shard_id in shard_ids:
+            # The rest of the shards only get the old data deleted.
+            set_key = replicas_left != 0
+            arguments = (
+                shard_id,
+                data_key,
+                timestamp_key,
+                data if set_key else None,
+                timestamp,
+                trace,
+                deadline,
+                expire_at,
+            )
+            if deadline is None:
+                written = self._write_replica(*arguments)
+            else:
+                future = self._executor.submit(self._write_replica, *arguments)
+                try:
+                    written = future.result(
+                        timeout=max(deadline - time.time(), 0.0),
+                    )
+                except concurrent.futures.TimeoutError:
+                    # The write to this backend completes in the background.
+                    pending, written = future, False
+            if written and set_key:
+                # We set the replica.
+                replicas_left -= 1
+                holders.append(shard_id)
+            acknowledged = replicaness - replicas_left
+            if write_concern is not None and acknowledged >= write_concern:
+                break
+            if pending is not None:
+                break
+        else:
+            # All writes are done.
+            self._remember_locations(data_key, holders)
+            return replicaness - replicas_left
+
+        self._remember_locations(data_key, holders)
+
+        # Complete the rest of the writes in the background.
+        remainder = (
+            shard_ids,
+            data_key,
+            timestamp_key,
+            data,
+            timestamp,
+            replicas_left,
+            expire_at,
+        )
+        if pending is None:
+            self._executor.submit(self._write_remainder, *remainder)
+        else:
+            # The remainder waits for the timed-out write without taking a
+            # worker.
+            pending.add_done_callback(
+                lambda future: self._executor.submit(
+                    self._write_remainder,
+                    *remainder,
+                    pending=future
+                ),
+            )
+        if pending is not None:
+            with self._counters_lock:
+                self._timeouts += 1
+            if (
+                replicas_left if write_concern is None
+                else acknowledged < write_concern
+            ):
+                raise rcluster.shard.exceptions.ShardTimeoutError(
+                    "%d replicas are written in time." % acknowledged,
+                    acknowledged=acknowledged,
+                )
+        return acknowledged
+
+    def _write_remainder(
+        self,
+        shard_ids,
+        data_key,
+        timestamp_key,
+        data,
+        timestamp,
+        replicas_left,
+        expire_at=None,
+        pending=None,
+    ):
+        """
+        Completes the write in the background. The pending write is the one
+        that has timed out: it counts as a replica once it succeeds.
+        """
+
+        if pending is not None:
+            if pending.exception() is None and pending.result():
+                if replicas_left:
+                    replicas_left -= 1
+            else:
+                with self._counters_lock:
+                    self._background_failures += 1
+        for shard_id in shard_ids:
+            set_key = replicas_left != 0
+            if self._write_replica(
+                shard_id,
+                data_key,
+                timestamp_key,
+                data if set_key else None,
+                timestamp,
+                expire_at=expire_at,
+            ):
+                if set_key:
+                    replicas_left -= 1
+            else:
+                with self._counters_lock:
+                    self._background_failures += 1
+
+    def _write_replica(
+        self,
+        shard_id,
+        data_key,
+        timestamp_key,
+        data,
+        timestamp,
+        trace=rcluster.tracing.NULL_TRACE,
+        deadline=None,
+        expire_at=None,
+    ):
+        """
+        Writes the data to the backend or deletes the key if the data is None.
+        The data expires at the expiry time in milliseconds if it is given.
+        Newer data on the backend is left intact. Concurrent modifications
+        are retried until the deadline expires.
+
+        Returns whether the backend has stored the write: False if it holds
+        newer data.
+        """
+
+        connection = self._connections.get(shard_id)
+        if connection is None:
+            return False
+        score, started_at = self._scores[shard_id], time.time()
+        try:
+            with trace.span("backend", shard_id, "set"), \
+                    connection.pipeline(transaction=True) as pipeline:
+                while True:
+                    try:
+                        pipeline.watch(
+                            *self._get_watched_keys(data_key, timestamp_key)
+                        )
+                        current_timestamp = self._get_current_timestamp(
+                            pipeline,
+                            data_key,
+                            timestamp_key,
+                        )
+                        pipeline.multi()
+
+                        written = current_timestamp <= timestamp
+                        if written:
+                            key_count = self._queue_write(
+                                pipeline,
+                                data_key,
+                                timestamp_key,
+                                data,
+                                timestamp,
+                                expire_at,
+                            )
+
+                        pipeline.execute()
+                        if written and data is not None:
+                            # Keep the placement up to date until the next
+                            # sample.
+                            self._load.add(shard_id, key_count, len(data))
+                    except redis.exceptions.WatchError:
+                        if deadline is not None and time.time() >= deadline:
+                            # Give up, the write is replayed later.
+                            self._add_hint(
+                                shard_id,
+                                data_key,
+                                timestamp_key,
+                                data,
+                                timestamp,
+                                expire_at,
+                            )
+                            return False
+                        # Other rcluster.shard has modified the key - retry.
+                        continue
+                    else:
+                        break
+        except redis.exceptions.ConnectionError as ex:
+            self._logger.debug(str(ex))
+            score.record(time.time() - started_at, failed=True)
+            # Skip failed target, but remember to write it later.
+            self._add_hint(
+                shard_id,
+                data_key,
+                timestamp_key,
+                data,
+                timestamp,
+                expire_at,
+            )
+            return False
+        else:
+            score.record(time.time() - started_at)
+            return written
+
+    def _get_watched_keys(self, data_key, timestamp_key):
+        if self._buckets is None:
+            return [data_key, timestamp_key]
+        return [
+            data_key,
+            timestamp_key,
+            self._buckets.locate(data_key)[0],
+        ]
+
+    def _get_current_timestamp(self, pipeline, data_key, timestamp_key):
+        """
+        Reads the timestamp of the data stored on the backend. The pipeline
+        must be watching the keys.
+        """
+
+        # Timestamp might not be set for the first time.
+        timestamp = pipeline.get(timestamp_key)
+        timestamp = (timestamp and int(timestamp)) or 0
+        if self._buckets is not None:
+            bucket_timestamp, _ = self._buckets.unpack(
+                pipeline.hget(*self._buckets.locate(data_key)),
+            )
+            timestamp = max(timestamp, bucket_timestamp)
+        return timestamp
+
+    def _queue_write(
+        self,
+        pipeline,
+        data_key,
+        timestamp_key,
+        data,
+        timestamp,
+        expire_at=None,
+    ):
+        """
+        Queues the replacement of the stored data in the transaction: the
+        small data goes to its bucket, the rest to the top-level keys. The
+        None data only deletes the stored data. Returns the number of the
+        added top-level keys.
+        """
+
+        # Delete old data.
+        pipeline.delete(data_key, timestamp_key)
+        if self._buckets is not None:
+            bucket_key, field = self._buckets.locate(data_key)
+            pipeline.hdel(bucket_key, field)
+        if data is None:
+            return 0
+        # Hash fields cannot expire, so the expiring data is kept in the
+        # top-level keys.
+        if (
+            expire_at is None and
+            self._buckets is not None and
+            self._buckets.fits(data_key, data)
+        ):
+            pipeline.hset(
+                bucket_key,
+                field,
+                self._buckets.pack(timestamp, data),
+            )
+            return 0
+        pipeline.set(data_key, data)
+        pipeline.set(timestamp_key, timestamp)
+        if expire_at is not None:
+            # The same expiry time on every replica. The timestamp is left
+            # as the tombstone of the expired data.
+            pipeline.pexpireat(data_key, expire_at)
+            pipeline.pexpireat(
+                timestamp_key,
+                expire_at + int(Cluster.TOMBSTONE_TTL * 1000),
+            )
+        return 2
+
+    def _add_hint(
+        self,
+        shard_id,
+        data_key,
+        timestamp_key,
+        data,
+        timestamp,
+        expire_at=None,
+    ):
+        """
+        Remembers the missed write to replay it to the backend later.
+        """
+
+        hints = self._hints.get(shard_id)
+        if hints is not None:
+            hints.add(rcluster.shard.handoff.Hint(
+                data_key,
+                timestamp_key,
+                data,
+                timestamp,
+                expire_at,
+            ))
+
+    def _on_handoff_timer(self):
+        """
+        Replays the missed writes to the backends.
+        """
+
+        for shard_id, hints in self._hints.items():
+            if len(hints) and shard_id not in self._replaying:
+                self._replaying.add(shard_id)
+                self._executor.submit(self._replay_hints, shard_id, hints)
+
+    def _replay_hints(self, shard_id, hints):
+        """
+        Replays the missed writes to the backend if it is available.
+        """
+
+        replayed_count = 0
+        try:
+            connection = self._connections.get(shard_id)
+            if connection is None:
+                return
+            connection.ping()
+            while True:
+                batch = hints.peek(Cluster.HANDOFF_BATCH_SIZE)
+                if not batch:
+                    break
+                if not self._replay_batch(connection, batch):
+                    # The keys are being modified - retry on the next timer.
+                    break
+                hints.remove(batch)
+                replayed_count += len(batch)
+        except redis.exceptions.ConnectionError:
+            # The backend is still unavailable.
+            pass
+        except:
+            self._logger.error(traceback.format_exc())
+        finally:
+            self._replaying.discard(shard_id)
+            if replayed_count:
+                self._logger.info(
+                    "Replayed %d hints to shard %s.",
+                    replayed_count,
+                    shard_id,
+                )
+
+    def _replay_batch(self, connection, batch):
+        """
+        Writes the batch of hints in a single transaction. Newer data on the
+        backend is left intact.
+
+        The transaction is retried with a backoff while the keys are
+        modified, then the batch is split in halves to isolate the contended
+        keys. Returns False if a hint could not be written.
+        """
+
+        timestamp_keys = [hint.timestamp_key for hint in batch]
+        watched_keys = set(timestamp_keys)
+        if self._buckets is not None:
+            watched_keys.update(
+                self._buckets.locate(hint.data_key)[0]
+                for hint in batch
+            )
+        with connection.pipeline(transaction=True) as pipeline:
+            for attempt in range(Cluster.HANDOFF_ATTEMPTS):
+                try:
+                    pipeline.watch(*watched_keys)
+                    current_timestamps = pipeline.mget(timestamp_keys)
+                    if self._buckets is not None:
+                        # The buckets are read one by one while watching.
+                        current_timestamps = [
+                            max(
+                                (current_timestamp and int(current_timestamp))
+                                or 0,
+                                self._buckets.unpack(pipeline.hget(
+                                    *self._buckets.locate(hint.data_key)
+                                ))[0],
+                            )
+                            for hint, current_timestamp in zip(
+                                batch,
+                                current_timestamps,
+                            )
+                        ]
+                    pipeline.multi()
+                    for hint, current_timestamp in zip(
+                        batch,
+                        current_timestamps,
+                    ):
+                        current_timestamp = (
+                            current_timestamp and int(current_timestamp)
+                        ) or 0
+                        if current_timestamp > hint.timestamp:
+                            continue
+                        # The expired data is deleted at once.
+                        self._queue_write(
+                            pipeline,
+                            hint.data_key,
+                            hint.timestamp_key,
+                            hint.data,
+                            hint.timestamp,
+                            hint.expire_at,
+                        )
+                    pipeline.execute()
+                except redis.exceptions.WatchError:
+                    # Other rcluster.shard has modified the keys - retry.
+                    time.sleep(random.uniform(
+                        0,
+                        Cluster.HANDOFF_BACKOFF * 2 ** attempt,
+                    ))
+                else:
+                    return True
+        if len(batch) == 1:
+            return False
+        middle = len(batch) // 2
+        return (
+            self._replay_batch(connection, batch[:middle]) and
+            self._replay_batch(connection, batch[middle:])
+        )
+
+    def get_versions(self, keys):
+        """
+        Gets the newest timestamp, data and time to live in seconds of every
+        key with a single pipeline per backend. Missing keys get zero
+        timestamp and None data, expired keys get None data. The time to
+        live is None for the keys that do not expire.
+        """
+
+        versions = [(0, None, None)] * len(keys)
+        wrapped_keys = [self._wrap_key(key) for key in keys]
+
+        # Number of the replies per key: the read commands and PTTL.
+        stride = 3 if self._buckets is None else 4
+
+        for shard_id, connection in self._ranked_connections():
+            with connection.pipeline(transaction=True) as pipeline:
+                for data_key, timestamp_key in wrapped_keys:
+                    for command in self._get_read_commands(
+                        data_key,
+                        timestamp_key,
+                    ):
+                        pipeline.execute_command(*command)
+                    pipeline.pttl(data_key)
+                try:
+                    values = self._check_replies(pipeline.execute())
+                except redis.exceptions.RedisError:
+                    # The backend is failed - just ignore it.
+                    continue
+            for index, (timestamp, _, _) in enumerate(versions):
+                replies = values[stride * index:stride * (index + 1)]
+                ttl = replies.pop()
+                new_data, new_timestamp = self._parse_version(replies)
+                # The expired version has a timestamp without data.
+                if timestamp < new_timestamp:
+                    # Only the top-level data expires.
+                    expires = (
+                        ttl >= 0 and
+                        new_timestamp == int(replies[1] or 0)
+                    )
+                    versions[index] = (
+                        new_timestamp,
+                        new_data,
+                        ttl / 1000.0 if expires else None,
+                    )
+
+        return versions
+
+    def load(self, records):
+        """
+        Writes the (key, timestamp, data, TTL) records directly to the least
+        busy backends with a single pipeline per backend. The TTL is in
+        seconds, None if the key does not expire. Intended for seeding the
+        cluster: the existing copies of the keys are neither checked nor
+        deleted. Raises ShardConnectionError if there are no backends.
+        """
+
+        # Backends from the least loaded.
+        loads = [
+            entry
+            for entry in self._load.get_entries()
+            if entry[-1] in self._connections
+        ]
+        if not loads:
+            raise rcluster.shard.exceptions.ShardConnectionError(
+                "No backends to load the keys to.",
+            )
+        replicaness = min(self._replicaness, len(loads))
+        pipelines, written = dict(), dict()
+
+        try:
+            for key, timestamp, data, ttl in records:
+                data_key, timestamp_key = self._wrap_key(key)
+                expire_at = None if ttl is None else self._get_expire_at(ttl)
+                targets = [heapq.heappop(loads) for _ in range(replicaness)]
+                for used_memory, db_size, shard_id in targets:
+                    pipeline = pipelines.get(shard_id)
+                    if pipeline is None:
+                        pipeline = pipelines[shard_id] = self._connections[
+                            shard_id
+                        ].pipeline(transaction=False)
+                    if (
+                        expire_at is None and
+                        self._buckets is not None and
+                        self._buckets.fits(data_key, data)
+                    ):
+                        bucket_key, field = self._buckets.locate(data_key)
+                        pipeline.hset(
+                            bucket_key,
+                            field,
+                            self._buckets.pack(timestamp, data),
+                        )
+                        added_keys = 0
+                    else:
+                        pipeline.set(data_key, data)
+                        pipeline.set(timestamp_key, timestamp)
+                        if expire_at is not None:
+                            pipeline.pexpireat(data_key, expire_at)
+                            pipeline.pexpireat(
+                                timestamp_key,
+                                expire_at + int(Cluster.TOMBSTONE_TTL * 1000),
+                            )
+                        # Data and timestamp keys.
+                        added_keys = 2
+                    heapq.heappush(
+                        loads,
+                        (
+                            used_memory + len(data),
+                            db_size + added_keys,
+                            shard_id,
+                        ),
+                    )
+                    key_count, byte_count = written.get(shard_id, (0, 0))
+                    written[shard_id] = (
+                        key_count + added_keys,
+                        byte_count + len(data),
+                    )
+
+            for shard_id, pipeline in pipelines.items():
+                pipeline.execute()
+                self._load.add(shard_id, *written[shard_id])
+        finally:
+            for pipeline in pipelines.values():
+                pipeline.reset()
+
+    def scan(self, cursor=0, match=None, count=None):
+        """
+        Incrementally iterates over the keys of all the backends. Returns the
+        next cursor and the keys. Zero cursor starts and ends the iteration.
+
+        Every call scans a single page of a single backend, so the keys may
+        be empty while the cursor is not zero yet. The backends are walked
+        in the order of the hashes of their shard IDs, and the cursor holds
+        the hash of the current one, so adding or removing a backend does
+        not shift the others. A key stored on several backends is returned
+        from the first of them only, so nothing is kept in memory between
+        the calls. With the small value buckets, the buckets of every backend
+        are walked after all the backends are scanned.
+        """
+
+        # The composite cursor holds the backend hash in its lower bits,
+        # then the bucket phase bit, then the backend cursor.
+        shard_hash = cursor & Cluster.SCAN_HASH_MASK
+        in_buckets = bool(cursor >> Cluster.SCAN_HASH_BITS & 1)
+        backend_cursor = cursor >> (Cluster.SCAN_HASH_BITS + 1)
+        shards = sorted(
+            (zlib.crc32(shard_id), shard_id, connection)
+            for shard_id, connection in list(self._connections.items())
+        )
+        hashes = [shard_hash for shard_hash, _, _ in shards]
+
+        # Continue with the next backend if the current one is removed.
+        index = bisect.bisect_left(hashes, shard_hash)
+        if index == len(shards) or hashes[index] != shard_hash:
+            backend_cursor = 0
+        if index == len(shards):
+            if in_buckets or self._buckets is None or not shards:
+                return 0, []
+            in_buckets, index = True, 0
+
+        _, shard_id, connection = shards[index]
+        try:
+            if not in_buckets:
+                backend_cursor, keys = self._scan_keys(
+                    connection,
+                    backend_cursor,
+                    match,
+                    count,
+                )
+            else:
+                # The bucket ID is the backend cursor.
+                backend_cursor, keys = self._scan_buckets(
+                    connection,
+                    backend_cursor,
+                    match,
+                    count,
+                )
+            keys = self._filter_owned_keys(
+                [shard_id for _, shard_id, _ in shards[:index]],
+                keys,
+            )
+        except redis.exceptions.ConnectionError as ex:
+            self._logger.warning(
+                "Skipping shard %s while scanning: %s",
+                shard_id,
+                ex,
+            )
+            backend_cursor, keys = 0, []
+
+        backend_cursor = int(backend_cursor)
+        if not backend_cursor:
+            # The backend is done, go to the next one.
+            index += 1
+            if index == len(shards):
+                if in_buckets or self._buckets is None:
+                    return 0, keys
+                in_buckets, index = True, 0
+        return (
+            backend_cursor << (Cluster.SCAN_HASH_BITS + 1) |
+            int(in_buckets) << Cluster.SCAN_HASH_BITS |
+            hashes[index]
+        ), keys
+
+    def _scan_keys(self, connection, cursor, match, count):
+        """
+        Scans the top-level keys of the backend. Returns the next backend
+        cursor and the keys.
+        """
+
+        # Every logical key has exactly one timestamp key on a backend.
+        cursor, timestamp_keys = connection.scan(
+            cursor,
+            match=b"rc:" + (match or b"*") + b":ts",
+            count=count,
+        )
+        if not timestamp_keys:
+            return cursor, []
+        # The pattern also matches the data keys of the keys that end with
+        # ":ts". Only a timestamp key has the data key.
+        with connection.pipeline(transaction=False) as pipeline:
+            for timestamp_key in timestamp_keys:
+                pipeline.exists(timestamp_key[:-3])
+            exists = pipeline.execute()
+        # Strip "rc:" and ":ts".
+        return cursor, [
+            timestamp_key[3:-3]
+            for timestamp_key, key_exists in zip(timestamp_keys, exists)
+            if key_exists
+        ]
+
+    def _scan_buckets(self, connection, bucket_id, match, count):
+        """
+        Reads the keys of the buckets starting from the specified one.
+        Returns the next bucket ID, zero once all the buckets are read, and
+        the keys.
+        """
+
+        bucket_count = self._buckets.bucket_count
+        end = min(bucket_id + (count or 10), bucket_count)
+        with connection.pipeline(transaction=False) as pipeline:
+            for next_id in range(bucket_id, end):
+                pipeline.hkeys(self._buckets.get_bucket_key(next_id))
+            buckets = pipeline.execute()
+        return end if end < bucket_count else 0, [
+            key
+            for keys in buckets
+            for key in keys
+            # Glob-style patterns just like the Redis SCAN.
+            if match is None or fnmatch.fnmatchcase(key, match)
+        ]
+
+    def _filter_owned_keys(self, shard_ids, keys):
+        """
+        Filters out the keys that exist on any of the specified backends.
+        """
+
+        for shard_id in shard_ids:
+            if not keys:
+                break
+            connection = self._connections.get(shard_id)
+            if connection is None:
+                continue
+            with connection.pipeline(transaction=False) as pipeline:
+                for key in keys:
+                    data_key, timestamp_key = self._wrap_key(key)
+                    pipeline.exists(timestamp_key)
+                    if self._buckets is not None:
+                        pipeline.hexists(*self._buckets.locate(data_key))
+                try:
+                    exists = pipeline.execute()
+                except redis.exceptions.ConnectionError:
+                    continue
+            if self._buckets is not None:
+                # Either the timestamp key or the bucket field.
+                exists = [
+                    exists[index] or exists[index + 1]
+                    for index in range(0, len(exists), 2)
+                ]
+            keys = [
+                key
+                for key, key_exists in zip(keys, exists)
+                if not key_exists
+            ]
+        return keys
+
+    def _replicate_hot_key(self, data_key):
+        """
+        Adds the extra replicas to the hot key in the background.
+        """
+
+        with self._hot_keys_lock:
+            if (
+                data_key in self._replicated_hot_keys or
+                len(self._replicated_hot_keys) >= self._hot_keys.capacity
+            ):
+                return
+            self._replicated_hot_keys.add(data_key)
+        self._logger.info("Key %s is hot.", self._unwrap_key(data_key))
+        self._executor.submit(
+            self._rebalance_key,
+            data_key,
+            self._replicaness + self._hot_key_replicas,
+        )
+
+    def _on_hot_keys_timer(self):
+        """
+        Decays the key access counts and removes the extra replicas of the
+        keys that have cooled down.
+        """
+
+        self._hot_keys.decay()
+        with self._hot_keys_lock:
+            replicated_hot_keys = list(self._replicated_hot_keys)
+        for data_key in replicated_hot_keys:
+            # The key stays hot until its read count falls well below the
+            # threshold, so that it does not flap. The count falls to zero
+            # at least.
+            if (
+                self._hot_key_threshold is None or
+                self._hot_keys.estimate(data_key) <
+                max(self._hot_key_threshold // 2, 1)
+            ):
+                self._logger.info(
+                    "Key %s has cooled down.",
+                    self._unwrap_key(data_key),
+                )
+                with self._hot_keys_lock:
+                    self._replicated_hot_keys.discard(data_key)
+                self._executor.submit(
+                    self._rebalance_key,
+                    data_key,
+                    self._replicaness,
+                )
+
+    def _rebalance_key(self, data_key, replicaness):
+        """
+        Copies the newest value of the key to the least busy backends or
+        removes the redundant copies from the busiest ones, so that the key
+        has the specified number of the replicas.
+        """
+
+        timestamp_key = data_key + b":ts"
+        latest_timestamp, latest_data, expire_at, holders = self._find_holders(
+            data_key,
+            timestamp_key,
+        )
+        if latest_data is None:
+            # The key is deleted.
+            return
+
+        by_load = list(self._load)
+        if len(holders) < replicaness:
+            for shard_id in by_load:
+                if len(holders) >= replicaness:
+                    break
+                if shard_id not in holders and self._write_replica(
+                    shard_id,
+                    data_key,
+                    timestamp_key,
+                    latest_data,
+                    latest_timestamp,
+                    expire_at=expire_at,
+                ):
+                    holders.append(shard_id)
+        else:
+            for shard_id in reversed(by_load):
+                if len(holders) <= replicaness:
+                    break
+                # Newer data is left intact.
+                if shard_id in holders and self._write_replica(
+                    shard_id,
+                    data_key,
+                    timestamp_key,
+                    None,
+                    latest_timestamp,
+                ):
+                    holders.remove(shard_id)
+        self._remember_locations(data_key, holders)
+
+    def _find_holders(self, data_key, timestamp_key):
+        """
+        Reads the key from every backend. Returns the newest timestamp, its
+        data and expiry time in milliseconds (None if it does not expire),
+        and the backends that hold this version. The data of the expired
+        version is None.
+        """
+
+        latest_timestamp, latest_data, expire_at = 0, None, None
+        holders = list()
+        commands = self._get_read_commands(data_key, timestamp_key)
+        commands.append((b"PTTL", data_key))
+        for shard_id, connection in list(self._connections.items()):
+            try:
+                replies = self._execute_read(shard_id, connection, commands)
+            except redis.exceptions.RedisError:
+                continue
+            ttl = replies.pop()
+            data, timestamp = self._parse_version(replies)
+            if timestamp > latest_timestamp:
+                latest_timestamp, latest_data = timestamp, data
+                # Negative for the keys without expiry and the buckets.
+                expire_at = (
+                    self._get_expire_at(ttl / 1000.0) if ttl >= 0 else None
+                )
+                holders = [shard_id]
+            elif timestamp and timestamp == latest_timestamp:
+                holders.append(shard_id)
+        return latest_timestamp, latest_data, expire_at, holders
+
+    def _find_timestamp_holders(self, data_key, timestamp_key):
+        """
+        Reads the timestamp and the remaining time to live of the key from
+        every backend in parallel, without the top-level data. Returns the
+        newest timestamp, the time to live of its data in milliseconds (-1
+        if it does not expire, -2 if it is expired or missing), the mapping
+        of the backends that hold this version to the small value if it is
+        kept in a bucket, and the backends that hold older versions.
+        """
+
+        commands = self._get_read_commands(
+            data_key,
+            timestamp_key,
+            with_data=False,
+        )
+        commands.append((b"PTTL", data_key))
+        futures = [
+            (
+                shard_id,
+                self._executor.submit(
+                    self._execute_read,
+                    shard_id,
+                    connection,
+                    commands,
+                ),
+            )
+            for shard_id, connection in list(self._connections.items())
+        ]
+
+        latest_timestamp, latest_ttl = 0, -2
+        holders, stale = dict(), list()
+        for shard_id, future in futures:
+            try:
+                replies = future.result()
+            except redis.exceptions.RedisError:
+                continue
+            ttl = replies.pop()
+            # Only the bucket data is read.
+            bucket_data, timestamp = self._parse_version([None] + replies)
+            if bucket_data is not None:
+                # Hash fields cannot expire.
+                ttl = -1
+            if timestamp > latest_timestamp:
+                stale.extend(holders)
+                latest_timestamp, latest_ttl = timestamp, ttl
+                holders = {shard_id: bucket_data}
+            elif timestamp and timestamp == latest_timestamp:
+                holders[shard_id] = bucket_data
+            elif timestamp:
+                stale.append(shard_id)
+        return latest_timestamp, latest_ttl, holders, stale
+
+    def expire(self, key, ttl):
+        """
+        Sets every replica of the newest version of the key to expire after
+        the TTL in seconds. Returns whether the key exists.
+        """
+
+        data_key, timestamp_key = self._wrap_key(key)
+        latest_timestamp, latest_ttl, holders, stale = (
+            self._find_timestamp_holders(data_key, timestamp_key)
+        )
+        if latest_ttl == -2:
+            return False
+        expire_at = self._get_expire_at(ttl)
+        futures = [
+            self._executor.submit(
+                self._expire_replica,
+                shard_id,
+                data_key,
+                timestamp_key,
+                latest_timestamp,
+                bucket_data,
+                expire_at,
+            )
+            for shard_id, bucket_data in holders.items()
+        ]
+        # The older copies are deleted, so that they do not outlive the key.
+        futures.extend(
+            self._executor.submit(
+                self._write_replica,
+                shard_id,
+                data_key,
+                timestamp_key,
+                None,
+                latest_timestamp,
+            )
+            for shard_id in stale
+        )
+        concurrent.futures.wait(futures)
+        return True
+
+    def _expire_replica(
+        self,
+        shard_id,
+        data_key,
+        timestamp_key,
+        timestamp,
+        bucket_data,
+        expire_at,
+    ):
+        """
+        Sets the version of the key on the backend to expire at the expiry
+        time in milliseconds. The small value moves from its bucket to the
+        top-level keys. A newer version on the backend is left intact.
+        Returns whether the expiry is set.
+        """
+
+        if bucket_data is not None:
+            return self._write_replica(
+                shard_id,
+                data_key,
+                timestamp_key,
+                bucket_data,
+                timestamp,
+                expire_at=expire_at,
+            )
+        connection = self._connections.get(shard_id)
+        if connection is None:
+            return False
+        score, started_at = self._scores[shard_id], time.time()
+        try:
+            with connection.pipeline(transaction=True) as pipeline:
+                pipeline.watch(
+                    *self._get_watched_keys(data_key, timestamp_key)
+                )
+                if self._get_current_timestamp(
+                    pipeline,
+                    data_key,
+                    timestamp_key,
+                ) != timestamp:
+                    score.record(time.time() - started_at)
+                    return False
+                pipeline.multi()
+                pipeline.pexpireat(data_key, expire_at)
+                pipeline.pexpireat(
+                    timestamp_key,
+                    expire_at + int(Cluster.TOMBSTONE_TTL * 1000),
+                )
+                pipeline.execute()
+        except redis.exceptions.WatchError:
+            # The version is replaced by a newer write.
+            score.record(time.time() - started_at)
+            return False
+        except redis.exceptions.ConnectionError as ex:
+            self._logger.debug(str(ex))
+            score.record(time.time() - started_at, failed=True)
+            return False
+        score.record(time.time() - started_at)
+        return True
+
+    def ttl(self, key):
+        """
+        Gets the time to live of the key in seconds: -1 if the key does not
+        expire, -2 if it does not exist.
+        """
+
+        data_key, timestamp_key = self._wrap_key(key)
+        _, latest_ttl, _, _ = self._find_timestamp_holders(
+            data_key,
+            timestamp_key,
+        )
+        if latest_ttl < 0:
+            return latest_ttl
+        return latest_ttl / 1000.0
+
+    def _shuffle_healthy(self, connections):
+        """
+        Shuffles the healthy connections keeping the failing ones last.
+        """
+
+        # A backend removed in the meantime has no score and goes last.
+        scores = self._scores
+        healthy = [
+            (shard_id, connection)
+            for shard_id, connection in connections
+            if shard_id in scores and scores[shard_id].healthy
+        ]
+        random.shuffle(healthy)
+        return healthy + [
+            (shard_id, connection)
+            for shard_id, connection in connections
+            if (shard_id, connection) not in healthy
+        ]
+
+    def _ranked_connections(self):
+        """
+        Gets the connections from the healthiest and fastest backend.
+        """
+
+        # The connections and the scores are replaced together.
+        with self._shards_lock:
+            connections, scores = self._connections, self._scores
+        return sorted(
+            connections.items(),
+            key=lambda item: scores[item[0]].rank,
+        )
+
+    def _wrap_key(self, key):
+        if isinstance(key, str):
+            key = bytes(key, "utf-8")
+        rc_key = b"rc:" + key
+        return rc_key, rc_key + b":ts"
+
+    def _unwrap_key(self, data_key):
+        # Strip "rc:".
+        return data_key[3:]
+
+    def _timestamp(self):
+        """
+        Gets the current timestamp.
+        """
+
+        return int(time.time() * 1000000)
+
+    def _get_expire_at(self, ttl):
+        """
+        Gets the expiry time in milliseconds after the TTL in seconds.
+        """
+
+        return int((time.time() + ttl) * 1000)
+
+    def _get_active_trace(self):
+        if self._tracer is None:
+            return rcluster.tracing.NULL_TRACE
+        return self._tracer.active
+
+
+def _without(mapping, key):
+    """
+    Copies the mapping without the key.
+    """
+
+    return dict(item for item in mapping.items() if item[0] != key)
+
+
+class _Scheduler:
+    """
+    Runs the cluster callbacks on a background thread when there is no IO
+    loop to run them on.
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger("rcluster.shard.cluster._Scheduler")
+        self._condition = threading.Condition()
+        # (due time, sequence number, periodic callback) heap.
+        self._timers = list()
+        self._sequence = itertools.count()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run_timers,
+            name="rcluster-cluster",
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def add_callback(self, callback):
+        # A callback is a periodic one that stops after the first call.
+        self._schedule(_PeriodicCallback(callback, 0.0, once=True))
+
+    def add_periodic_callback(self, callback, interval):
+        periodic_callback = _PeriodicCallback(callback, interval)
+        self._schedule(periodic_callback)
+        return periodic_callback
+
+    def _schedule(self, periodic_callback):
+        with self._condition:
+            heapq.heappush(self._timers, (
+                time.time() + periodic_callback.interval,
+                next(self._sequence),
+                periodic_callback,
+            ))
+            self._condition.notify()
+
+    def _run_timers(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (
+                    not self._timers or self._timers[0][0] > time.time()
+                ):
+                    self._condition.wait(
+                        self._timers[0][0] - time.time()
+                        if self._timers else None
+                    )
+                if self._stopped:
+                    return
+                _, _, periodic_callback = heapq.heappop(self._timers)
+            if periodic_callback.stopped:
+                continue
+            try:
+                periodic_callback.callback()
+            except:
+                self._logger.error(traceback.format_exc())
+            if periodic_callback.once:
+                continue
+            self._schedule(periodic_callback)
+
+
+class _PeriodicCallback:
+    def __init__(self, callback, interval, once=False):
+        self.callback = callback
+        self.interval = interval
+        self.once = once
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Key location directory.
+"""
+
+import array
+import threading
+import zlib
+
+
+class KeyDirectory:
+    """
+    Remembers which backends hold the keys in the fixed memory.
+
+    The table is split into sets of WAYS entries chosen by the key hash.
+    An entry is the 32-bit CRC32 fingerprint of the key and up to
+    LOCATIONS one-byte backend indexes, kept in flat arrays: about eight
+    bytes per key. A full set replaces its entries in turn. A rare
+    fingerprint collision only costs the broadcast read, so the directory
+    is a hint rather than the truth. Safe to use from any thread.
+    """
+
+    WAYS = 8
+    LOCATIONS = 4
+    # Backend index 0 marks a free location.
+    MAX_SHARDS = 255
+    # Locations cleared from the removed backends per update.
+    SWEEP_STEP = 256
+
+    def __init__(self, capacity):
+        set_count = 1
+        while set_count * KeyDirectory.WAYS < capacity:
+            set_count <<= 1
+        self._lock = threading.Lock()
+        self._mask = set_count - 1
+        self._fingerprints = array.array("I", [0]) * (
+            set_count * KeyDirectory.WAYS
+        )
+        self._locations = array.array("B", [0]) * (
+            set_count * KeyDirectory.WAYS * KeyDirectory.LOCATIONS
+        )
+        self._size = 0
+        # Round-robin replacement in the full sets.
+        self._victim = 0
+        self._indexes = dict()
+        self._shard_ids = [None] * (KeyDirectory.MAX_SHARDS + 1)
+        # Indexes of the removed backends that are still referenced.
+        self._stale_indexes = set()
+        # Stale indexes being cleared, and the next location to clear.
+        self._sweeping = set()
+        self._sweep_offset = 0
+        # Indexes that are not referenced anymore.
+        self._free_indexes = list()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return len(self._fingerprints)
+
+    def get(self, key):
+        """
+        Gets the IDs of the backends that hold the key. Returns None if the
+        key is unknown.
+        """
+
+        with self._lock:
+            slot = self._find(key, self._fingerprint(key))
+            if slot is None:
+                return None
+            start = slot * KeyDirectory.LOCATIONS
+            shard_ids = [
+                self._shard_ids[index]
+                for index in self._locations[
+                    start:start + KeyDirectory.LOCATIONS
+                ]
+                if index and self._shard_ids[index] is not None
+            ]
+        return shard_ids or None
+
+    def put(self, key, shard_ids):
+        """
+        Sets the backends that hold the key. The empty list forgets the
+        key.
+        """
+
+        if not shard_ids:
+            self.discard(key)
+            return
+        with self._lock:
+            indexes = [
+                self._get_index(shard_id)
+                for shard_id in shard_ids[:KeyDirectory.LOCATIONS]
+            ]
+            slot = self._allocate(key)
+            start = slot * KeyDirectory.LOCATIONS
+            for offset in range(KeyDirectory.LOCATIONS):
+                self._locations[start + offset] = (
+                    indexes[offset] if offset < len(indexes) else 0
+                )
+            self._sweep()
+
+    def add(self, key, shard_id):
+        """
+        Adds the backend to the ones that hold the key.
+        """
+
+        with self._lock:
+            self._sweep()
+            index = self._get_index(shard_id)
+            slot = self._allocate(key)
+            start = slot * KeyDirectory.LOCATIONS
+            locations = self._locations[start:start + KeyDirectory.LOCATIONS]
+            if index in locations:
+                return
+            for offset, current in enumerate(locations):
+                if not current or self._shard_ids[current] is None:
+                    self._locations[start + offset] = index
+                    return
+
+    def discard(self, key):
+        with self._lock:
+            slot = self._find(key, self._fingerprint(key))
+            if slot is None:
+                return
+            self._fingerprints[slot] = 0
+            self._size -= 1
+
+    def remove_shard(self, shard_id):
+        """
+        Forgets the backend. Its index is reused once the updates have
+        cleared its locations, or when no other index is left.
+        """
+
+        with self._lock:
+            index = self._indexes.pop(shard_id, None)
+            if index is not None:
+                self._shard_ids[index] = None
+                self._stale_indexes.add(index)
+
+    def _fingerprint(self, key):
+        # Zero marks a free entry.
+        return zlib.crc32(key) or 1
+
+    def _find(self, key, fingerprint):
+        start = (hash(key) & self._mask) * KeyDirectory.WAYS
+        for slot in range(start, start + KeyDirectory.WAYS):
+            if self._fingerprints[slot] == fingerprint:
+                return slot
+        return None
+
+    def _allocate(self, key):
+        """
+        Gets the entry of the key, a free one or the replaced one.
+        """
+
+        fingerprint = self._fingerprint(key)
+        slot = self._find(key, fingerprint)
+        if slot is not None:
+            return slot
+        start = (hash(key) & self._mask) * KeyDirectory.WAYS
+        for slot in range(start, start + KeyDirectory.WAYS):
+            if not self._fingerprints[slot]:
+                self._size += 1
+                break
+        else:
+            slot = start + self._victim % KeyDirectory.WAYS
+            self._victim += 1
+        self._fingerprints[slot] = fingerprint
+        location = slot * KeyDirectory.LOCATIONS
+        for offset in range(KeyDirectory.LOCATIONS):
+            self._locations[location + offset] = 0
+        return slot
+
+    def _get_index(self, shard_id):
+        index = self._indexes.get(shard_id)
+        if index is not None:
+            return index
+        used = (
+            len(self._indexes) + len(self._stale_indexes) +
+            len(self._sweeping) + len(self._free_indexes)
+        )
+        if used < KeyDirectory.MAX_SHARDS:
+            index = used + 1
+        elif self._free_indexes:
+            index = self._free_indexes.pop()
+        elif self._stale_indexes or self._sweeping:
+            # The remaining locations of the removed backend point to this
+            # one. The reads compare them with the placement, so they cost
+            # a miss at most.
+            index = (self._stale_indexes or self._sweeping).pop()
+        else:
+            raise ValueError("Too many backends.")
+        self._indexes[shard_id] = index
+        self._shard_ids[index] = shard_id
+        return index
+
+    def _sweep(self):
+        """
+        Clears the next locations of the removed backends. The indexes are
+        freed once all the locations are cleared.
+        """
+
+        if not self._sweeping:
+            if not self._stale_indexes:
+                return
+            self._sweeping, self._stale_indexes = self._stale_indexes, set()
+            self._sweep_offset = 0
+        end = min(
+            self._sweep_offset + KeyDirectory.SWEEP_STEP,
+            len(self._locations),
+        )
+        for offset in range(self._sweep_offset, end):
+            if self._locations[offset] in self._sweeping:
+                self._locations[offset] = 0
+        self._sweep_offset = end
+        if end == len(self._locations):
+            self._free_indexes.extend(self._sweeping)
+            self._sweeping = set()
@@ -8,3 +8,15 @@ class ShardConnectionError(Exception):
     """
 
     pass
+
+
+class ShardTimeoutError(Exception):
+    """
+    The deadline has expired before the backends answered.
+    """
+
+    def __init__(self, message, acknowledged=0):
+        super(ShardTimeoutError, self).__init__(message)
+
+        # Number of the replicas written in time.
+        self.acknowledged = acknowledged
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Hinted handoff: the writes missed by unavailable backends.
+"""
+
+import collections
+import logging
+import os
+import struct
+import threading
+
+
+class Hint:
+    """
+    Missed write. None data stands for deletion. The data expires at the
+    expiry time in milliseconds unless it is None.
+    """
+
+    __slots__ = ("data_key", "timestamp_key", "data", "timestamp", "expire_at")
+
+    def __init__(
+        self,
+        data_key,
+        timestamp_key,
+        data,
+        timestamp,
+        expire_at=None,
+    ):
+        self.data_key = data_key
+        self.timestamp_key = timestamp_key
+        self.data = data
+        self.timestamp = timestamp
+        self.expire_at = expire_at
+
+
+class HintQueue:
+    """
+    Bounded queue of the writes missed by a single backend. Only the newest
+    write is kept for every key. The queue can be backed by an append-only
+    file to survive restarts.
+    """
+
+    # Timestamp, data key length, timestamp key length, data length.
+    _HEADER = struct.Struct(">QIII")
+    # Data length of a deletion.
+    _NO_DATA = 0xFFFFFFFF
+    # Data length flag: the expiry time follows the data.
+    _EXPIRES = 0x80000000
+    _EXPIRE_AT = struct.Struct(">Q")
+
+    def __init__(self, capacity=65536, path=None):
+        self._logger = logging.getLogger("rcluster.shard.handoff.HintQueue")
+        self._capacity = capacity
+        self._path = path
+        self._lock = threading.Lock()
+        self._hints = collections.OrderedDict()
+        self._dropped = 0
+        self._file = None
+        self._file_records = 0
+
+        if path is not None:
+            self._load()
+            self._file = open(path, "ab")
+
+    @property
+    def dropped(self):
+        """
+        Number of the hints dropped because the queue was full. Non-zero
+        means that the backend needs a full re-sync.
+        """
+
+        return self._dropped
+
+    def __len__(self):
+        return len(self._hints)
+
+    def add(self, hint):
+        """
+        Adds the hint unless there is a newer one for the same key.
+        """
+
+        with self._lock:
+            if not self._put(hint):
+                return
+            if self._file is not None:
+                self._write(self._file, hint)
+                self._file_records += 1
+                if self._file_records > 2 * self._capacity:
+                    self._compact()
+
+    def peek(self, count):
+        """
+        Gets up to count oldest hints without removing them.
+        """
+
+        with self._lock:
+            return [
+                hint for hint, _ in zip(self._hints.values(), range(count))
+            ]
+
+    def remove(self, hints):
+        """
+        Removes the replayed hints. Hints replaced by newer ones are kept.
+        """
+
+        with self._lock:
+            for hint in hints:
+                if self._hints.get(hint.data_key) is hint:
+                    del self._hints[hint.data_key]
+            if not self._hints and self._file is not None:
+                # Everything is replayed, the file is not needed anymore.
+                self._file.truncate(0)
+                self._file_records = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _put(self, hint):
+        existing = self._hints.get(hint.data_key)
+        if existing is not None:
+            if existing.timestamp > hint.timestamp:
+                return False
+            del self._hints[hint.data_key]
+        self._hints[hint.data_key] = hint
+        if len(self._hints) > self._capacity:
+            self._hints.popitem(last=False)
+            self._dropped += 1
+        return True
+
+    def _load(self):
+        """
+        Loads the hints from the file.
+        """
+
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, "rb") as hints_file:
+            while True:
+                header = hints_file.read(HintQueue._HEADER.size)
+                if len(header) < HintQueue._HEADER.size:
+                    break
+                timestamp, data_key_length, timestamp_key_length, \
+                    data_length = HintQueue._HEADER.unpack(header)
+                data_key = hints_file.read(data_key_length)
+                timestamp_key = hints_file.read(timestamp_key_length)
+                expire_at = None
+                if data_length == HintQueue._NO_DATA:
+                    data = None
+                else:
+                    expires = data_length & HintQueue._EXPIRES
+                    data_length &= ~HintQueue._EXPIRES
+                    data = hints_file.read(data_length)
+                    if len(data) < data_length:
+                        # The last record is not written completely.
+                        break
+                    if expires:
+                        expire_at = hints_file.read(
+                            HintQueue._EXPIRE_AT.size,
+                        )
+                        if len(expire_at) < HintQueue._EXPIRE_AT.size:
+                            break
+                        expire_at, = HintQueue._EXPIRE_AT.unpack(expire_at)
+                self._put(Hint(
+                    data_key,
+                    timestamp_key,
+                    data,
+                    timestamp,
+                    expire_at,
+                ))
+                self._file_records += 1
+        self._logger.info(
+            "Loaded %d hints from %s.",
+            len(self._hints),
+            self._path,
+        )
+
+    def _compact(self):
+        """
+        Rewrites the file with the queued hints only.
+        """
+
+        self._file.close()
+        compacted_path = self._path + ".compact"
+        with open(compacted_path, "wb") as compacted_file:
+            for hint in self._hints.values():
+                self._write(compacted_file, hint)
+        os.rename(compacted_path, self._path)
+        self._file = open(self._path, "ab")
+        self._file_records = len(self._hints)
+
+    def _write(self, hints_file, hint):
+        if hint.data is None:
+            data_length = HintQueue._NO_DATA
+        elif hint.expire_at is None:
+            data_length = len(hint.data)
+        else:
+            data_length = len(hint.data) | HintQueue._EXPIRES
+        hints_file.write(HintQueue._HEADER.pack(
+            hint.timestamp,
+            len(hint.data_key),
+            len(hint.timestamp_key),
+            data_length,
+        ))
+        hints_file.write(hint.data_key)
+        hints_file.write(hint.timestamp_key)
+        if hint.data is not None:
+            hints_file.write(hint.data)
+            if hint.expire_at is not None:
+                hints_file.write(HintQueue._EXPIRE_AT.pack(hint.expire_at))
+        hints_file.flush()
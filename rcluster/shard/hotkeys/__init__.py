@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Key access frequency tracking.
+"""
+
+import array
+import threading
+import zlib
+
+
+class CountMinSketch:
+    """
+    Estimates the key frequencies in the fixed memory. The estimates are
+    never lower than the real counts.
+    """
+
+    def __init__(self, width=4096, depth=4):
+        self._width = width
+        self._depth = depth
+        self._counters = array.array("L", [0]) * (width * depth)
+
+    def add(self, key, count=1):
+        """
+        Counts the key. Returns the new estimate.
+        """
+
+        indexes = self._get_indexes(key)
+        counters = self._counters
+        estimate = min(counters[index] for index in indexes) + count
+        # Conservative update: only the counters below the new estimate
+        # are raised.
+        for index in indexes:
+            if counters[index] < estimate:
+                counters[index] = estimate
+        return estimate
+
+    def estimate(self, key):
+        return min(self._counters[index] for index in self._get_indexes(key))
+
+    def decay(self):
+        """
+        Halves all the counters, so that old accesses fade out.
+        """
+
+        self._counters = array.array(
+            "L",
+            (counter >> 1 for counter in self._counters),
+        )
+
+    def _get_indexes(self, key):
+        # Double hashing: the rows use different combinations of two key
+        # hashes. CRC-32 is not salted per process unlike hash(), so the
+        # estimates do not depend on the process.
+        first = zlib.crc32(key) & 0xFFFFFFFF
+        second = zlib.crc32(key, first) | 1
+        width = self._width
+        return [
+            row * width + (first + row * second) % width
+            for row in range(self._depth)
+        ]
+
+
+class HotKeyTracker:
+    """
+    Keeps the most frequently accessed keys. Safe to use from any thread.
+    """
+
+    def __init__(self, capacity=32, width=4096, depth=4):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._sketch = CountMinSketch(width, depth)
+        # Top keys with their estimates.
+        self._top = dict()
+        # Lowest estimate in the top keys.
+        self._floor = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def record(self, key):
+        """
+        Counts the key access. Returns the estimated access count.
+        """
+
+        with self._lock:
+            estimate = self._sketch.add(key)
+            if key in self._top:
+                self._top[key] = estimate
+            elif len(self._top) < self._capacity:
+                self._top[key] = estimate
+                self._update_floor()
+            elif estimate > self._floor:
+                # Replace the coldest key.
+                del self._top[min(self._top, key=self._top.__getitem__)]
+                self._top[key] = estimate
+                self._update_floor()
+        return estimate
+
+    def estimate(self, key):
+        with self._lock:
+            return self._sketch.estimate(key)
+
+    def top(self, count=None):
+        """
+        Gets the hottest keys with their estimated access counts.
+        """
+
+        with self._lock:
+            keys = sorted(self._top.items(), key=lambda item: -item[1])
+        return keys if count is None else keys[:count]
+
+    def decay(self):
+        with self._lock:
+            self._sketch.decay()
+            for key, estimate in list(self._top.items()):
+                if estimate > 1:
+                    self._top[key] = estimate >> 1
+                else:
+                    del self._top[key]
+            self._update_floor()
+
+    def _update_floor(self):
+        self._floor = min(self._top.values()) if self._top else 0
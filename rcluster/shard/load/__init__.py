@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Backend load metrics.
+"""
+
+import bisect
+import threading
+
+
+class BackendLoad:
+    """
+    Load metrics of a backend sampled from INFO and DBSIZE.
+    """
+
+    __slots__ = ("db_size", "used_memory", "ops_per_sec")
+
+    def __init__(self, db_size=0, used_memory=0, ops_per_sec=0):
+        self.db_size = db_size
+        self.used_memory = used_memory
+        self.ops_per_sec = ops_per_sec
+
+    def __repr__(self):
+        return "BackendLoad(db_size=%s, used_memory=%s, ops_per_sec=%s)" % (
+            self.db_size,
+            self.used_memory,
+            self.ops_per_sec,
+        )
+
+    def format(self):
+        return bytes(
+            "keys=%d,used_memory=%d,ops_per_sec=%d" % (
+                self.db_size,
+                self.used_memory,
+                self.ops_per_sec,
+            ),
+            "ascii",
+        )
+
+
+class LoadIndex:
+    """
+    Keeps the backends sorted from the least loaded: by the used memory,
+    then by the number of keys. Every update moves a single entry. Safe to
+    use from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loads = dict()
+        # Sorted (used_memory, db_size, shard_id) entries.
+        self._entries = list()
+
+    def __len__(self):
+        return len(self._loads)
+
+    def __iter__(self):
+        """
+        Iterates over the shard IDs from the least loaded backend.
+        """
+
+        with self._lock:
+            shard_ids = [entry[-1] for entry in self._entries]
+        return iter(shard_ids)
+
+    def get(self, shard_id):
+        return self._loads.get(shard_id)
+
+    def get_entries(self):
+        """
+        Gets the copy of the sorted (used_memory, db_size, shard_id) entries.
+        """
+
+        with self._lock:
+            return list(self._entries)
+
+    def update(self, shard_id, load):
+        """
+        Sets the sampled load of the backend.
+        """
+
+        with self._lock:
+            self._remove_entry(shard_id)
+            self._loads[shard_id] = load
+            bisect.insort(
+                self._entries,
+                (load.used_memory, load.db_size, shard_id),
+            )
+
+    def add(self, shard_id, key_count, byte_count):
+        """
+        Accounts for the data written since the last sample.
+        """
+
+        with self._lock:
+            load = self._loads.get(shard_id)
+            if load is None:
+                return
+            self._remove_entry(shard_id)
+            load = self._loads[shard_id] = BackendLoad(
+                load.db_size + key_count,
+                load.used_memory + byte_count,
+                load.ops_per_sec,
+            )
+            bisect.insort(
+                self._entries,
+                (load.used_memory, load.db_size, shard_id),
+            )
+
+    def remove(self, shard_id):
+        with self._lock:
+            self._remove_entry(shard_id)
+            self._loads.pop(shard_id, None)
+
+    def _remove_entry(self, shard_id):
+        load = self._loads.get(shard_id)
+        if load is None:
+            return
+        index = bisect.bisect_left(
+            self._entries,
+            (load.used_memory, load.db_size, shard_id),
+        )
+        del self._entries[index]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Multiplexed backend connections.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+
+import redis.exceptions
+
+import rcluster.shared
+
+
+class Multiplexer:
+    """
+    Sends the commands of all the callers to the backend over a fixed
+    number of connections. The requests queued while a connection is busy
+    are written with a single call, and the replies are routed back in
+    order. Safe to use from any thread.
+    """
+
+    def __init__(self, connection_pool, connection_count=2, max_batch=256):
+        self._logger = logging.getLogger("rcluster.shard.multiplex")
+        self._connection_pool = connection_pool
+        self._max_batch = max_batch
+        self._condition = threading.Condition()
+        # Pending (commands, future) requests.
+        self._queue = collections.deque()
+        self._closed = False
+        self._batches = 0
+        self._requests = 0
+        self._threads = list()
+        for index in range(connection_count):
+            thread = threading.Thread(
+                target=self._run,
+                name="rcluster-multiplex-%d" % index,
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def connection_count(self):
+        return len(self._threads)
+
+    @property
+    def batches(self):
+        """
+        Number of the writes to the backend.
+        """
+
+        return self._batches
+
+    @property
+    def requests(self):
+        return self._requests
+
+    def execute(self, *commands):
+        """
+        Queues the commands to be sent together. Returns the future of the
+        list of their replies.
+        """
+
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._closed:
+                raise redis.exceptions.ConnectionError(
+                    "Multiplexer is closed.",
+                )
+            self._queue.append((commands, future))
+            self._condition.notify()
+        return future
+
+    def close(self):
+        """
+        Closes the connections. The pending requests fail.
+        """
+
+        with self._condition:
+            self._closed = True
+            pending, self._queue = self._queue, collections.deque()
+            self._condition.notify_all()
+        for _, future in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(redis.exceptions.ConnectionError(
+                    "Multiplexer is closed.",
+                ))
+
+    def _run(self):
+        connection = self._connection_pool.make_connection()
+        try:
+            while True:
+                with self._condition:
+                    while not self._queue and not self._closed:
+                        self._condition.wait()
+                    if self._closed:
+                        break
+                    batch = [
+                        self._queue.popleft()
+                        for _ in range(min(len(self._queue), self._max_batch))
+                    ]
+                batch = [
+                    (commands, future)
+                    for commands, future in batch
+                    # Skip the cancelled requests.
+                    if future.set_running_or_notify_cancel()
+                ]
+                if batch:
+                    self._send(connection, batch)
+        finally:
+            connection.disconnect()
+
+    def _send(self, connection, batch):
+        self._batches += 1
+        self._requests += len(batch)
+        try:
+            connection.send_packed_command(b"".join(
+                rcluster.shared.encode_request(command)
+                for commands, _ in batch
+                for command in commands
+            ))
+            for commands, future in batch:
+                replies, error = list(), None
+                for _ in commands:
+                    try:
+                        replies.append(connection.read_response())
+                    except redis.exceptions.ResponseError as ex:
+                        # Keep reading the replies of the other commands.
+                        replies.append(ex)
+                        error = error or ex
+                if error is None:
+                    future.set_result(replies)
+                else:
+                    future.set_exception(error)
+        except Exception as ex:
+            # The replies can not be matched to the requests anymore.
+            connection.disconnect()
+            self._logger.debug("Connection is failed: %s", ex)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
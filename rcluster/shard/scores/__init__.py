@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Backend response time and error rate tracking.
+"""
+
+import collections
+import math
+
+
+class BackendScore:
+    """
+    Exponentially weighted moving averages of the backend response time and
+    error rate.
+    """
+
+    # The backend is considered unhealthy above this error rate.
+    UNHEALTHY_ERROR_RATE = 0.5
+
+    def __init__(self, alpha=0.2, window=256):
+        self._alpha = alpha
+        self._latency = None
+        self._error_rate = 0.0
+        # Recent response times for percentiles.
+        self._latencies = collections.deque(maxlen=window)
+
+    @property
+    def latency(self):
+        """
+        Average response time in seconds. None if it is not known yet.
+        """
+
+        return self._latency
+
+    @property
+    def error_rate(self):
+        return self._error_rate
+
+    @property
+    def healthy(self):
+        return self._error_rate < BackendScore.UNHEALTHY_ERROR_RATE
+
+    @property
+    def rank(self):
+        """
+        Sorting key: healthy backends go first, then the faster ones. Unknown
+        backends are tried first to learn their response time.
+        """
+
+        return (not self.healthy, self._latency or 0.0)
+
+    def record(self, latency, failed=False):
+        """
+        Records the backend call.
+        """
+
+        self._error_rate += self._alpha * (
+            (1.0 if failed else 0.0) - self._error_rate
+        )
+        if not failed:
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += self._alpha * (latency - self._latency)
+            self._latencies.append(latency)
+
+    def percentile(self, percent):
+        """
+        Gets the response time percentile over the recent calls. None if there
+        were no calls.
+        """
+
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        index = int(math.ceil(percent / 100.0 * len(latencies))) - 1
+        return latencies[max(0, min(index, len(latencies) - 1))]
+
+    def format(self):
+        """
+        Formats the score into a byte string.
+        """
+
+        return bytes(
+            "latency=%s,p99=%s,errors=%.3f,healthy=%d" % (
+                _format_latency(self._latency),
+                _format_latency(self.percentile(99)),
+                self._error_rate,
+                self.healthy,
+            ),
+            "ascii",
+        )
+
+
+def _format_latency(latency):
+    return "-" if latency is None else "%.3fms" % (latency * 1000.0)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Value size hints.
+"""
+
+import collections
+import threading
+
+
+class SizeHints:
+    """
+    Remembers the sizes of the recently seen large values. The least
+    recently used keys are forgotten first. Safe to use from any thread.
+    """
+
+    def __init__(self, capacity=65536):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._sizes = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._sizes)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def get(self, key):
+        """
+        Gets the last seen size of the value. Returns None if the key is
+        unknown.
+        """
+
+        with self._lock:
+            size = self._sizes.get(key)
+            if size is not None:
+                self._sizes.move_to_end(key)
+            return size
+
+    def put(self, key, size):
+        with self._lock:
+            self._sizes[key] = size
+            self._sizes.move_to_end(key)
+            if len(self._sizes) > self._capacity:
+                self._sizes.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._sizes.pop(key, None)
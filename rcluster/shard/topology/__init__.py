@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cluster topology shared by the proxies through the backends.
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+import traceback
+
+import redis.exceptions
+
+import rcluster.shared
+
+
+class TopologyRegistry:
+    """
+    Publishes the shards and the replicaness of this proxy to every backend
+    and applies the changes made by other proxies.
+
+    Every backend keeps the registry hash (shard ID to address), the hash
+    of the removed shards and the replicaness with its timestamp. A change
+    is announced on the pub/sub channel, and the registry is also polled
+    periodically, so a missed notification is applied within the poll
+    interval. The registered shards that cannot be connected are retried
+    less and less often.
+    """
+
+    REGISTRY_KEY = b"rcluster:topology"
+    REMOVED_KEY = b"rcluster:topology:removed"
+    REPLICANESS_KEY = b"rcluster:topology:replicaness"
+    CHANNEL = b"rcluster:topology"
+    # How often the listener checks whether it is stopped, in seconds.
+    LISTEN_TIMEOUT = 1.0
+    # Longest delay between the connection attempts, in seconds.
+    MAX_RETRY_INTERVAL = 300.0
+
+    def __init__(self, shard, interval=5.0):
+        self._logger = logging.getLogger(
+            "rcluster.shard.topology.TopologyRegistry",
+        )
+        self._shard = shard
+        self._interval = interval
+        # Publishing and polling are serialized.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._replicaness_timestamp = 0
+        self._polling = False
+        # Shards being connected.
+        self._pending = set()
+        # Address to the number of the failed attempts and the time of the
+        # next one.
+        self._failures = dict()
+        self._stopped = threading.Event()
+        self._listener = None
+
+    def start(self, seeds=()):
+        """
+        Connects to the seed backends and starts following the topology.
+        """
+
+        for host, port_number, db in seeds:
+            self._add_shard(host, port_number, db)
+        self._shard.add_periodic_callback(self.refresh, self._interval)
+        self._listener = threading.Thread(
+            target=self._listen,
+            name="rcluster-topology",
+        )
+        self._listener.daemon = True
+        self._listener.start()
+
+    def stop(self):
+        """
+        Stops following the topology. The listener ends within
+        LISTEN_TIMEOUT.
+        """
+
+        self._stopped.set()
+
+    @property
+    def listener(self):
+        return self._listener
+
+    def publish(self, replicaness_changed=False, added=(), removed=()):
+        """
+        Publishes the topology of this proxy. The added shard IDs are no
+        longer marked as removed, and the removed ones are marked so that
+        the other proxies drop them too.
+        """
+
+        shards = dict(
+            (
+                shard_id,
+                bytes(rcluster.shared.format_address(address), "utf-8"),
+            )
+            for shard_id, address, _, _ in self._shard.get_shards()
+        )
+        replicaness = None
+        if replicaness_changed:
+            self._replicaness_timestamp = int(time.time() * 1000000)
+            replicaness = bytes(
+                "%d:%d" % (
+                    self._replicaness_timestamp,
+                    self._shard.replicaness,
+                ),
+                "ascii",
+            )
+        removed = dict(
+            (shard_id, bytes(str(int(time.time())), "ascii"))
+            for shard_id in removed
+        )
+        self._executor.submit(
+            self._publish,
+            shards,
+            replicaness,
+            list(added),
+            removed,
+        )
+
+    def refresh(self):
+        """
+        Polls the registry and applies the changes.
+        """
+
+        if self._polling:
+            return
+        self._polling = True
+        self._executor.submit(self._poll).add_done_callback(
+            lambda future: self._shard.add_callback(
+                lambda: self._on_polled(future),
+            ),
+        )
+
+    def _publish(self, shards, replicaness, added, removed):
+        for shard_id, connection in self._shard.connections.items():
+            try:
+                with connection.pipeline(transaction=False) as pipeline:
+                    if removed:
+                        pipeline.hdel(TopologyRegistry.REGISTRY_KEY, *removed)
+                        pipeline.hmset(TopologyRegistry.REMOVED_KEY, removed)
+                    if added:
+                        pipeline.hdel(TopologyRegistry.REMOVED_KEY, *added)
+                    if shards:
+                        pipeline.hmset(TopologyRegistry.REGISTRY_KEY, shards)
+                    if replicaness is not None:
+                        pipeline.set(
+                            TopologyRegistry.REPLICANESS_KEY,
+                            replicaness,
+                        )
+                    pipeline.publish(TopologyRegistry.CHANNEL, b"changed")
+                    pipeline.execute()
+            except redis.exceptions.ConnectionError as ex:
+                self._logger.warning(
+                    "Could not publish the topology to shard %s: %s",
+                    shard_id,
+                    ex,
+                )
+
+    def _poll(self):
+        """
+        Reads the registry from every backend.
+        """
+
+        shards, removed = dict(), set()
+        replicaness_timestamp, replicaness = 0, None
+        for connection in self._shard.connections.values():
+            try:
+                with connection.pipeline(transaction=False) as pipeline:
+                    pipeline.hgetall(TopologyRegistry.REGISTRY_KEY)
+                    pipeline.hkeys(TopologyRegistry.REMOVED_KEY)
+                    pipeline.get(TopologyRegistry.REPLICANESS_KEY)
+                    registry, removed_ids, replicaness_value = (
+                        pipeline.execute()
+                    )
+            except redis.exceptions.ConnectionError:
+                continue
+            shards.update(registry)
+            removed.update(removed_ids)
+            if replicaness_value:
+                timestamp, value = map(int, replicaness_value.split(b":"))
+                if timestamp > replicaness_timestamp:
+                    replicaness_timestamp, replicaness = timestamp, value
+        return shards, removed, replicaness_timestamp, replicaness
+
+    def _on_polled(self, future):
+        """
+        Applies the polled topology on the IO loop.
+        """
+
+        self._polling = False
+        try:
+            shards, removed, replicaness_timestamp, replicaness = (
+                future.result()
+            )
+        except:
+            self._logger.error(traceback.format_exc())
+            return
+
+        if replicaness_timestamp > self._replicaness_timestamp:
+            self._replicaness_timestamp = replicaness_timestamp
+            if replicaness != self._shard.replicaness:
+                self._logger.info("Replicaness is set to %d.", replicaness)
+                self._shard.replicaness = replicaness
+
+        known_shards = self._shard.connections
+        for shard_id in removed:
+            if shard_id in known_shards:
+                self._logger.info("Shard %s is removed.", shard_id)
+                self._shard.remove_shard(shard_id)
+        for shard_id, address in shards.items():
+            if shard_id in known_shards or shard_id in removed:
+                continue
+            try:
+                host, port_number, db = rcluster.shared.parse_address(address)
+            except ValueError:
+                self._logger.warning("Invalid shard address: %s", address)
+                continue
+            self._add_shard(host, port_number, db, retry=True)
+
+    def _add_shard(self, host, port_number, db, retry=False):
+        """
+        Connects to the shard in the background. The retries of the failed
+        shards are delayed.
+        """
+
+        address = (host, port_number, db)
+        if address in self._pending:
+            return
+        if retry and self._failures.get(address, (0, 0))[1] > time.time():
+            return
+        self._pending.add(address)
+        self._shard.add_shard_async(host, port_number, db).add_done_callback(
+            lambda future: self._on_shard_added(address, future),
+        )
+
+    def _on_shard_added(self, address, future):
+        self._pending.discard(address)
+        if future.exception() is None:
+            self._failures.pop(address, None)
+            return
+        failure_count = self._failures.get(address, (0, 0))[0] + 1
+        retry_interval = min(
+            self._interval * 2 ** failure_count,
+            TopologyRegistry.MAX_RETRY_INTERVAL,
+        )
+        self._failures[address] = (
+            failure_count,
+            time.time() + retry_interval,
+        )
+        self._logger.warning(
+            "Could not connect to shard %s, retrying in %.0f seconds: %s",
+            rcluster.shared.format_address(address),
+            retry_interval,
+            future.exception(),
+        )
+
+    def _listen(self):
+        """
+        Listens to the topology notifications. Runs in its own thread.
+        """
+
+        while not self._stopped.is_set():
+            for shard_id, connection in self._shard.connections.items():
+                if self._stopped.is_set():
+                    return
+                try:
+                    self._listen_to(shard_id, connection)
+                except redis.exceptions.ConnectionError:
+                    # Try the next backend.
+                    continue
+            self._stopped.wait(self._interval)
+
+    def _listen_to(self, shard_id, connection):
+        """
+        Listens to the notifications on the backend until it is removed or
+        the registry is stopped.
+        """
+
+        pubsub = connection.pubsub()
+        try:
+            pubsub.subscribe(TopologyRegistry.CHANNEL)
+            while (
+                not self._stopped.is_set() and
+                shard_id in self._shard.connections
+            ):
+                message = pubsub.get_message(
+                    timeout=TopologyRegistry.LISTEN_TIMEOUT,
+                )
+                if message is not None and message["type"] == "message":
+                    self._shard.add_callback(self.refresh)
+        finally:
+            pubsub.close()
@@ -5,6 +5,77 @@
 Shared variables, functions and classes.
 """
 
+import concurrent.futures
+import threading
+
 
 # The default redis-shard port.
 DEFAULT_SHARD_PORT = 6379
+
+
+def parse_address(value):
+    """
+    Parses "host:port[/db]" into a (host, port_number, db) tuple.
+    """
+
+    if isinstance(value, bytes):
+        value = str(value, "utf-8")
+    host, port_db = value.rsplit(":", 1)
+    port_number, db = port_db.split("/", 1) if "/" in port_db else (
+        port_db,
+        0,
+    )
+    return host, int(port_number), int(db)
+
+
+def format_address(address):
+    """
+    Formats the (host, port_number, db) tuple into "host:port/db".
+    """
+
+    return "%s:%d/%d" % address
+
+
+def encode_request(arguments):
+    """
+    Encodes the request in the unified request protocol.
+    """
+
+    chunks = [bytes("*%d\r\n" % len(arguments), "ascii")]
+    for argument in arguments:
+        if argument is None:
+            chunks.append(b"$-1\r\n")
+        else:
+            chunks.append(bytes("$%d\r\n" % len(argument), "ascii"))
+            chunks.append(argument)
+            chunks.append(b"\r\n")
+    return b"".join(chunks)
+
+
+def when_all(futures, callback):
+    """
+    Calls the callback with the futures once all of them are done. Returns
+    the future of the callback result.
+
+    The callback is called in the thread that completes the last future.
+    """
+
+    result = concurrent.futures.Future()
+    lock, pending = threading.Lock(), [len(futures)]
+
+    def on_done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        try:
+            result.set_result(callback(futures))
+        except Exception as ex:
+            result.set_exception(ex)
+
+    if futures:
+        for future in futures:
+            future.add_done_callback(on_done)
+    else:
+        on_done(None)
+    return result
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from rcluster.capture import Capture, read_capture, replay
+from rcluster.shared import encode_request
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self.path = os.path.join(self._directory, "requests.capture")
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_round_trip(self):
+        capture = Capture(self._directory)
+        capture.start("requests.capture")
+        self.assertRaises(RuntimeError, capture.start, "requests.capture")
+        capture.record(b"SET", [b"key", b"data"])
+        capture.record(b"CAPTURE", [b"STOP"])
+        capture.record(b"GET", [b"key"])
+        self.assertEqual(2, capture.stop())
+        self.assertFalse(capture.active)
+        self.assertRaises(RuntimeError, capture.stop)
+
+        with open(self.path, "rb") as capture_file:
+            records = list(read_capture(capture_file))
+        self.assertEqual(
+            [
+                encode_request([b"SET", b"key", b"data"]),
+                encode_request([b"GET", b"key"]),
+            ],
+            [request for _, request in records],
+        )
+        self.assertLessEqual(records[0][0], records[1][0])
+
+    def test_admin_commands(self):
+        capture = Capture(self._directory)
+        capture.start("requests.capture")
+        capture.record(b"ADDSHARD", [b"localhost", b"6379", b"0"])
+        capture.record(b"setreplicaness", [b"2"])
+        capture.record(b"SETWRITECONCERN", [b"1"])
+        capture.record(b"SETDEADLINE", [b"100"])
+        capture.record(b"SETTRACERATE", [b"1"])
+        capture.record(b"set", [b"key", b"data"])
+
+        self.assertEqual(1, capture.stop())
+
+    def test_file_name(self):
+        self.assertRaises(RuntimeError, Capture().start, "requests.capture")
+
+        capture = Capture(self._directory)
+        for name in ("", "../requests", "/tmp/requests", "a\\b", ".."):
+            self.assertRaises(ValueError, capture.start, name)
+        self.assertFalse(capture.active)
+
+    def test_max_size(self):
+        capture = Capture(self._directory)
+        capture.start("requests.capture", max_size=64)
+        for _ in range(10):
+            capture.record(b"GET", [b"key"])
+
+        self.assertFalse(capture.active)
+        self.assertEqual(1, capture.recorded)
+
+    def test_read_invalid(self):
+        records = read_capture(io.BytesIO(b"*1\r\n$4\r\nPING\r\n"))
+        self.assertRaises(ValueError, list, records)
+
+    def test_encode_request(self):
+        self.assertEqual(
+            b"*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$-1\r\n",
+            encode_request([b"SET", b"key", None]),
+        )
+
+    def test_replay(self):
+        request = encode_request([b"PING"])
+        listener = socket.socket()
+        listener.bind(("localhost", 0))
+        listener.listen(2)
+
+        def serve():
+            connection, _ = listener.accept()
+            with connection:
+                while connection.recv(len(request)):
+                    connection.sendall(b"+PONG\r\n")
+
+        threads = [threading.Thread(target=serve) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        # The records are streamed from the generator.
+        records = ((0.0, request) for _ in range(10))
+        count, errors, _, latencies = replay(
+            listener.getsockname(),
+            records,
+            speed=0.0,
+            connection_count=2,
+        )
+        for thread in threads:
+            thread.join()
+        listener.close()
+
+        self.assertEqual(10, count)
+        self.assertEqual(0, errors)
+        self.assertEqual(10, len(latencies))
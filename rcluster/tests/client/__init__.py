@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import time
+import unittest
+
+import rcluster.client
+
+
+class TestClient(unittest.TestCase):
+    def test_set_get_key(self):
+        with rcluster.client.Client() as client:
+            client.add_shard("localhost", 6380, 0)
+
+            key, data = self._key(), os.urandom(32)
+            self.assertEqual(1, client.set(key, data))
+            self.assertEqual(data, client.get(key), "Data is not read.")
+
+    def test_seeds(self):
+        with rcluster.client.Client(seeds=[("localhost", 6380, 0)]) as client:
+            self.assertEqual(1, len(client.get_shards()))
+
+            key, data = self._key(), os.urandom(32)
+            self.assertEqual(1, client.set(key, data))
+            self.assertEqual(data, client.get(key), "Data is not read.")
+
+    def test_scan_iter(self):
+        with rcluster.client.Client() as client:
+            client.add_shard("localhost", 6380, 0)
+
+            prefix = self._key()
+            keys = set(
+                bytes("%s:%d" % (prefix, index), "ascii")
+                for index in range(10)
+            )
+            for key in keys:
+                client.set(key, b"data")
+            self.assertEqual(
+                keys,
+                set(client.scan_iter(match=bytes(prefix, "ascii") + b":*")),
+            )
+
+    def test_remove_shard(self):
+        with rcluster.client.Client(topology_interval=0.1) as client, \
+                rcluster.client.Client(
+                    seeds=[("localhost", 6380, 0)],
+                    topology_interval=0.1,
+                ) as other_client:
+            client.add_shard("localhost", 6380, 0)
+            shard_id = client.add_shard("localhost", 6380, 1)
+            self._wait(lambda: len(other_client.get_shards()) == 2)
+
+            client.remove_shard(shard_id)
+            self.assertEqual(1, len(client.get_shards()))
+            self._wait(lambda: len(other_client.get_shards()) == 1)
+
+        # The listener notices that it is stopped.
+        client.cluster.topology.listener.join(5.0)
+        self.assertFalse(client.cluster.topology.listener.is_alive())
+
+    def _wait(self, condition):
+        for _ in range(50):
+            if condition():
+                return
+            time.sleep(0.1)
+        self.fail("The topology is not applied.")
+
+    def _key(self):
+        return "".join(
+            random.choice("abcdef")
+            for x in range(32)
+        )
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+
+from rcluster.dump import (
+    DumpReader,
+    DumpWriter,
+)
+
+
+class TestDump(unittest.TestCase):
+    def test_write_read(self):
+        records = [
+            (b"foo", 1, b"bar", None),
+            (b"empty", 2, b"", 0.0),
+            (b"binary", 3, bytes(range(256)), 1.5),
+        ]
+        dump_file = io.BytesIO()
+        writer = DumpWriter(dump_file)
+        for key, timestamp, data, ttl in records:
+            writer.write(key, timestamp, data, ttl)
+        dump_file.seek(0)
+
+        self.assertEqual(records, list(DumpReader(dump_file)))
+
+    def test_read_v1(self):
+        dump_file = io.BytesIO(
+            DumpWriter.V1_MAGIC +
+            DumpWriter.V1_HEADER.pack(1, 3, 3) +
+            b"foobar"
+        )
+
+        self.assertEqual(
+            [(b"foo", 1, b"bar", None)],
+            list(DumpReader(dump_file)),
+        )
+
+    def test_not_dump(self):
+        with self.assertRaises(ValueError):
+            DumpReader(io.BytesIO(b"*1\r\n$4\r\nPING\r\n"))
+
+    def test_truncated(self):
+        dump_file = io.BytesIO()
+        DumpWriter(dump_file).write(b"foo", 1, b"bar")
+        dump_file = io.BytesIO(dump_file.getvalue()[:-1])
+
+        with self.assertRaises(ValueError):
+            list(DumpReader(dump_file))
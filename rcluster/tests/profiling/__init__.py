@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rcluster.profiling import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def test_cpu(self):
+        profiler = Profiler()
+        profiler.start_cpu()
+        self.assertRaises(RuntimeError, profiler.start_cpu)
+        sorted(range(1000), key=lambda value: -value)
+        report = profiler.stop_cpu(count=5)
+
+        self.assertFalse(profiler.cpu_active)
+        self.assertIn("function calls", report)
+        self.assertRaises(RuntimeError, profiler.stop_cpu)
+
+    def test_memory(self):
+        profiler = Profiler()
+        try:
+            profiler.start_memory()
+        except RuntimeError:
+            self.skipTest("tracemalloc is not available.")
+        try:
+            data = [bytes(64) for _ in range(1000)]
+            report = profiler.snapshot_memory(count=5)
+        finally:
+            profiler.stop_memory()
+
+        self.assertTrue(data)
+        self.assertIn("Traced memory", report)
+        self.assertFalse(profiler.memory_active)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    # asyncio requires Python 3.4+.
+    asyncio = None
+else:
+    import rcluster.protocol
+    import rcluster.protocol.replies
+    import rcluster.tracing
+    from rcluster.protocol.aio import (
+        RedisProtocol,
+        _parse_request,
+    )
+
+
+@unittest.skipIf(asyncio is None, "asyncio is not available.")
+class TestParseRequest(unittest.TestCase):
+    def test_pipelined(self):
+        buffer = bytearray(
+            b"*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n*1\r\n$4\r\nPING\r\n",
+        )
+        request, position = _parse_request(buffer, 0)
+        self.assertEqual([b"GET", b"foo"], request)
+        request, position = _parse_request(buffer, position)
+        self.assertEqual([b"PING"], request)
+        self.assertEqual(len(buffer), position)
+
+    def test_incomplete(self):
+        buffer = bytearray(b"*1\r\n$4\r\nPING\r\n*2\r\n$3\r\nGET\r\n$3\r\nfo")
+        _, position = _parse_request(buffer, 0)
+        self.assertEqual((None, position), _parse_request(buffer, position))
+
+    def test_null_argument(self):
+        self.assertEqual(
+            ([b"SET", None], 18),
+            _parse_request(bytearray(b"*2\r\n$3\r\nSET\r\n$-1\r\n"), 0),
+        )
+
+    def test_invalid(self):
+        self.assertRaises(
+            ValueError,
+            _parse_request,
+            bytearray(b"PING\r\n"),
+            0,
+        )
+
+
+@unittest.skipIf(asyncio is None, "asyncio is not available.")
+class TestRedisProtocol(unittest.TestCase):
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        self._transport = _Transport()
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_invalid_reply(self):
+        protocol = self._create_protocol({
+            b"BAD": lambda arguments: _InvalidReply(),
+        })
+        protocol.data_received(b"*1\r\n$3\r\nBAD\r\n*1\r\n$4\r\nPING\r\n")
+
+        self.assertEqual(
+            b"-ERR Invalid reply value.\r\n+PONG\r\n",
+            b"".join(self._transport.data),
+        )
+        self.assertFalse(self._transport.closed)
+
+    def test_pause_writing(self):
+        protocol = self._create_protocol()
+        protocol.pause_writing()
+        self.assertTrue(self._transport.reading_paused)
+
+        protocol.resume_writing()
+        self.assertFalse(self._transport.reading_paused)
+
+    def test_pending_replies(self):
+        protocol = self._create_protocol({
+            b"WAIT": lambda arguments: concurrent.futures.Future(),
+        })
+        protocol.data_received(
+            b"*1\r\n$4\r\nWAIT\r\n" * RedisProtocol.MAX_PENDING_REPLIES,
+        )
+
+        self.assertTrue(self._transport.reading_paused)
+
+    def _create_protocol(self, handlers={}):
+        protocol = RedisProtocol(
+            self._loop,
+            rcluster.protocol.CommandHandler(handlers),
+            rcluster.tracing.Tracer(),
+            _Capture(),
+        )
+        protocol.connection_made(self._transport)
+        return protocol
+
+
+class _Transport:
+    """
+    Transport that keeps the written data.
+    """
+
+    def __init__(self):
+        self.data = list()
+        self.closed = False
+        self.reading_paused = False
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def writelines(self, chunks):
+        self.data.extend(chunks)
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+
+    def close(self):
+        self.closed = True
+
+
+class _InvalidReply:
+    """
+    Reply that cannot be encoded.
+    """
+
+    encoded = None
+    reply_type = None
+    quit = False
+
+
+class _Capture:
+    active = False
@@ -10,6 +10,11 @@ from rcluster.protocol.replies import (
     NoneReply,
 
     ReplyEncoder,
+
+    OK_REPLY,
+    PONG_REPLY,
+    NONE_REPLY,
+    constant,
 )
 
 import unittest
@@ -61,8 +66,49 @@ class TestReplyEncoder(unittest.TestCase):
             data,
         )
 
+    def test_encode_nested_multi_bulk(self):
+        data = ReplyEncoder.encode(MultiBulkReply(replies=[
+            MultiBulkReply(replies=[
+                BulkReply(data=b"foo"),
+                IntegerReply(value=1),
+            ]),
+            StatusReply(data=b"OK"),
+            ErrorReply(data=b"ERR"),
+        ]))
+        self.assertEqual((
+                b"*3\r\n"
+                b"*2\r\n"
+                b"$3\r\n"
+                b"foo\r\n"
+                b":1\r\n"
+                b"+OK\r\n"
+                b"-ERR\r\n"
+            ),
+            data,
+        )
+
     def test_encode_none(self):
         self.assertEqual(
             b"$-1\r\n",
             ReplyEncoder.encode(NoneReply()),
         )
+
+    def test_encode_null(self):
+        self.assertEqual(b"$-1\r\n", ReplyEncoder.encode(None))
+
+    def test_encode_constants(self):
+        self.assertEqual(b"+OK\r\n", ReplyEncoder.encode(OK_REPLY))
+        self.assertEqual(b"+PONG\r\n", ReplyEncoder.encode(PONG_REPLY))
+        self.assertEqual(b"$-1\r\n", ReplyEncoder.encode(NONE_REPLY))
+
+    def test_constant_is_immutable(self):
+        reply = constant(StatusReply(data=b"OK Bye!", quit=True))
+
+        self.assertEqual(b"+OK Bye!\r\n", reply.encoded)
+        self.assertTrue(reply.quit)
+        with self.assertRaises(AttributeError):
+            reply.quit = False
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            BulkReply(data=b"foo").extra = None
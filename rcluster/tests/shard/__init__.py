@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import concurrent.futures
 import os
 import random
+import subprocess
+import threading
+import time
 import unittest
 
 import redis
+import redis.exceptions
 
+import rcluster.protocol.exceptions
+import rcluster.protocol.replies
 import rcluster.shard
+import rcluster.shard.exceptions
+import rcluster.shard.handoff
+import rcluster.tracing
 
 
 class TestShard(unittest.TestCase):
@@ -49,6 +59,353 @@ class TestShard(unittest.TestCase):
 
         self.assertEqual(data, shard.get(key), "Data is not read.")
 
+    def test_set_get_key_with_timeout(self):
+        shard = rcluster.shard.Shard(0)
+        shard.add_shard("localhost", 6380, 0)
+
+        key, data = self._key(), os.urandom(32)
+        shard.set(key, data, timeout=1.0)
+
+        self.assertEqual(
+            data,
+            shard.get(key, timeout=1.0),
+            "Data is not read.",
+        )
+
+    def test_two_phase_read(self):
+        shard = rcluster.shard.Shard(0)
+        shard.replicaness = 2
+        shard.large_value_threshold = 1024
+        shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+
+        key, data = self._key(), os.urandom(4096)
+        shard.set(key, data)
+
+        self.assertEqual(data, shard.get(key), "Data is not read.")
+        self.assertEqual(1, shard.two_phase_reads)
+
+        # Small values are read as usual again.
+        shard.set(key, b"data")
+        self.assertEqual(b"data", shard.get(key), "Data is not read.")
+        self.assertEqual(1, shard.two_phase_reads)
+
+    def test_small_key_buckets(self):
+        shard = rcluster.shard.Shard(0, small_key_buckets=16)
+        shard.add_shard("localhost", 6380, 0)
+
+        key, data = self._key(), os.urandom(8)
+        shard.set(key, data)
+        self.assertEqual(data, shard.get(key), "Data is not read.")
+        cursor, keys = shard.scan(0)
+        while cursor:
+            cursor, more_keys = shard.scan(cursor)
+            keys.extend(more_keys)
+        self.assertIn(key.encode(), keys)
+
+        # Large data moves to the top-level keys.
+        data = os.urandom(1024)
+        shard.set(key, data)
+        self.assertEqual(data, shard.get(key), "Data is not read.")
+
+    def test_key_directory(self):
+        shard = rcluster.shard.Shard(0, key_directory=1024)
+        shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+
+        key, data = self._key(), os.urandom(32)
+        shard.set(key, data)
+        self.assertEqual(data, shard.get(key), "Data is not read.")
+        self.assertEqual(1, shard.directory_hits)
+        self.assertEqual(data, shard.get_async(key, None).result())
+        self.assertEqual(2, shard.directory_hits)
+
+        # Unknown keys are read from every backend.
+        self.assertIsNone(shard.get(self._key()))
+        self.assertEqual(1, shard.directory_misses)
+
+        # Another proxy has written a newer version to the other backend,
+        # and has failed to delete the remembered copy.
+        for port_number in (6380, 6381):
+            backend = redis.StrictRedis(port=port_number)
+            if not backend.exists("rc:" + key):
+                backend.set("rc:" + key, b"newer")
+                backend.set("rc:" + key + ":ts", 1 << 62)
+        shard.replicaness = 2
+        self.assertEqual(b"newer", shard.get(key))
+        self.assertEqual(b"newer", shard.get_async(key, None).result())
+
+    def test_get_async(self):
+        tracer = rcluster.tracing.Tracer(sample_rate=1.0)
+        shard = rcluster.shard.Shard(0, tracer=tracer)
+        shard.replicaness = 2
+        shard_id = shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+
+        key, data = self._key(), os.urandom(32)
+        shard.set(key, data)
+        shard.tracer.active = trace = tracer.start()
+        self.assertEqual(data, shard.get_async(key).result(timeout=1.0))
+        self.assertEqual(
+            2,
+            sum(1 for span in trace.spans if span[0] == "backend"),
+        )
+
+        # Aborted transactions are skipped.
+        aborted = concurrent.futures.Future()
+        aborted.set_result([b"OK", b"QUEUED", b"QUEUED", None])
+        shard._multiplexers[shard_id] = _StubMultiplexer(aborted)
+        self.assertEqual(data, shard.get_async(key).result(timeout=1.0))
+
+        # So are the error replies inside the transaction.
+        broken = concurrent.futures.Future()
+        broken.set_result([b"OK", b"QUEUED", b"QUEUED", [
+            b"stale",
+            redis.exceptions.ResponseError("WRONGTYPE"),
+        ]])
+        shard._multiplexers[shard_id] = _StubMultiplexer(broken)
+        self.assertEqual(data, shard.get_async(key).result(timeout=1.0))
+        self.assertEqual(data, shard.get(key))
+
+        # Fast reads do not wait for the stalled backend.
+        shard._multiplexers[shard_id] = _StubMultiplexer(
+            concurrent.futures.Future(),
+        )
+        shard.replicaness = 1
+        shard.fast_reads = True
+        self.assertEqual(data, shard.get_async(key).result(timeout=1.0))
+
+    def test_expire(self):
+        shard = rcluster.shard.Shard(0, small_key_buckets=16)
+        shard.replicaness = 2
+        shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+
+        key, data = self._key(), os.urandom(8)
+        shard.set(key, data, ttl=0.2)
+        self.assertEqual(data, shard.get(key), "Data is not read.")
+        self.assertGreater(shard.ttl(key), 0.0)
+
+        other_key = self._key()
+        self.assertFalse(shard.expire(other_key, 0.2))
+        shard.set(other_key, data)
+        self.assertEqual(-1, shard.ttl(other_key))
+        self.assertTrue(shard.expire(other_key, 0.2))
+
+        time.sleep(0.3)
+        self.assertIsNone(shard.get(key))
+        self.assertIsNone(shard.get(other_key))
+        self.assertEqual(-2, shard.ttl(key))
+
+    def test_load_ttl(self):
+        shard = rcluster.shard.Shard(0, small_key_buckets=16)
+        shard.add_shard("localhost", 6380, 0)
+
+        key, other_key = self._key(), self._key()
+        shard.load([(key, 1, b"data", 0.2), (other_key, 1, b"data", None)])
+        versions = shard.get_versions([key, other_key])
+        self.assertEqual((1, b"data"), versions[0][:2])
+        self.assertGreater(versions[0][2], 0.0)
+        self.assertEqual((1, b"data", None), versions[1])
+
+        time.sleep(0.3)
+        self.assertIsNone(shard.get(key))
+        self.assertEqual(b"data", shard.get(other_key))
+
+    def test_load_no_backends(self):
+        shard = rcluster.shard.Shard(0)
+
+        with self.assertRaises(rcluster.shard.exceptions.ShardConnectionError):
+            shard.load([(self._key(), 1, b"data", None)])
+
+    def test_scan_timestamp_suffix(self):
+        shard = rcluster.shard.Shard(0)
+        shard.add_shard("localhost", 6380, 0)
+
+        key = self._key()
+        shard.set(key + ":ts", b"data")
+        cursor, keys = shard.scan(0, match=key.encode() + b"*")
+        while cursor:
+            cursor, more_keys = shard.scan(
+                cursor,
+                match=key.encode() + b"*",
+            )
+            keys.extend(more_keys)
+
+        self.assertEqual([key.encode() + b":ts"], keys)
+
+    def test_scan_incremental(self):
+        shard = rcluster.shard.Shard(0)
+        shard.replicaness = 2
+        shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+
+        key = self._key().encode()
+        shard.set(key, b"data")
+        # A single backend is scanned per call.
+        self.assertEqual([], shard.scan(0, match=b"missing" + key)[1])
+        self.assertNotEqual(0, shard.scan(0, match=b"missing" + key)[0])
+
+        # The backend added during the iteration does not shift the others.
+        cursor, keys = shard.scan(0, match=key)
+        shard.add_shard("localhost", 6380, 1)
+        while cursor:
+            cursor, more_keys = shard.scan(cursor, match=key)
+            keys.extend(more_keys)
+        self.assertEqual([key], keys)
+
+    def test_expire_stale_replica(self):
+        shard = rcluster.shard.Shard(0)
+        shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+
+        key, data = self._key(), os.urandom(8)
+        shard.set(key, data, ttl=0.2)
+        # The other backend has missed the deletion of an older version.
+        for port_number in (6380, 6381):
+            backend = redis.StrictRedis(port=port_number)
+            if not backend.exists("rc:" + key):
+                backend.set("rc:" + key, b"stale")
+                backend.set("rc:" + key + ":ts", 1)
+        self.assertEqual(data, shard.get(key), "Data is not read.")
+
+        time.sleep(0.3)
+        self.assertIsNone(shard.get(key))
+        self.assertEqual(-2, shard.ttl(key))
+        self.assertIsNone(shard.get_versions([key])[0][1])
+        # The stale copy is deleted in the background.
+        time.sleep(0.1)
+        self.assertFalse(any(
+            redis.StrictRedis(port=port_number).exists("rc:" + key)
+            for port_number in (6380, 6381)
+        ))
+
+    def test_set_timeout_replicaness(self):
+        shard = rcluster.shard.Shard(0)
+        shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+
+        # The first write completes after the deadline.
+        write_replica, delays = shard._write_replica, [0.2]
+
+        def slow_write_replica(*arguments, **kwargs):
+            if delays:
+                time.sleep(delays.pop())
+            return write_replica(*arguments, **kwargs)
+
+        shard._write_replica = slow_write_replica
+        key = self._key()
+        self.assertRaises(
+            rcluster.shard.exceptions.ShardTimeoutError,
+            shard.set,
+            key,
+            b"data",
+            timeout=0.05,
+        )
+        time.sleep(0.4)
+
+        self.assertEqual(1, sum(
+            1 for port_number in (6380, 6381)
+            if redis.StrictRedis(port=port_number).exists("rc:" + key)
+        ))
+
+    def test_write_concern_replicaness(self):
+        shard = rcluster.shard.Shard(0)
+        shard.replicaness = 2
+        shard.add_shard("localhost", 6380, 0)
+        shard.add_shard("localhost", 6381, 0)
+        handler = shard.command_handler_factory()
+        key = self._key().encode()
+
+        self.assertRaises(
+            rcluster.protocol.exceptions.CommandError,
+            handler.handle,
+            b"SET",
+            [key, b"data", b"W", b"3"],
+        )
+        self.assertEqual(
+            rcluster.protocol.replies.OK_REPLY,
+            handler.handle(b"SET", [key, b"data", b"W", b"2"]),
+        )
+
+        # The replicaness is lowered after the write concern is set.
+        shard.write_concern = 2
+        shard.replicaness = 1
+        self.assertEqual(
+            rcluster.protocol.replies.OK_REPLY,
+            handler.handle(b"SET", [key, b"data"]),
+        )
+
+    def test_set_newer_replica(self):
+        shard = rcluster.shard.Shard(0)
+        shard.add_shard("localhost", 6380, 0)
+
+        # The backend holds a newer version, so the write is not stored.
+        key = self._key()
+        redis.StrictRedis(port=6380).set("rc:%s:ts" % key, 1 << 62)
+        self.assertEqual(0, shard.set(key, b"data"))
+        self.assertIsNone(shard.get(key))
+
+    def test_hot_key_cooldown(self):
+        shard = rcluster.shard.Shard(0)
+        shard.hot_key_threshold = 1
+        shard.add_shard("localhost", 6380, 0)
+
+        key = self._key()
+        shard.get(key)
+        self.assertEqual(1, len(shard.replicated_hot_keys))
+
+        # The count of the key is halved down to zero.
+        for _ in range(4):
+            shard._on_hot_keys_timer()
+        self.assertEqual(0, len(shard.replicated_hot_keys))
+
+    def test_hot_keys_disabled(self):
+        shard = rcluster.shard.Shard(0)
+        shard.add_shard("localhost", 6380, 0)
+
+        shard.get(self._key())
+        self.assertEqual([], shard.get_hot_keys())
+
+    def test_replay_contended(self):
+        shard = rcluster.shard.Shard(0)
+        data_key, timestamp_key = shard._wrap_key(self._key())
+        hint = rcluster.shard.handoff.Hint(
+            data_key,
+            timestamp_key,
+            b"data",
+            1,
+        )
+        connection = _ContendedConnection()
+
+        self.assertFalse(shard._replay_batch(connection, [hint, hint]))
+        # The whole batch, then its first half.
+        self.assertEqual(
+            2 * rcluster.shard.Shard.HANDOFF_ATTEMPTS,
+            connection.attempts,
+        )
+
+    def test_get_timeout(self):
+        shard = rcluster.shard.Shard(0)
+        shard.add_shard("localhost", 6380, 0)
+
+        # Make the backend busy.
+        sleeper = threading.Thread(
+            target=redis.StrictRedis(port=6380).execute_command,
+            args=("DEBUG", "SLEEP", 0.5),
+        )
+        sleeper.start()
+        time.sleep(0.1)
+        try:
+            self.assertRaises(
+                rcluster.shard.exceptions.ShardTimeoutError,
+                shard.get,
+                self._key(),
+                timeout=0.1,
+            )
+        finally:
+            sleeper.join()
+
     def test_shutdown_redis(self):
         shard = rcluster.shard.Shard(0)
         shard.add_shard("localhost", 6380, 0)
@@ -56,9 +413,12 @@ class TestShard(unittest.TestCase):
         key, data = self._key(), os.urandom(32)
         shard.set(key, data)
         self._shutdown_redis(6380)
-
-        # Check that this will not fail.
-        self.assertIsNone(shard.get(key), "Data must be unavailable.")
+        try:
+            # Check that this will not fail.
+            self.assertIsNone(shard.get(key), "Data must be unavailable.")
+        finally:
+            # The other tests need the backend regardless of their order.
+            self._start_redis(6380)
 
     def _key(self):
         return "".join(
@@ -68,3 +428,60 @@ class TestShard(unittest.TestCase):
 
     def _shutdown_redis(self, port_number):
         redis.StrictRedis(port=port_number).shutdown()
+
+    def _start_redis(self, port_number):
+        subprocess.check_call([
+            "redis-server",
+            os.path.join(
+                os.path.dirname(__file__),
+                os.pardir,
+                os.pardir,
+                os.pardir,
+                "etc",
+                "redis-%d.conf" % port_number,
+            ),
+        ])
+        connection = redis.StrictRedis(port=port_number)
+        # Wait till the daemon starts accepting connections.
+        for _ in range(50):
+            try:
+                connection.ping()
+            except redis.exceptions.ConnectionError:
+                time.sleep(0.1)
+            else:
+                return
+        self.fail("Redis has not started on port %d." % port_number)
+
+
+class _StubMultiplexer:
+    """
+    Multiplexer that replies to every read with the same future.
+    """
+
+    def __init__(self, future):
+        self._future = future
+
+    def execute(self, *commands):
+        return self._future
+
+
+class _ContendedConnection:
+    """
+    Connection whose watched keys are always modified.
+    """
+
+    def __init__(self):
+        self.attempts = 0
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def watch(self, *keys):
+        self.attempts += 1
+        raise redis.exceptions.WatchError()
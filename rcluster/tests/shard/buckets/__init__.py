@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rcluster.shard.buckets import BucketLayout
+
+
+class TestBucketLayout(unittest.TestCase):
+    def test_locate(self):
+        layout = BucketLayout(16)
+        bucket_key, field = layout.locate(b"rc:key")
+
+        self.assertEqual(b"key", field)
+        self.assertTrue(bucket_key.startswith(BucketLayout.PREFIX))
+        self.assertEqual((bucket_key, field), layout.locate(b"rc:key"))
+        self.assertLess(int(bucket_key[len(BucketLayout.PREFIX):]), 16)
+
+    def test_fits(self):
+        layout = BucketLayout(16, max_entry_size=64)
+
+        self.assertTrue(layout.fits(b"rc:key", b"x" * 56))
+        self.assertFalse(layout.fits(b"rc:key", b"x" * 57))
+        self.assertFalse(layout.fits(b"rc:" + b"k" * 65, b"x"))
+
+    def test_pack(self):
+        layout = BucketLayout(16)
+
+        self.assertEqual(
+            (1400000000000000, b"data"),
+            layout.unpack(layout.pack(1400000000000000, b"data")),
+        )
+        self.assertEqual((0, None), layout.unpack(None))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+import rcluster.shard.cluster
+
+
+class TestCluster(unittest.TestCase):
+    def test_callbacks(self):
+        cluster = rcluster.shard.cluster.Cluster()
+        cluster.start()
+        try:
+            called, thread_names = threading.Event(), list()
+
+            def callback():
+                thread_names.append(threading.current_thread().name)
+                called.set()
+
+            cluster.add_callback(callback)
+            self.assertTrue(called.wait(5.0), "Callback is not called.")
+            self.assertEqual(["rcluster-cluster"], thread_names)
+        finally:
+            cluster.stop()
+
+    def test_add_remove_shard_concurrently(self):
+        cluster = rcluster.shard.cluster.Cluster()
+        shard_id = cluster.add_shard("localhost", 6380, 0)
+        failures = list()
+        stopped = threading.Event()
+
+        def rank():
+            try:
+                while not stopped.is_set():
+                    cluster._ranked_connections()
+            except Exception as ex:
+                failures.append(ex)
+
+        thread = threading.Thread(target=rank)
+        thread.start()
+        try:
+            for _ in range(50):
+                cluster.remove_shard(shard_id)
+                shard_id = cluster.add_shard("localhost", 6380, 0)
+        finally:
+            stopped.set()
+            thread.join()
+            cluster.stop()
+        self.assertEqual([], failures)
+        self.assertEqual([shard_id], list(cluster.connections))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rcluster.shard.directory import KeyDirectory
+
+
+class TestKeyDirectory(unittest.TestCase):
+    def test_put_get(self):
+        directory = KeyDirectory(16)
+        directory.put(b"key", [2, 0])
+
+        self.assertEqual([2, 0], directory.get(b"key"))
+        self.assertIsNone(directory.get(b"other"))
+        self.assertEqual(1, len(directory))
+
+        directory.put(b"key", [])
+        self.assertIsNone(directory.get(b"key"))
+        self.assertEqual(0, len(directory))
+
+    def test_add(self):
+        directory = KeyDirectory(16)
+        directory.add(b"key", 1)
+        directory.add(b"key", 3)
+        directory.add(b"key", 1)
+
+        self.assertEqual([1, 3], directory.get(b"key"))
+
+    def test_full(self):
+        directory = KeyDirectory(8)
+        keys = [bytes("key%d" % index, "ascii") for index in range(64)]
+        for key in keys:
+            directory.put(key, [0])
+
+        self.assertEqual(8, directory.capacity)
+        self.assertEqual(8, len(directory))
+        self.assertEqual(
+            8,
+            sum(1 for key in keys if directory.get(key) is not None),
+        )
+
+    def test_remove_shard(self):
+        directory = KeyDirectory(16)
+        directory.put(b"key", [0, 1])
+        directory.remove_shard(0)
+
+        self.assertEqual([1], directory.get(b"key"))
+
+        directory.remove_shard(1)
+        self.assertIsNone(directory.get(b"key"))
+
+    def test_reuse_index(self):
+        directory = KeyDirectory(16)
+        directory.put(b"key", [0])
+        for shard_id in range(1, KeyDirectory.MAX_SHARDS):
+            directory.add(b"other", shard_id)
+        directory.remove_shard(0)
+        # The update clears the locations of the removed backend.
+        directory.put(b"other", [1])
+        directory.add(b"new", KeyDirectory.MAX_SHARDS)
+
+        self.assertIsNone(directory.get(b"key"))
+        self.assertEqual([KeyDirectory.MAX_SHARDS], directory.get(b"new"))
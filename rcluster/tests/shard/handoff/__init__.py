@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from rcluster.shard.handoff import (
+    Hint,
+    HintQueue,
+)
+
+
+class TestHintQueue(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_newest_wins(self):
+        hints = HintQueue()
+        hints.add(Hint(b"rc:foo", b"rc:foo:ts", b"new", 2))
+        hints.add(Hint(b"rc:foo", b"rc:foo:ts", b"old", 1))
+
+        self.assertEqual(1, len(hints))
+        self.assertEqual(b"new", hints.peek(1)[0].data)
+
+    def test_capacity(self):
+        hints = HintQueue(capacity=2)
+        for index in range(3):
+            key = bytes("rc:%d" % index, "ascii")
+            hints.add(Hint(key, key + b":ts", b"data", index))
+
+        self.assertEqual(2, len(hints))
+        self.assertEqual(1, hints.dropped)
+        self.assertEqual(
+            [b"rc:1", b"rc:2"],
+            [hint.data_key for hint in hints.peek(10)],
+        )
+
+    def test_remove_keeps_newer(self):
+        hints = HintQueue()
+        hints.add(Hint(b"rc:foo", b"rc:foo:ts", b"old", 1))
+        batch = hints.peek(10)
+        hints.add(Hint(b"rc:foo", b"rc:foo:ts", b"new", 2))
+        hints.remove(batch)
+
+        self.assertEqual(1, len(hints))
+
+    def test_file(self):
+        path = os.path.join(self._directory, "shard.hints")
+        hints = HintQueue(path=path)
+        hints.add(Hint(b"rc:foo", b"rc:foo:ts", b"foo", 1))
+        hints.add(Hint(b"rc:bar", b"rc:bar:ts", None, 2))
+        hints.close()
+
+        hints = HintQueue(path=path)
+        self.assertEqual(
+            [(b"rc:foo", b"foo", 1), (b"rc:bar", None, 2)],
+            [
+                (hint.data_key, hint.data, hint.timestamp)
+                for hint in hints.peek(10)
+            ],
+        )
+        hints.remove(hints.peek(10))
+        hints.close()
+        self.assertEqual(0, os.path.getsize(path))
+
+    def test_file_expiry(self):
+        path = os.path.join(self._directory, "shard.hints")
+        hints = HintQueue(path=path)
+        hints.add(Hint(b"rc:foo", b"rc:foo:ts", b"foo", 1, 1500000000000))
+        hints.add(Hint(b"rc:bar", b"rc:bar:ts", b"bar", 2))
+        hints.close()
+
+        hints = HintQueue(path=path)
+        self.assertEqual(
+            [(b"foo", 1500000000000), (b"bar", None)],
+            [(hint.data, hint.expire_at) for hint in hints.peek(10)],
+        )
+        hints.close()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rcluster.shard.hotkeys import (
+    CountMinSketch,
+    HotKeyTracker,
+)
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_never_underestimates(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        counts = dict()
+        for index in range(1000):
+            key = bytes("key:%d" % (index % 97), "ascii")
+            sketch.add(key)
+            counts[key] = counts.get(key, 0) + 1
+
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+
+    def test_decay(self):
+        sketch = CountMinSketch()
+        for _ in range(8):
+            sketch.add(b"foo")
+        sketch.decay()
+
+        self.assertEqual(4, sketch.estimate(b"foo"))
+
+    def test_stable_indexes(self):
+        # The indexes do not depend on the hash randomization.
+        self.assertEqual(
+            [1313, 6976, 8543, 14206],
+            CountMinSketch()._get_indexes(b"foo"),
+        )
+
+
+class TestHotKeyTracker(unittest.TestCase):
+    def test_top(self):
+        tracker = HotKeyTracker(capacity=2)
+        for _ in range(10):
+            tracker.record(b"hot")
+        for _ in range(5):
+            tracker.record(b"warm")
+        for index in range(100):
+            tracker.record(bytes("cold:%d" % index, "ascii"))
+
+        self.assertEqual(
+            [(b"hot", 10), (b"warm", 5)],
+            tracker.top(),
+        )
+        self.assertEqual([(b"hot", 10)], tracker.top(1))
+
+    def test_decay(self):
+        tracker = HotKeyTracker()
+        tracker.record(b"once")
+        for _ in range(4):
+            tracker.record(b"hot")
+        tracker.decay()
+
+        self.assertEqual([(b"hot", 2)], tracker.top())
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rcluster.shard.load import (
+    BackendLoad,
+    LoadIndex,
+)
+
+
+class TestLoadIndex(unittest.TestCase):
+    def test_order(self):
+        index = LoadIndex()
+        index.update(b"a", BackendLoad(db_size=10, used_memory=300))
+        index.update(b"b", BackendLoad(db_size=20, used_memory=100))
+        index.update(b"c", BackendLoad(db_size=5, used_memory=100))
+
+        self.assertEqual([b"c", b"b", b"a"], list(index))
+
+    def test_add(self):
+        index = LoadIndex()
+        index.update(b"a", BackendLoad(db_size=0, used_memory=100))
+        index.update(b"b", BackendLoad(db_size=0, used_memory=200))
+        index.add(b"a", 2, 150)
+
+        self.assertEqual([b"b", b"a"], list(index))
+        self.assertEqual(2, index.get(b"a").db_size)
+        self.assertEqual(250, index.get(b"a").used_memory)
+
+    def test_remove(self):
+        index = LoadIndex()
+        index.update(b"a", BackendLoad())
+        index.update(b"b", BackendLoad(used_memory=1))
+        index.remove(b"a")
+        index.add(b"a", 1, 1)
+
+        self.assertEqual([b"b"], list(index))
+        self.assertEqual(1, len(index))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import unittest
+
+import redis
+import redis.exceptions
+
+from rcluster.shard.multiplex import Multiplexer
+
+
+class TestMultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.multiplexer = Multiplexer(
+            redis.StrictRedis(port=6380).connection_pool,
+        )
+
+    def tearDown(self):
+        self.multiplexer.close()
+
+    def test_execute(self):
+        key, data = b"rc:test:multiplex", os.urandom(32)
+        replies = self.multiplexer.execute(
+            (b"SET", key, data),
+            (b"GET", key),
+        ).result()
+
+        self.assertEqual(data, replies[1])
+
+    def test_replies_in_order(self):
+        results = dict()
+
+        def echo(index):
+            value = bytes(str(index), "ascii")
+            results[index] = (
+                self.multiplexer.execute((b"ECHO", value)).result(),
+                value,
+            )
+
+        threads = [
+            threading.Thread(target=echo, args=(index, ))
+            for index in range(32)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(32, len(results))
+        for replies, value in results.values():
+            self.assertEqual([value], replies)
+        self.assertLessEqual(self.multiplexer.batches, 32)
+
+    def test_error_reply(self):
+        failed = self.multiplexer.execute((b"NOSUCHCOMMAND", ))
+        succeeded = self.multiplexer.execute((b"ECHO", b"data"))
+
+        self.assertRaises(redis.exceptions.ResponseError, failed.result)
+        self.assertEqual([b"data"], succeeded.result())
+
+    def test_closed(self):
+        self.multiplexer.close()
+
+        self.assertRaises(
+            redis.exceptions.ConnectionError,
+            self.multiplexer.execute,
+            (b"PING", ),
+        )
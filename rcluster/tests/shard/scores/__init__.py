@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rcluster.shard.scores import BackendScore
+
+
+class TestBackendScore(unittest.TestCase):
+    def test_unknown(self):
+        score = BackendScore()
+
+        self.assertIsNone(score.latency)
+        self.assertIsNone(score.percentile(99))
+        self.assertTrue(score.healthy)
+
+    def test_rank(self):
+        fast, slow, failed = BackendScore(), BackendScore(), BackendScore()
+        for _ in range(10):
+            fast.record(0.001)
+            slow.record(0.010)
+            failed.record(0.001, failed=True)
+
+        self.assertFalse(failed.healthy)
+        self.assertEqual(
+            [fast, slow, failed],
+            sorted([failed, slow, fast], key=lambda score: score.rank),
+        )
+
+    def test_percentile(self):
+        score = BackendScore()
+        for latency in range(1, 101):
+            score.record(latency / 1000.0)
+
+        self.assertEqual(0.099, score.percentile(99))
+        self.assertEqual(0.050, score.percentile(50))
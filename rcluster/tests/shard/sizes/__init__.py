@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rcluster.shard.sizes import SizeHints
+
+
+class TestSizeHints(unittest.TestCase):
+    def test_put_get(self):
+        hints = SizeHints()
+        hints.put(b"key", 1048576)
+
+        self.assertEqual(1048576, hints.get(b"key"))
+        self.assertIsNone(hints.get(b"other"))
+
+        hints.discard(b"key")
+        self.assertIsNone(hints.get(b"key"))
+
+    def test_least_recently_used(self):
+        hints = SizeHints(capacity=2)
+        hints.put(b"first", 1)
+        hints.put(b"second", 2)
+        hints.get(b"first")
+        hints.put(b"third", 3)
+
+        self.assertEqual(2, len(hints))
+        self.assertEqual(1, hints.get(b"first"))
+        self.assertIsNone(hints.get(b"second"))
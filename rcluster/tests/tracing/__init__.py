@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from rcluster.tracing import (
+    NULL_TRACE,
+    Tracer,
+)
+
+
+class TestTracer(unittest.TestCase):
+    def test_not_sampled(self):
+        tracer = Tracer(sample_rate=0.0)
+        trace = tracer.start()
+        trace.mark("parse")
+        with trace.span("backend", "shard"):
+            pass
+        tracer.finish(trace)
+
+        self.assertIs(NULL_TRACE, trace)
+        self.assertEqual([], tracer.get_traces())
+
+    def test_sampled(self):
+        tracer = Tracer(sample_rate=1.0)
+        trace = tracer.start()
+        trace.describe(b"GET", [b"foo"])
+        trace.mark("parse")
+        with trace.span("backend", "shard", "get"):
+            pass
+        trace.mark("dispatch")
+        tracer.finish(trace)
+
+        self.assertEqual([trace], tracer.get_traces())
+        self.assertEqual(
+            ["parse", "backend", "dispatch"],
+            [name for name, _, _, _ in trace.spans],
+        )
+        data = trace.format()
+        self.assertIn(b"GET foo", data)
+        self.assertIn(b"backend[shard,get]=", data)
+
+    def test_capacity(self):
+        tracer = Tracer(sample_rate=1.0, capacity=2)
+        traces = [tracer.start() for _ in range(3)]
+        for trace in traces:
+            tracer.finish(trace)
+
+        self.assertEqual([traces[2], traces[1]], tracer.get_traces())
+        self.assertEqual([traces[2]], tracer.get_traces(1))
+
+    def test_active_per_thread(self):
+        tracer = Tracer(sample_rate=1.0)
+        tracer.active = trace = tracer.start()
+        actives = []
+        thread = threading.Thread(
+            target=lambda: actives.append(tracer.active),
+        )
+        thread.start()
+        thread.join()
+
+        self.assertIs(trace, tracer.active)
+        self.assertEqual([NULL_TRACE], actives)
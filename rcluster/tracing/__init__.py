@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Sampled request tracing.
+"""
+
+import collections
+import itertools
+import random
+import threading
+import time
+
+
+class Tracer:
+    """
+    Samples incoming requests and keeps the recent traces in memory.
+    """
+
+    def __init__(self, sample_rate=0.0, capacity=128):
+        self._sample_rate = sample_rate
+        self._traces = collections.deque(maxlen=capacity)
+        self._trace_ids = itertools.count(1)
+        # The trace of the request being dispatched right now by the thread.
+        # Backend calls are made or started within the dispatch, so they can
+        # find their trace here. The other threads get the trace explicitly.
+        self._local = threading.local()
+
+    @property
+    def active(self):
+        return getattr(self._local, "trace", NULL_TRACE)
+
+    @active.setter
+    def active(self, trace):
+        self._local.trace = trace
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, sample_rate):
+        self._sample_rate = sample_rate
+
+    def start(self):
+        """
+        Starts a new trace if the request is sampled. Returns the null trace
+        otherwise.
+        """
+
+        if self._sample_rate and random.random() < self._sample_rate:
+            return Trace(next(self._trace_ids))
+        return NULL_TRACE
+
+    def finish(self, trace):
+        """
+        Stores the finished trace.
+        """
+
+        if trace is not NULL_TRACE:
+            self._traces.append(trace)
+
+    def get_traces(self, count=None):
+        """
+        Gets the most recent traces, the newest first.
+        """
+
+        traces = reversed(self._traces)
+        return list(
+            traces if count is None else itertools.islice(traces, count),
+        )
+
+    def reset(self):
+        self._traces.clear()
+
+
+class Trace:
+    """
+    Structured spans of a single sampled request.
+    """
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.started_at = self._last_mark = time.time()
+        self.command = None
+        self.arguments = ()
+        self.spans = list()
+
+    def describe(self, command, arguments):
+        """
+        Remembers the request. Nothing is formatted until the trace is read.
+        """
+
+        self.command, self.arguments = command, arguments
+
+    def mark(self, name, *details):
+        """
+        Records the span from the previous mark till now.
+        """
+
+        now = time.time()
+        self.spans.append(
+            (name, self._last_mark, now - self._last_mark, details),
+        )
+        self._last_mark = now
+
+    def span(self, name, *details):
+        """
+        Records the span that covers the with-block.
+        """
+
+        return _Span(self, name, details)
+
+    def format(self):
+        """
+        Formats the trace into a byte string.
+        """
+
+        parts = [
+            "#%d" % self.trace_id,
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.started_at)),
+        ]
+        if self.command is not None:
+            parts.append(_format_value(self.command))
+            if self.arguments:
+                # The first argument is usually the key.
+                parts.append(_format_value(self.arguments[0]))
+                parts.append("(%d args)" % len(self.arguments))
+        parts.append(
+            "total=%.3fms" % ((self._last_mark - self.started_at) * 1000.0),
+        )
+        parts.extend(
+            "%s%s=%.3fms" % (
+                name,
+                "[%s]" % ",".join(_format_value(d) for d in details)
+                if details else "",
+                duration * 1000.0,
+            )
+            for name, _, duration, details in self.spans
+        )
+        return bytes(" ".join(parts), "utf-8")
+
+
+class _NullTrace:
+    """
+    Trace of a request that is not sampled. Does nothing.
+    """
+
+    def describe(self, command, arguments):
+        pass
+
+    def mark(self, name, *details):
+        pass
+
+    def span(self, name, *details):
+        return _NULL_SPAN
+
+
+class _Span:
+    def __init__(self, trace, name, details):
+        self._trace = trace
+        self._name = name
+        self._details = details
+
+    def __enter__(self):
+        self._started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._trace.spans.append((
+            self._name,
+            self._started_at,
+            time.time() - self._started_at,
+            self._details if exc_type is None
+            else self._details + ("failed", ),
+        ))
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+def _format_value(value, max_length=32):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    value = str(value)
+    return value if len(value) <= max_length else value[:max_length] + "..."
+
+
+NULL_TRACE = _NullTrace()
+_NULL_SPAN = _NullSpan()
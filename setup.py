@@ -60,18 +60,57 @@ setuptools.setup(
     # Package directories.
     packages=[
         "rcluster",
+        "rcluster.capture",
+        "rcluster.client",
+        "rcluster.client.aio",
+        "rcluster.dump",
+        "rcluster.profiling",
         "rcluster.protocol",
+        "rcluster.protocol.aio",
         "rcluster.protocol.exceptions",
         "rcluster.protocol.replies",
+        "rcluster.protocol.stream",
         "rcluster.shard",
+        "rcluster.shard.buckets",
+        "rcluster.shard.cluster",
+        "rcluster.shard.directory",
+        "rcluster.shard.exceptions",
+        "rcluster.shard.handoff",
+        "rcluster.shard.hotkeys",
+        "rcluster.shard.load",
+        "rcluster.shard.multiplex",
+        "rcluster.shard.scores",
+        "rcluster.shard.sizes",
+        "rcluster.shard.topology",
         "rcluster.shared",
         "rcluster.tests",
+        "rcluster.tests.capture",
+        "rcluster.tests.client",
+        "rcluster.tests.dump",
+        "rcluster.tests.profiling",
         "rcluster.tests.protocol",
+        "rcluster.tests.protocol.aio",
+        "rcluster.tests.protocol.replies",
+        "rcluster.tests.shard",
+        "rcluster.tests.shard.buckets",
+        "rcluster.tests.shard.cluster",
+        "rcluster.tests.shard.directory",
+        "rcluster.tests.shard.handoff",
+        "rcluster.tests.shard.hotkeys",
+        "rcluster.tests.shard.load",
+        "rcluster.tests.shard.multiplex",
+        "rcluster.tests.shard.scores",
+        "rcluster.tests.shard.sizes",
+        "rcluster.tests.tracing",
+        "rcluster.tracing",
     ],
     # Entry points.
     entry_points={
         "console_scripts": [
             "rcluster-shard = rcluster.shard:entry_point",
+            "rcluster-export = rcluster.dump:export_entry_point",
+            "rcluster-import = rcluster.dump:import_entry_point",
+            "rcluster-replay = rcluster.capture:replay_entry_point",
         ],
     },
     # Other files.
@@ -80,7 +119,7 @@ setuptools.setup(
     # Dependencies.
     install_requires=[
         # Redis driver is obviously required to communicate with Redis.
-        "redis>=2.7.2",
+        "redis>=2.10.4",
         # Tornado is used for all communications.
         "tornado>=2.4.1",
         # Using Hiredis can provide up to a 10x speed improvement in
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Measures the throughput and latency of a running rcluster-shard.
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+
+def encode_request(*arguments):
+    chunks = [bytes("*%d\r\n" % len(arguments), "ascii")]
+    for argument in arguments:
+        chunks.append(bytes("$%d\r\n" % len(argument), "ascii"))
+        chunks.append(argument)
+        chunks.append(b"\r\n")
+    return b"".join(chunks)
+
+
+def read_reply(stream):
+    line = stream.readline()
+    if not line:
+        raise EOFError("Connection is closed.")
+    if line[:1] == b"$":
+        length = int(line[1:])
+        if length >= 0:
+            stream.read(length + 2)
+    elif line[:1] == b"*":
+        for _ in range(int(line[1:])):
+            read_reply(stream)
+
+
+def run_client(args, requests, latencies):
+    connection = socket.create_connection((args.host, args.port))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    stream = connection.makefile("rb")
+    try:
+        for index in range(0, args.requests, args.pipeline):
+            batch = requests[index:index + args.pipeline]
+            started_at = time.time()
+            connection.sendall(b"".join(batch))
+            for _ in batch:
+                read_reply(stream)
+            latencies.append((time.time() - started_at) / len(batch))
+    finally:
+        stream.close()
+        connection.close()
+
+
+def percentile(values, percent):
+    index = max(0, int(len(values) * percent / 100.0 + 0.5) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=globals()["__doc__"],
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="benchmark.py",
+    )
+    parser.add_argument("--host", default="localhost", dest="host")
+    parser.add_argument("--port", type=int, default=6379, dest="port")
+    parser.add_argument(
+        "--command",
+        choices=["PING", "SET", "GET"],
+        default="PING",
+        dest="command",
+    )
+    parser.add_argument("--clients", type=int, default=8, dest="clients")
+    parser.add_argument("--requests", type=int, default=10000, dest="requests")
+    parser.add_argument("--pipeline", type=int, default=1, dest="pipeline")
+    parser.add_argument("--size", type=int, default=64, dest="size")
+    args = parser.parse_args()
+
+    data = os.urandom(args.size)
+    requests = list()
+    for index in range(args.requests):
+        key = bytes("key:%d" % (index % 1000), "ascii")
+        if args.command == "SET":
+            requests.append(encode_request(b"SET", key, data))
+        elif args.command == "GET":
+            requests.append(encode_request(b"GET", key))
+        else:
+            requests.append(encode_request(b"PING"))
+
+    latencies = list()
+    clients = [
+        threading.Thread(target=run_client, args=(args, requests, latencies))
+        for _ in range(args.clients)
+    ]
+    started_at = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - started_at
+
+    if not latencies:
+        print("No requests completed.")
+        sys.exit(os.EX_UNAVAILABLE)
+    latencies.sort()
+    print("%s: %d clients, pipeline %d, %d requests each" % (
+        args.command,
+        args.clients,
+        args.pipeline,
+        args.requests,
+    ))
+    print("%.0f requests/s" % (args.clients * args.requests / elapsed))
+    print("latency p50=%.3fms p99=%.3fms max=%.3fms" % (
+        percentile(latencies, 50) * 1000.0,
+        percentile(latencies, 99) * 1000.0,
+        latencies[-1] * 1000.0,
+    ))
+
+    sys.exit(os.EX_OK)